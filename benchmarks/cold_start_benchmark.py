@@ -0,0 +1,141 @@
+import os
+import sys
+import math
+import json
+import time
+import subprocess
+import importlib.util
+
+# Cold-start benchmark and budget check of the Lambda handlers. Every run starts a fresh Python process, the way
+# Lambda starts a new execution environment, and measures:
+#   - the init phase: loading the handler module, broken down by the components of its init timing report
+#   - the first invocation with one application, against the local stubs in replay.py without injected latency. The
+#     handler's lazy clients still create their real boto3 clients on first use, so the invocation includes that
+#     cost, which is also reported on its own.
+#   - the creation of every boto3 client the handler creates lazily, including the import of boto3 by the first one created
+# The script exits with status 1 when the p50 init phase (or first invocation) exceeds its budget, so it can run as
+# a check before deploying.
+#
+# Usage:
+#   python benchmarks/cold_start_benchmark.py [--handler r-disposition-assessment.py] [--runs 5] [--budget-ms 150]
+#       [--invocation-budget-ms 500] [--env RESPONSE_CACHE_BACKEND=disk ...]
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLERS = ['r-disposition-assessment.py', 'migration-plan.py']
+
+def measure(filename):
+    # Runs in the fresh process. The handler is loaded before anything else of the benchmark is imported, so
+    # modules shared with replay.py (botocore among them) count towards the handler's init phase.
+    start = time.perf_counter()
+    path = os.path.join(BENCHMARK_DIR, '..', filename)
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    init_ms = (time.perf_counter() - start) * 1000
+
+    import logging
+    import replay
+    import lambda_handler_benchmark
+    module.logger.setLevel(logging.ERROR)
+    with open(os.path.join(BENCHMARK_DIR, 'responses', 'structured.json')) as f:
+        book = replay.ReplayBook([], replay.default_responses(f.read()))
+    lazy_clients = {name: value for name, value in vars(module).items() if isinstance(value, module.LazyClient)}
+    replay.install_stubs(module, book, replay.Injector())
+
+    class StubbedLazyClient(module.LazyClient):
+        # Creates the real client on first use, as in Lambda, so the first invocation pays for it, but answers
+        # with the stub
+        def __init__(self, lazy_client, stub):
+            super().__init__(lazy_client.service_name, **lazy_client.config)
+            self.stub = stub
+
+        def get(self):
+            super().get()
+            return self.stub
+
+    clients = {}
+    for name, lazy_client in lazy_clients.items():
+        clients[name] = StubbedLazyClient(lazy_client, getattr(module, name))
+        setattr(module, name, clients[name])
+    seconds, response = lambda_handler_benchmark.run_handler(module, lambda_handler_benchmark.build_event(filename, ['APP-0001'], {}))
+    client_ms = sum(ms for component, ms in module.init_timings.items() if component.startswith('client:'))
+
+    # Clients this invocation did not need are created afterwards, only for their row in the report
+    for client in clients.values():
+        client.get()
+    return {
+        'init_ms': init_ms,
+        'components': dict(module.init_timings),
+        'first_invocation_ms': seconds * 1000,
+        'first_invocation_client_ms': client_ms,
+        'error': 'response' not in response
+    }
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def run(filename, runs, environment):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', filename], env=environment,
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+def report(filename, results):
+    print(f"{filename}: {len(results)} cold starts, {sum(result['error'] for result in results)} failed invocations")
+    print(f"  {'component':<34}{'p50 ms':>10}{'max ms':>10}")
+    components = list(results[0]['components'])
+    rows = [(component, [result['components'].get(component, 0) for result in results]) for component in components]
+    rows.append(('init phase (module load)', [result['init_ms'] for result in results]))
+    rows.append(('first invocation, 1 app', [result['first_invocation_ms'] for result in results]))
+    rows.append(('  of which client creation', [result['first_invocation_client_ms'] for result in results]))
+    for name, values in rows:
+        print(f"  {name:<34}{percentile(values, 0.5):>10.1f}{max(values):>10.1f}")
+
+def check_budget(filename, results, budget_ms, invocation_budget_ms):
+    failures = []
+    init_ms = percentile([result['init_ms'] for result in results], 0.5)
+    if budget_ms and init_ms > budget_ms:
+        failures.append(f"{filename}: p50 init phase {init_ms:.1f} ms exceeds the budget of {budget_ms:.0f} ms")
+    invocation_ms = percentile([result['first_invocation_ms'] for result in results], 0.5)
+    if invocation_budget_ms and invocation_ms > invocation_budget_ms:
+        failures.append(f"{filename}: p50 first invocation {invocation_ms:.1f} ms exceeds the budget of {invocation_budget_ms:.0f} ms")
+    if any(result['error'] for result in results):
+        failures.append(f"{filename}: the first invocation failed")
+    return failures
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--measure':
+        print(json.dumps(measure(sys.argv[2])))
+        sys.exit(0)
+
+    import argparse
+    from lambda_handler_benchmark import BENCHMARK_ENVIRONMENT
+    parser = argparse.ArgumentParser(description="Measure the cold start of the Lambda handlers and check it against a budget")
+    parser.add_argument('--handler', action='append', choices=HANDLERS, help="Handler to measure; both by default")
+    parser.add_argument('--runs', type=int, default=5, help="Cold starts per handler")
+    parser.add_argument('--budget-ms', type=float, default=150, help="Maximum p50 init phase; 0 disables the check")
+    parser.add_argument('--invocation-budget-ms', type=float, default=0, help="Maximum p50 first invocation; 0 disables the check")
+    parser.add_argument('--env', action='append', default=[], help="KEY=VALUE set before the handler is loaded")
+    args = parser.parse_args()
+
+    environment = dict(os.environ)
+    for name, value in BENCHMARK_ENVIRONMENT.items():
+        environment.setdefault(name, value)
+    for item in args.env:
+        name, value = item.split('=', 1)
+        environment[name] = value
+    # Creating the real clients needs credentials, but never reaches AWS
+    environment.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    environment.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    failures = []
+    for filename in args.handler or HANDLERS:
+        results = run(filename, args.runs, environment)
+        report(filename, results)
+        failures.extend(check_budget(filename, results, args.budget_ms, args.invocation_budget_ms))
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,164 @@
+import os
+import sys
+import math
+import json
+import time
+import logging
+import argparse
+import contextlib
+import importlib.util
+
+import replay
+
+# End-to-end benchmark of a Lambda handler against the local Bedrock, knowledge base and S3 stubs in replay.py.
+# For every portfolio size it runs lambda_handler a number of times, each time in a freshly loaded module, and
+# reports p50/p95 wall time, calls per application and bytes moved.
+#
+# Usage:
+#   python benchmarks/lambda_handler_benchmark.py [--handler r-disposition-assessment.py] [--apps 1,10,100]
+#       [--runs 3] [--fixtures DIR] [--latency-ms invoke_model=200:50,retrieve_and_generate=100:20,*=5:1]
+#       [--throttle-rate 0.02] [--env MAX_WORKERS=16 --env KB_BATCH_RETRIEVAL=true ...] [--param mode=sync ...]
+#
+# Record fixtures against real AWS (with the handler's environment variables set) with:
+#   python benchmarks/lambda_handler_benchmark.py --record DIR --app-ids A1-CRM,A2-CMDB
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LATENCY_MS = 'invoke_model=200:50,invoke_model_with_response_stream=200:50,retrieve_and_generate=100:20,retrieve=50:10,*=5:1'
+
+# The stubs do the throttling, so the client-side rate limits are off and backoff is short unless overridden
+BENCHMARK_ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'S3_BUCKET': 'benchmark-bucket',
+    'KB_ID_MIGRATION_AGENT_INFO': 'benchmark-kb-application',
+    'KB_ID_BP_DOCS': 'benchmark-kb-best-practices',
+    'KB_ID_QANDA_INFO': 'benchmark-kb-qanda',
+    'MODEL_REQUESTS_PER_SECOND': '0',
+    'KB_REQUESTS_PER_SECOND': '0',
+    'THROTTLE_BASE_DELAY_SECONDS': '0.05',
+    'THROTTLE_MAX_DELAY_SECONDS': '1'
+}
+
+def load_handler_module(filename):
+    # The file names of the Lambda handlers are not importable, and their boto3 clients need a region once created
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    path = os.path.join(BENCHMARK_DIR, '..', filename)
+    spec = importlib.util.spec_from_file_location(filename.replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_latency(spec):
+    latency = {}
+    for item in filter(None, spec.split(',')):
+        operation, values = item.split('=')
+        median, _, jitter = values.partition(':')
+        latency[operation] = (float(median), float(jitter or 0))
+    return latency
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def build_event(handler, app_ids, params):
+    if handler == 'migration-plan.py':
+        properties = {'app_id': ','.join(app_ids), 'r_strategy': 'Rehost'}
+    else:
+        properties = {'app_ids': ','.join(app_ids)}
+    properties.update(params)
+    return {
+        'requestBody': {'content': {'application/json': {'properties': [{'name': name, 'value': value} for name, value in properties.items()]}}},
+        'actionGroup': 'benchmark',
+        'apiPath': '/benchmark',
+        'httpMethod': 'POST',
+        'sessionAttributes': {},
+        'promptSessionAttributes': {}
+    }
+
+class BenchmarkContext:
+    # Lambda context with the maximum 15 minute timeout, so checkpointed runs never stop early
+    def __init__(self):
+        self.deadline = time.monotonic() + 900
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def run_handler(module, event):
+    # Handlers print an EMF metric line per stage (and every event and response with LOG_PAYLOADS); keep them out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        response = module.lambda_handler(event, BenchmarkContext())
+        return time.perf_counter() - start, response
+
+def benchmark(args):
+    with open(os.path.join(BENCHMARK_DIR, 'responses', 'structured.json')) as f:
+        recommendation = f.read()
+    exchanges = replay.load_fixtures(args.fixtures) if args.fixtures else []
+    latency = parse_latency(args.latency_ms)
+    params = dict(param.split('=', 1) for param in args.param)
+
+    print(f"{'apps':>6}{'runs':>6}{'p50 s':>10}{'p95 s':>10}{'errors':>8}{'model/app':>11}{'kb/app':>9}{'s3/app':>9}"
+          f"{'throttles':>11}{'KB sent/app':>13}{'KB recv/app':>13}")
+    for apps in [int(size) for size in args.apps.split(',')]:
+        app_ids = [f"APP-{index:04d}" for index in range(1, apps + 1)]
+        durations, errors, totals = [], 0, {'model': 0, 'kb': 0, 's3': 0, 'throttles': 0, 'sent': 0, 'received': 0}
+        for _ in range(args.runs):
+            module = load_handler_module(args.handler)
+            module.logger.setLevel(logging.ERROR)
+            injector = replay.Injector(latency, args.throttle_rate, seed=len(durations))
+            replay.install_stubs(module, replay.ReplayBook(exchanges, replay.default_responses(recommendation)), injector)
+            seconds, response = run_handler(module, build_event(args.handler, app_ids, params))
+            durations.append(seconds)
+            errors += 'response' not in response
+            stats = injector.stats()
+            calls = stats['calls']
+            totals['model'] += calls.get('invoke_model', 0) + calls.get('invoke_model_with_response_stream', 0)
+            totals['kb'] += calls.get('retrieve_and_generate', 0) + calls.get('retrieve', 0)
+            totals['s3'] += sum(count for operation, count in calls.items() if operation not in replay.RECORDED_OPERATIONS['bedrock'] + replay.RECORDED_OPERATIONS['bedrock_client'] + replay.StubBedrockBatch.BATCH_OPERATIONS)
+            totals['throttles'] += sum(stats['throttles'].values())
+            totals['sent'] += stats['bytes_sent']
+            totals['received'] += stats['bytes_received']
+        per_app = {name: value / args.runs / apps for name, value in totals.items()}
+        print(f"{apps:>6}{args.runs:>6}{percentile(durations, 0.5):>10.3f}{percentile(durations, 0.95):>10.3f}{errors:>8}"
+              f"{per_app['model']:>11.2f}{per_app['kb']:>9.2f}{per_app['s3']:>9.2f}{totals['throttles'] / args.runs:>11.1f}"
+              f"{per_app['sent'] / 1024:>13.1f}{per_app['received'] / 1024:>13.1f}")
+
+def record(args):
+    # Runs the handler once against real AWS and appends the exchanges to the fixture directory
+    os.makedirs(args.record, exist_ok=True)
+    module = load_handler_module(args.handler)
+    replay.record_module(module, args.record)
+    params = dict(param.split('=', 1) for param in args.param)
+    seconds, response = run_handler(module, build_event(args.handler, args.app_ids.split(','), params))
+    print(f"Recorded {args.handler} in {seconds:.1f}s to {args.record}/exchanges.jsonl")
+    print(json.dumps(response, indent=2, default=str))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark a Lambda handler against local Bedrock and S3 stubs")
+    parser.add_argument('--handler', default='r-disposition-assessment.py', choices=['r-disposition-assessment.py', 'migration-plan.py'])
+    parser.add_argument('--apps', default='1,10,100', help="Comma-separated portfolio sizes")
+    parser.add_argument('--runs', type=int, default=3, help="Runs per portfolio size")
+    parser.add_argument('--fixtures', help="Directory with an exchanges.jsonl recorded with --record")
+    parser.add_argument('--latency-ms', default=DEFAULT_LATENCY_MS, help="operation=median:jitter pairs; * applies to the rest")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Probability that a Bedrock or knowledge base call is throttled")
+    parser.add_argument('--env', action='append', default=[], help="KEY=VALUE set before the handler is loaded")
+    parser.add_argument('--param', action='append', default=[], help="Request parameter NAME=VALUE, e.g. mode=sync")
+    parser.add_argument('--record', help="Record real exchanges to this directory instead of benchmarking")
+    parser.add_argument('--app-ids', default='', help="Applications to assess when recording")
+    args = parser.parse_args()
+
+    if args.record:
+        for item in args.env:
+            name, value = item.split('=', 1)
+            os.environ[name] = value
+        record(args)
+        sys.exit(0)
+
+    for name, value in BENCHMARK_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    for item in args.env:
+        name, value = item.split('=', 1)
+        os.environ[name] = value
+    # The stubs never reach AWS, but boto3 still needs credentials to create the clients
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    benchmark(args)
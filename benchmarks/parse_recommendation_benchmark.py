@@ -0,0 +1,67 @@
+import os
+import sys
+import glob
+import timeit
+import logging
+
+from lambda_handler_benchmark import load_handler_module
+
+# Micro-benchmark of parse_recommendation over the model responses in benchmarks/responses.
+# Add more corpus entries by saving raw responses from invoke_bedrock_model as .txt or .json files.
+#
+# Usage: python benchmarks/parse_recommendation_benchmark.py [iterations]
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def legacy_parse_recommendation(recommendation):
+    # The original parser, kept for comparison: exact header prefixes and repeated string concatenation
+    patterns = ''
+    justification = ''
+    aws_architecture = ''
+    approximate_cost = ''
+    in_patterns = in_justification = in_architecture = in_cost = False
+
+    for line in recommendation.split('\n'):
+        line = line.strip()
+        if line.startswith('1. Top 3 Recommended Migration Patterns:'):
+            in_patterns, in_justification, in_architecture, in_cost = True, False, False, False
+            patterns += line + '\n'
+        elif line.startswith('2. Justification:'):
+            in_patterns, in_justification, in_architecture, in_cost = False, True, False, False
+            justification += line + '\n'
+        elif line.startswith('3. Potential AWS Architecture:'):
+            in_patterns, in_justification, in_architecture, in_cost = False, False, True, False
+            aws_architecture += line + '\n'
+        elif line.startswith('4. Cost Breakdown and Total Cost for each Migration Pattern:'):
+            in_patterns, in_justification, in_architecture, in_cost = False, False, False, True
+            approximate_cost += line + '\n'
+        elif in_patterns and line:
+            patterns += line + '\n'
+        elif in_justification and line:
+            justification += line + '\n'
+        elif in_architecture and line:
+            aws_architecture += line + '\n'
+        elif in_cost and line:
+            approximate_cost += line + '\n'
+
+    return patterns.strip(), justification.strip(), aws_architecture.strip(), approximate_cost.strip()
+
+def run(iterations):
+    module = load_handler_module('r-disposition-assessment.py')
+    # Keep the fallback warnings and the per-call metrics out of the timings
+    module.logger.setLevel(logging.ERROR)
+    parse_recommendation = getattr(module.parse_recommendation, '__wrapped__', module.parse_recommendation)
+    corpus = sorted(glob.glob(os.path.join(BENCHMARK_DIR, 'responses', '*')))
+
+    print(f"{'response':<32}{'parser':<10}{'sections':>10}{'us/call':>12}")
+    for path in corpus:
+        with open(path) as f:
+            recommendation = f.read()
+        name = os.path.basename(path)
+        for parser_name, parser in (('legacy', legacy_parse_recommendation), ('current', parse_recommendation)):
+            sections = sum(1 for section in parser(recommendation) if section)
+            seconds = timeit.timeit(lambda: parser(recommendation), number=iterations)
+            print(f"{name:<32}{parser_name:<10}{sections:>8}/4{seconds / iterations * 1e6:>12.1f}")
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
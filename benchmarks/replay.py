@@ -0,0 +1,369 @@
+import io
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import defaultdict
+from botocore.exceptions import ClientError
+
+# Record/replay of the Bedrock, knowledge base and S3 exchanges of the Lambda handlers, so lambda_handler can be
+# benchmarked without AWS.
+#
+# Recording wraps the real boto3 clients of a loaded handler module and appends every recorded exchange to
+# <fixture dir>/exchanges.jsonl. Replay installs local stubs in place of the clients. A stub answers with the
+# recorded response for an identical request, or else with the next recorded response of the same operation, so
+# a few recorded applications can stand in for a portfolio of any size. Without fixtures, the stubs answer with the
+# sample recommendation in benchmarks/responses. Latency and throttling are injected per operation. Batch inference
+# jobs are simulated over the S3 stub and answer every record with an invoke_model response.
+
+RECORDED_OPERATIONS = {
+    'bedrock': ('invoke_model', 'invoke_model_with_response_stream'),
+    'bedrock_client': ('retrieve_and_generate', 'retrieve'),
+    's3': ('put_object',)
+}
+
+def request_key(operation, request):
+    # Bodies of S3 writes are not recorded, so they cannot be part of the key
+    request = {name: value for name, value in request.items() if not (operation == 'put_object' and name == 'Body')}
+    return hashlib.sha256(json.dumps([operation, request], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def body_bytes(body):
+    if hasattr(body, 'read'):
+        return body.read()
+    return body.encode('utf-8') if isinstance(body, str) else bytes(body)
+
+class StreamingBody(io.BytesIO):
+    # Stand-in for botocore's StreamingBody: read() and iter_lines() are all the handlers use
+    def iter_lines(self):
+        return iter(self.read().splitlines())
+
+class Recorder:
+    def __init__(self, fixture_dir):
+        self.path = f"{fixture_dir.rstrip('/')}/exchanges.jsonl"
+        self.lock = threading.Lock()
+
+    def write(self, exchange):
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(exchange, default=str) + '\n')
+
+class RecordingClient:
+    # Proxy of a real boto3 client that records the operations in RECORDED_OPERATIONS and passes everything else through
+    def __init__(self, client, operations, recorder):
+        self.client = client
+        self.operations = operations
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in self.operations:
+            return attribute
+
+        def record(**request):
+            start = time.perf_counter()
+            response = attribute(**request)
+            if name == 'invoke_model':
+                payload = response['body'].read()
+                response['body'] = StreamingBody(payload)
+                recorded_response = {'body': payload.decode('utf-8')}
+            elif name == 'invoke_model_with_response_stream':
+                events = [json.loads(event['chunk']['bytes']) for event in response['body']]
+                response['body'] = iter({'chunk': {'bytes': json.dumps(event).encode('utf-8')}} for event in events)
+                recorded_response = {'events': events}
+            else:
+                recorded_response = {key: value for key, value in response.items() if key != 'ResponseMetadata'}
+            recorded_request = dict(request)
+            if name == 'put_object':
+                recorded_request['Body'] = len(body_bytes(request['Body']))
+            self.recorder.write({
+                'operation': name,
+                'key': request_key(name, request),
+                'request': recorded_request,
+                'response': recorded_response,
+                'latency_ms': round((time.perf_counter() - start) * 1000, 3)
+            })
+            return response
+        return record
+
+def record_module(module, fixture_dir):
+    # Wrap the clients of a handler module loaded against real AWS
+    recorder = Recorder(fixture_dir)
+    for attribute, operations in RECORDED_OPERATIONS.items():
+        setattr(module, attribute, RecordingClient(getattr(module, attribute), operations, recorder))
+
+def load_fixtures(fixture_dir):
+    exchanges = []
+    with open(f"{fixture_dir.rstrip('/')}/exchanges.jsonl") as f:
+        for line in f:
+            if line.strip():
+                exchanges.append(json.loads(line))
+    return exchanges
+
+class Injector:
+    # Latency and throttling shared by all stubs. latency_ms maps an operation (or '*') to (median ms, jitter ms);
+    # throttle_rate is the probability that a Bedrock or knowledge base call is throttled.
+    def __init__(self, latency_ms=None, throttle_rate=0.0, seed=0):
+        self.latency_ms = latency_ms or {}
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.throttles = defaultdict(int)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def before(self, operation, request_bytes, throttleable=True):
+        with self.lock:
+            self.calls[operation] += 1
+            self.bytes_sent += request_bytes
+            median, jitter = self.latency_ms.get(operation, self.latency_ms.get('*', (0, 0)))
+            delay = max(0.0, median + self.random.uniform(-jitter, jitter)) / 1000
+            throttled = throttleable and self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles[operation] += 1
+        time.sleep(delay)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded (injected)'}}, operation)
+
+    def after(self, response_bytes):
+        with self.lock:
+            self.bytes_received += response_bytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'throttles': dict(self.throttles),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received
+            }
+
+class ReplayBook:
+    # Recorded responses by request key, with round-robin fallback per operation
+    def __init__(self, exchanges, default_responses):
+        self.exact = {exchange['key']: exchange['response'] for exchange in exchanges}
+        self.by_operation = defaultdict(list)
+        for exchange in exchanges:
+            self.by_operation[exchange['operation']].append(exchange['response'])
+        for operation, response in default_responses.items():
+            if not self.by_operation[operation]:
+                self.by_operation[operation].append(response)
+        self.positions = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def response(self, operation, request):
+        response = self.exact.get(request_key(operation, request))
+        if response is not None:
+            return response
+        with self.lock:
+            responses = self.by_operation[operation]
+            if not responses:
+                raise KeyError(f"No recorded response for {operation}")
+            position = self.positions[operation]
+            self.positions[operation] = position + 1
+        return responses[position % len(responses)]
+
+def default_responses(recommendation):
+    # Used for operations without fixtures
+    return {
+        'invoke_model': {'body': json.dumps({
+            'content': [{'type': 'text', 'text': recommendation}],
+            'usage': {'input_tokens': 3000, 'output_tokens': 800}
+        })},
+        'invoke_model_with_response_stream': {'events': [
+            {'type': 'message_start', 'message': {'usage': {'input_tokens': 3000}}},
+            {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': recommendation}},
+            {'type': 'message_delta', 'usage': {'output_tokens': 800}}
+        ]},
+        'retrieve_and_generate': {'output': {'text': "Application summary from the knowledge base. " * 40}},
+        'retrieve': {'retrievalResults': [
+            {'content': {'text': f"Knowledge base passage {rank}. " * 20}, 'score': 0.9 - rank / 20,
+             'location': {'type': 'S3', 's3Location': {'uri': f"s3://knowledge-base/document-{rank}.csv"}}, 'metadata': {}}
+            for rank in range(8)
+        ]}
+    }
+
+class StubBedrockRuntime:
+    def __init__(self, book, injector):
+        self.book = book
+        self.injector = injector
+
+    def invoke_model(self, **request):
+        self.injector.before('invoke_model', len(request['body']))
+        response = self.book.response('invoke_model', request)
+        payload = response['body'].encode('utf-8')
+        self.injector.after(len(payload))
+        return {'body': StreamingBody(payload), 'ResponseMetadata': {'RetryAttempts': 0}}
+
+    def invoke_model_with_response_stream(self, **request):
+        self.injector.before('invoke_model_with_response_stream', len(request['body']))
+        events = [json.dumps(event).encode('utf-8') for event in self.book.response('invoke_model_with_response_stream', request)['events']]
+        self.injector.after(sum(len(event) for event in events))
+        return {'body': iter({'chunk': {'bytes': event}} for event in events), 'ResponseMetadata': {'RetryAttempts': 0}}
+
+class StubAgentRuntime:
+    def __init__(self, book, injector):
+        self.book = book
+        self.injector = injector
+
+    def call(self, operation, request):
+        self.injector.before(operation, len(json.dumps(request)))
+        response = dict(self.book.response(operation, request), ResponseMetadata={'RetryAttempts': 0})
+        self.injector.after(len(json.dumps(response)))
+        return response
+
+    def retrieve_and_generate(self, **request):
+        return self.call('retrieve_and_generate', request)
+
+    def retrieve(self, **request):
+        return self.call('retrieve', request)
+
+class StubS3:
+    # In-memory bucket store; S3 calls get the injected latency but are never throttled
+    def __init__(self, injector):
+        self.injector = injector
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def missing(self, operation):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, operation)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        data = body_bytes(Body)
+        self.injector.before('put_object', len(data), throttleable=False)
+        with self.lock:
+            self.objects[(Bucket, Key)] = data
+        return {'ETag': hashlib.md5(data).hexdigest()}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.injector.before('get_object', 0, throttleable=False)
+        with self.lock:
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise self.missing('GetObject')
+        self.injector.after(len(data))
+        return {'Body': StreamingBody(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.injector.before('head_object', 0, throttleable=False)
+        with self.lock:
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ETag': hashlib.md5(data).hexdigest(), 'ContentLength': len(data)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        response = self.get_object(Bucket=Bucket, Key=Key)
+        with open(Filename, 'wb') as f:
+            f.write(response['Body'].read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.injector.before('delete_object', 0, throttleable=False)
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self.injector.before('list_objects_v2', 0, throttleable=False)
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys], 'KeyCount': len(keys)}
+
+    def get_paginator(self, operation):
+        stub = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(stub, operation)(**kwargs)
+        return Paginator()
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.injector.before('create_multipart_upload', 0, throttleable=False)
+        with self.lock:
+            upload_id = f"upload-{len(self.uploads)}"
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = body_bytes(Body)
+        self.injector.before('upload_part', len(data), throttleable=False)
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = data
+        return {'ETag': f"part-{PartNumber}"}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.injector.before('abort_multipart_upload', 0, throttleable=False)
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.injector.before('complete_multipart_upload', 0, throttleable=False)
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {}
+
+class StubBedrockBatch:
+    # Batch inference jobs over the S3 stub. A job reads its input records when it is created and completes after
+    # polls_until_complete calls of get_model_invocation_job, or when complete() is called (as EventBridge would
+    # announce it). Completion writes <output uri><job id>/records.jsonl.out with one invoke_model response per record.
+    BATCH_OPERATIONS = ('create_model_invocation_job', 'get_model_invocation_job')
+
+    def __init__(self, book, injector, s3, polls_until_complete=1):
+        self.book = book
+        self.injector = injector
+        self.s3 = s3
+        self.polls_until_complete = polls_until_complete
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def split_uri(self, uri):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        return bucket, key
+
+    def create_model_invocation_job(self, jobName, roleArn, modelId, inputDataConfig, outputDataConfig, **kwargs):
+        self.injector.before('create_model_invocation_job', 0)
+        bucket, key = self.split_uri(inputDataConfig['s3InputDataConfig']['s3Uri'])
+        records = [json.loads(line) for line in self.s3.get_object(Bucket=bucket, Key=key)['Body'].read().splitlines() if line.strip()]
+        with self.lock:
+            job_id = f"job{len(self.jobs):08d}"
+            job_arn = f"arn:aws:bedrock:us-east-1:000000000000:model-invocation-job/{job_id}"
+            self.jobs[job_arn] = {'job_id': job_id, 'records': records, 'polls': 0, 'status': 'InProgress', 'modelId': modelId,
+                                  'output_uri': outputDataConfig['s3OutputDataConfig']['s3Uri']}
+        return {'jobArn': job_arn}
+
+    def complete(self, job_arn):
+        with self.lock:
+            job = self.jobs[job_arn]
+            if job['status'] == 'Completed':
+                return
+            job['status'] = 'Completed'
+        lines = []
+        for record in job['records']:
+            request = {'modelId': job['modelId'], 'body': json.dumps(record['modelInput'])}
+            lines.append(json.dumps({'recordId': record['recordId'], 'modelInput': record['modelInput'],
+                                     'modelOutput': json.loads(self.book.response('invoke_model', request)['body'])}))
+        bucket, prefix = self.split_uri(job['output_uri'])
+        self.s3.put_object(Bucket=bucket, Key=f"{prefix.rstrip('/')}/{job['job_id']}/records.jsonl.out", Body='\n'.join(lines))
+
+    def get_model_invocation_job(self, jobIdentifier, **kwargs):
+        self.injector.before('get_model_invocation_job', 0)
+        with self.lock:
+            job = self.jobs[jobIdentifier]
+            job['polls'] += 1
+            ready = job['polls'] >= self.polls_until_complete
+        if ready:
+            self.complete(jobIdentifier)
+        return {'jobArn': jobIdentifier, 'status': job['status']}
+
+def install_stubs(module, book, injector):
+    # Replace the clients of a loaded handler module with stubs; returns the S3 stub for inspection
+    s3 = StubS3(injector)
+    module.bedrock = StubBedrockRuntime(book, injector)
+    module.bedrock_client = StubAgentRuntime(book, injector)
+    module.s3 = s3
+    if hasattr(module, 'bedrock_batch'):
+        module.bedrock_batch = StubBedrockBatch(book, injector, s3)
+    return s3
@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import csv
+import json
+import sqlite3
+import logging
+import argparse
+import boto3
+
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.client('s3')
+
+# Builds the SQLite inventory index that the assessment and migration plan functions read with INVENTORY_INDEX_KEY.
+# Sources are the Application Discovery export (one sheet per table: Servers, Applications, Databases, Server to
+# application, ...) and the migration Q&A spreadsheet, as XLSX workbooks or one CSV file per sheet.
+INVENTORY_SOURCE_KEYS = os.environ.get('INVENTORY_SOURCE_KEYS', '')
+QANDA_SOURCE_KEYS = os.environ.get('QANDA_SOURCE_KEYS', '')
+INVENTORY_INDEX_KEY = os.environ.get('INVENTORY_INDEX_KEY', 'inventory-index/inventory.db')
+WAVES_OUTPUT_KEY = os.environ.get('WAVES_OUTPUT_KEY', 'inventory-index/migration-waves.csv')
+WORK_DIR = '/tmp/inventory-index'
+
+# A server hosting more applications than this (e.g. a monitoring server) is shared infrastructure and does not
+# tie its applications into one move group
+SHARED_SERVER_APP_LIMIT = int(os.environ.get('SHARED_SERVER_APP_LIMIT', '10'))
+
+# IDs are matched case-insensitively but stored as they appear in the exports
+SCHEMA = """
+CREATE TABLE records (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, sheet TEXT NOT NULL, record TEXT NOT NULL);
+CREATE TABLE record_keys (key_type TEXT NOT NULL, key TEXT NOT NULL COLLATE NOCASE, record_id INTEGER NOT NULL);
+CREATE TABLE app_servers (app_id TEXT NOT NULL COLLATE NOCASE, server_id TEXT NOT NULL COLLATE NOCASE, PRIMARY KEY (app_id, server_id));
+CREATE TABLE app_dependencies (app_id TEXT NOT NULL COLLATE NOCASE, depends_on TEXT NOT NULL COLLATE NOCASE, PRIMARY KEY (app_id, depends_on));
+CREATE TABLE server_links (source TEXT NOT NULL COLLATE NOCASE, target TEXT NOT NULL COLLATE NOCASE, PRIMARY KEY (source, target));
+CREATE TABLE apps (app_id TEXT PRIMARY KEY COLLATE NOCASE, wave INTEGER NOT NULL, move_group INTEGER NOT NULL);
+CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE INDEX record_keys_by_key ON record_keys (key_type, key);
+CREATE INDEX app_servers_by_server ON app_servers (server_id);
+CREATE INDEX app_dependencies_by_target ON app_dependencies (depends_on);
+CREATE INDEX server_links_by_target ON server_links (target);
+CREATE INDEX apps_by_move_group ON apps (move_group);
+"""
+
+def normalize_column(column):
+    return re.sub(r'[^a-z0-9]', '', str(column).lower())
+
+def normalize_key(value):
+    return str(value).strip()
+
+def key_columns(headers):
+    # "Application ID", "appid", "app-id" and "Dependent Application ID" identify applications; "Serverid" and
+    # "Server ID" identify servers
+    app_columns = [h for h in headers if normalize_column(h).endswith(('appid', 'applicationid'))]
+    server_columns = [h for h in headers if normalize_column(h).endswith('serverid')]
+    return app_columns, server_columns
+
+def cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def rows_to_records(rows):
+    rows = iter(rows)
+    headers = [cell_text(h) for h in next(rows, [])]
+    for row in rows:
+        record = {h: cell_text(v) for h, v in zip(headers, row) if h}
+        if any(record.values()):
+            yield record
+
+def read_csv_sheets(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield os.path.splitext(os.path.basename(path))[0], list(rows_to_records(csv.reader(f)))
+
+def read_xlsx_sheets(path):
+    # openpyxl is only needed for XLSX sources; add it to the deployment package or a Lambda layer
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError(f"Reading {path} requires openpyxl; install it or export the sheets as CSV files")
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            yield worksheet.title, list(rows_to_records(worksheet.iter_rows(values_only=True)))
+    finally:
+        workbook.close()
+
+def read_sheets(path):
+    if path.lower().endswith(('.xlsx', '.xlsm')):
+        return read_xlsx_sheets(path)
+    return read_csv_sheets(path)
+
+def strongly_connected_components(adjacency):
+    # Iterative Tarjan, so deep dependency chains cannot hit the recursion limit. Components are returned in
+    # reverse topological order: every component comes after all the components it depends on.
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for root in adjacency:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(adjacency[root]))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(adjacency[successor])))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+def build_dependency_graph(connection):
+    # Nodes are ('app', id) and ('server', id). An application and each server it runs on point at each other,
+    # so they always land in the same move group, unless the server is shared infrastructure.
+    names = {}
+    adjacency = {}
+
+    def node(key_type, key):
+        node_id = (key_type, key.lower())
+        names.setdefault(node_id, key)
+        adjacency.setdefault(node_id, set())
+        return node_id
+
+    for (app_id,) in connection.execute("SELECT DISTINCT key FROM record_keys WHERE key_type = 'app' ORDER BY key"):
+        node('app', app_id)
+    for app_id, depends_on in connection.execute("SELECT app_id, depends_on FROM app_dependencies"):
+        adjacency[node('app', app_id)].add(node('app', depends_on))
+    shared_servers = {server_id.lower() for server_id, count in connection.execute(
+        "SELECT server_id, COUNT(*) FROM app_servers GROUP BY server_id") if count > SHARED_SERVER_APP_LIMIT}
+    for app_id, server_id in connection.execute("SELECT app_id, server_id FROM app_servers"):
+        if server_id.lower() not in shared_servers:
+            app, server = node('app', app_id), node('server', server_id)
+            adjacency[app].add(server)
+            adjacency[server].add(app)
+    for source, target in connection.execute("SELECT source, target FROM server_links"):
+        adjacency[node('server', source)].add(node('server', target))
+
+    # Sorted successors keep the move group numbering stable for the same inputs
+    return {node_id: sorted(successors) for node_id, successors in adjacency.items()}, names
+
+def plan_migration_waves(connection):
+    # Returns (app_id, wave, move_group) for every application. A move group is a strongly connected component:
+    # applications in a dependency cycle or on the same server have to move together. Each group is scheduled one
+    # wave after the latest group it depends on, so dependencies always migrate first.
+    adjacency, names = build_dependency_graph(connection)
+    components = strongly_connected_components(adjacency)
+    component_of = {node_id: i for i, component in enumerate(components) for node_id in component}
+
+    waves = []
+    has_apps = []
+    for i, component in enumerate(components):
+        wave = 0
+        for node_id in component:
+            for successor in adjacency[node_id]:
+                j = component_of[successor]
+                if j != i:
+                    # Server-only groups (e.g. a database server no application runs on) order waves but are not one
+                    wave = max(wave, waves[j] + has_apps[j])
+        waves.append(wave)
+        has_apps.append(any(key_type == 'app' for key_type, key in component))
+
+    # Number the move groups in wave order so the numbering reads like a schedule
+    groups = sorted(
+        (waves[i] + 1, sorted(names[node_id] for node_id in component if node_id[0] == 'app'))
+        for i, component in enumerate(components) if has_apps[i]
+    )
+    return [(app_id, wave, move_group) for move_group, (wave, apps) in enumerate(groups, 1) for app_id in apps]
+
+def write_waves_csv(connection, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['App-id', 'Wave', 'Move group', 'Depends on'])
+        writer.writerows(connection.execute(
+            "SELECT a.app_id, a.wave, a.move_group, COALESCE(group_concat(d.depends_on, ', '), '') FROM apps a"
+            " LEFT JOIN app_dependencies d ON d.app_id = a.app_id GROUP BY a.app_id ORDER BY a.wave, a.move_group, a.app_id"
+        ))
+
+def build_index(sources, output_path):
+    # sources is a list of (kind, path) with kind "inventory" or "qanda"; returns the number of indexed records
+    # per sheet. Rows without an application or server ID column (e.g. a table of contents) are skipped.
+    temporary_path = output_path + '.building'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    connection.executescript(SCHEMA)
+
+    counts = {}
+    for kind, path in sources:
+        for sheet, records in read_sheets(path):
+            if not records:
+                continue
+            app_columns, server_columns = key_columns(records[0].keys())
+            if not app_columns and not server_columns:
+                logger.info("Skipping sheet %s in %s: no application or server ID column", sheet, path)
+                continue
+
+            for record in records:
+                app_ids = list(dict.fromkeys(normalize_key(record[c]) for c in app_columns if record.get(c)))
+                server_ids = list(dict.fromkeys(normalize_key(record[c]) for c in server_columns if record.get(c)))
+                if not app_ids and not server_ids:
+                    continue
+                record_id = connection.execute(
+                    "INSERT INTO records (kind, sheet, record) VALUES (?, ?, ?)", (kind, sheet, json.dumps(record))
+                ).lastrowid
+                # Rows that name an application belong to it; rows that only name servers (server specs, databases,
+                # server communication) are reached through the servers the application runs on
+                if app_ids:
+                    keys = [('app', app_id) for app_id in app_ids]
+                    connection.executemany("INSERT OR IGNORE INTO app_servers VALUES (?, ?)",
+                                           [(app_id, server_id) for app_id in app_ids for server_id in server_ids])
+                else:
+                    keys = [('server', server_id) for server_id in server_ids]
+                # A row naming several applications (Application dependency) or several servers (Server
+                # communication) is an edge from the first ID column to the others
+                if kind == 'inventory' and len(app_ids) > 1:
+                    connection.executemany("INSERT OR IGNORE INTO app_dependencies VALUES (?, ?)",
+                                           [(app_ids[0], app_id) for app_id in app_ids[1:]])
+                elif kind == 'inventory' and not app_ids and len(server_ids) > 1:
+                    connection.executemany("INSERT OR IGNORE INTO server_links VALUES (?, ?)",
+                                           [(server_ids[0], server_id) for server_id in server_ids[1:]])
+                connection.executemany("INSERT INTO record_keys VALUES (?, ?, ?)", [(t, k, record_id) for t, k in keys])
+                counts[f"{kind}/{sheet}"] = counts.get(f"{kind}/{sheet}", 0) + 1
+
+    waves = plan_migration_waves(connection)
+    connection.executemany("INSERT INTO apps VALUES (?, ?, ?)", waves)
+    connection.execute("INSERT INTO settings VALUES ('shared_server_app_limit', ?)", (str(SHARED_SERVER_APP_LIMIT),))
+    counts['waves'] = max((wave for app_id, wave, move_group in waves), default=0)
+    counts['move_groups'] = len({move_group for app_id, wave, move_group in waves})
+
+    connection.commit()
+    write_waves_csv(connection, os.path.splitext(output_path)[0] + '-waves.csv')
+    connection.execute("VACUUM")
+    connection.close()
+    os.replace(temporary_path, output_path)
+    logger.info("Built inventory index %s: %s", output_path, counts)
+    return counts
+
+def download_sources(bucket, keys, kind):
+    sources = []
+    for key in [k.strip() for k in keys.split(',') if k.strip()]:
+        path = os.path.join(WORK_DIR, kind, os.path.basename(key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3.download_file(bucket, key, path)
+        sources.append((kind, path))
+    return sources
+
+def lambda_handler(event, context):
+    # Run after new exports are uploaded, e.g. from an S3 event notification or on a schedule. The event may
+    # override the comma-separated inventory_keys, qanda_keys, index_key and waves_key.
+    try:
+        bucket = os.environ['S3_BUCKET']
+        inventory_keys = event.get('inventory_keys', INVENTORY_SOURCE_KEYS)
+        qanda_keys = event.get('qanda_keys', QANDA_SOURCE_KEYS)
+        index_key = event.get('index_key', INVENTORY_INDEX_KEY)
+
+        sources = download_sources(bucket, inventory_keys, 'inventory') + download_sources(bucket, qanda_keys, 'qanda')
+        os.makedirs(WORK_DIR, exist_ok=True)
+        output_path = os.path.join(WORK_DIR, 'inventory.db')
+        counts = build_index(sources, output_path)
+        s3.upload_file(output_path, bucket, index_key)
+        s3.upload_file(os.path.join(WORK_DIR, 'inventory-waves.csv'), bucket, event.get('waves_key', WAVES_OUTPUT_KEY))
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'index': f"s3://{bucket}/{index_key}", 'waves': f"s3://{bucket}/{event.get('waves_key', WAVES_OUTPUT_KEY)}", 'records': counts})
+        }
+
+    except Exception as e:
+        logger.error(f"An error occurred: {e}", exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                "error": "An error occurred while building the inventory index.",
+                "details": str(e)
+            })
+        }
+
+if __name__ == '__main__':
+    # Local build: python build-inventory-index.py --inventory discovery.xlsx --qanda questions.xlsx --output inventory.db
+    # The migration waves are written next to the index as inventory-waves.csv
+    parser = argparse.ArgumentParser(description="Build the SQLite inventory index from local CSV/XLSX exports")
+    parser.add_argument('--inventory', nargs='*', default=[], help="Application Discovery exports")
+    parser.add_argument('--qanda', nargs='*', default=[], help="Migration Q&A spreadsheets")
+    parser.add_argument('--output', default='inventory.db')
+    args = parser.parse_args()
+    logging.basicConfig()
+    counts = build_index([('inventory', p) for p in args.inventory] + [('qanda', p) for p in args.qanda], args.output)
+    json.dump(counts, sys.stdout, indent=2)
@@ -1,99 +1,965 @@
+import time
+
+# Start of the Lambda init phase; the init timing report measures every component from here
+INIT_STARTED = time.perf_counter()
+
 import os
 import json
+import inspect
+import functools
+import hashlib
+import sqlite3
+import threading
+import random
 import logging
-import boto3
-import csv
-from io import StringIO
-from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize a Boto3 client for Bedrock
-bedrock = boto3.client(service_name='bedrock-runtime')
-bedrock_client = boto3.client(service_name='bedrock-agent-runtime')
-s3 = boto3.client('s3')
+# Milliseconds spent on each component of the init phase, logged once by the first invocation of this container.
+# Clients are created on first use and added as client:<service> when that happens.
+init_timings = OrderedDict()
+init_phase_started = INIT_STARTED
+init_reported = False
+
+def record_init_phase(component):
+    global init_phase_started
+    now = time.perf_counter()
+    init_timings[component] = round((now - init_phase_started) * 1000, 3)
+    init_phase_started = now
+
+record_init_phase('imports')
+
+# Boto3 clients. Importing boto3 and botocore.config and creating a client are the slowest parts of a cold start,
+# so each client is only created when a request first uses it. Throttling of Bedrock calls is retried by
+# call_with_backoff rather than botocore, so the rate limiters can react to it. Set AWS_ENDPOINT_URL_BEDROCK_RUNTIME,
+# AWS_ENDPOINT_URL_BEDROCK_AGENT_RUNTIME or AWS_ENDPOINT_URL_S3 to run against local fake endpoints.
+BEDROCK_READ_TIMEOUT = int(os.environ.get('BEDROCK_READ_TIMEOUT', '300'))
+
+# Number of migration plans generated at the same time when a request asks for several apps or strategies, and
+# number of sections of each sectioned plan generated at the same time
+PLAN_MAX_WORKERS = int(os.environ.get('PLAN_MAX_WORKERS', '4'))
+PLAN_SECTION_WORKERS = int(os.environ.get('PLAN_SECTION_WORKERS', '10'))
+
+# One connection for every model call that can run at the same time, so sectioned plans never wait for the pool
+CLIENT_MAX_POOL_CONNECTIONS = max(10, max(1, PLAN_MAX_WORKERS) * max(1, PLAN_SECTION_WORKERS))
+client_init_lock = threading.Lock()
+
+class LazyClient:
+    # Stands in for a boto3 client and creates it on first attribute access. One lock for all clients, since
+    # creating clients on boto3's default session is not thread-safe.
+    def __init__(self, service_name, **config):
+        self.service_name = service_name
+        self.config = config
+        self.client = None
+
+    def get(self):
+        if self.client is None:
+            with client_init_lock:
+                if self.client is None:
+                    start = time.perf_counter()
+                    import boto3
+                    from botocore.config import Config
+                    client = boto3.client(service_name=self.service_name, config=Config(**self.config))
+                    init_timings[f"client:{self.service_name}"] = round((time.perf_counter() - start) * 1000, 3)
+                    self.client = client
+            logger.info("Created %s client in %.1f ms", self.service_name, init_timings[f"client:{self.service_name}"])
+            emit_metrics(f"init_client:{self.service_name}", {'Duration': init_timings[f"client:{self.service_name}"]})
+        return self.client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+bedrock_config = {'max_pool_connections': CLIENT_MAX_POOL_CONNECTIONS, 'read_timeout': BEDROCK_READ_TIMEOUT,
+                  'retries': {'mode': 'standard', 'total_max_attempts': 1}}
+bedrock = LazyClient('bedrock-runtime', **bedrock_config)
+bedrock_client = LazyClient('bedrock-agent-runtime', **bedrock_config)
+s3 = LazyClient('s3', max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS, retries={'mode': 'standard'})
+
+# Seconds to wait for each knowledge base retrieval before continuing without its context
+KB_RETRIEVAL_TIMEOUT = float(os.environ.get('KB_RETRIEVAL_TIMEOUT', '60'))
+
+# Per-stage metrics are printed as CloudWatch Embedded Metric Format (EMF) lines. Full prompts, KB answers, model
+# responses and the events and responses of the handler are only logged when LOG_PAYLOADS is true, since they
+# dominate CloudWatch ingestion.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MigrationPortfolioAssessment')
+LOG_PAYLOADS = os.environ.get('LOG_PAYLOADS', 'false').lower() == 'true'
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'migration-plan')
+METRIC_UNITS = {
+    'Duration': 'Milliseconds',
+    'RequestBytes': 'Bytes',
+    'ResponseBytes': 'Bytes'
+}
+metrics_context = threading.local()
+
+def emit_metrics(stage, values, app_id=None):
+    # app_id is a property rather than a dimension to keep metric cardinality low; it can still be queried in Logs Insights
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Stage']],
+                'Metrics': [{'Name': name, 'Unit': METRIC_UNITS.get(name, 'Count')} for name in values]
+            }]
+        },
+        'Function': FUNCTION_NAME,
+        'Stage': stage,
+        **values
+    }
+    if app_id:
+        record['AppId'] = app_id
+    print(json.dumps(record))
+
+def add_metric(name, value):
+    # Adds to the metrics of the innermost instrumented stage running on this thread
+    stack = getattr(metrics_context, 'stack', None)
+    if stack:
+        stack[-1][name] = stack[-1].get(name, 0) + value
+
+def set_metrics_app_id(app_id):
+    metrics_context.app_id = app_id
+
+def log_init_report():
+    # Only the first invocation of a container paid for the init phase, so only it reports it
+    global init_reported
+    if init_reported:
+        return
+    init_reported = True
+    components = {component: ms for component, ms in init_timings.items() if not component.startswith('client:')}
+    logger.info("Init timing report: %s, total %.1f ms", ", ".join(f"{component} {ms:.1f} ms" for component, ms in components.items()),
+                sum(components.values()))
+    for component, ms in components.items():
+        emit_metrics(f"init_{component}", {'Duration': ms})
+
+def instrument(function):
+    # Records wall time, errors and the size of a string result for every call, plus anything the function
+    # adds with add_metric, and emits them tagged with the stage name and the application ID
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        app_id = arguments.get('app_id', getattr(metrics_context, 'app_id', None))
+        if not hasattr(metrics_context, 'stack'):
+            metrics_context.stack = []
+        values = {}
+        metrics_context.stack.append(values)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            if isinstance(result, str):
+                values['ResponseBytes'] = len(result.encode('utf-8'))
+            return result
+        except Exception:
+            values['Errors'] = 1
+            raise
+        finally:
+            metrics_context.stack.pop()
+            values['Duration'] = round((time.perf_counter() - start) * 1000, 3)
+            emit_metrics(function.__name__, values, app_id)
+    return wrapper
+
+def record_response_metadata(response):
+    add_metric('Retries', response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+# Every Bedrock and knowledge base request goes through a token bucket per model and per knowledge base. A
+# throttled request halves that bucket's rate and is retried with exponential backoff and full jitter; successful
+# requests restore the rate gradually. A rate of 0 disables limiting.
+MODEL_REQUESTS_PER_SECOND = float(os.environ.get('MODEL_REQUESTS_PER_SECOND', '2'))
+KB_REQUESTS_PER_SECOND = float(os.environ.get('KB_REQUESTS_PER_SECOND', '5'))
+THROTTLE_MAX_RETRIES = int(os.environ.get('THROTTLE_MAX_RETRIES', '6'))
+THROTTLE_BASE_DELAY = float(os.environ.get('THROTTLE_BASE_DELAY_SECONDS', '1'))
+THROTTLE_MAX_DELAY = float(os.environ.get('THROTTLE_MAX_DELAY_SECONDS', '30'))
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException'}
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.max_rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 32, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name, rate):
+    with rate_limiters_lock:
+        if name not in rate_limiters:
+            rate_limiters[name] = RateLimiter(rate)
+        return rate_limiters[name]
+
+def call_with_backoff(limiter, operation, **kwargs):
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = operation(**kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in RETRYABLE_ERROR_CODES or attempt == THROTTLE_MAX_RETRIES:
+                raise
+            if code in THROTTLING_ERROR_CODES:
+                limiter.throttled()
+                add_metric('Throttles', 1)
+            error = code
+        except (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError) as e:
+            if attempt == THROTTLE_MAX_RETRIES:
+                raise
+            error = type(e).__name__
+        else:
+            limiter.succeeded()
+            return response
+        delay = random.uniform(0, min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2 ** attempt))
+        add_metric('Retries', 1)
+        logger.warning("%s from %s, retrying in %.1fs (attempt %d of %d)", error, operation.__name__, delay, attempt + 1, THROTTLE_MAX_RETRIES)
+        time.sleep(delay)
+
+def call_model(operation, model_id, **kwargs):
+    return call_with_backoff(get_rate_limiter(f"model:{model_id}", MODEL_REQUESTS_PER_SECOND), operation, modelId=model_id, **kwargs)
+
+def call_knowledge_base(operation, kb_id, **kwargs):
+    return call_with_backoff(get_rate_limiter(f"kb:{kb_id}", KB_REQUESTS_PER_SECOND), operation, **kwargs)
+
+# Returned by the retrieval helpers when a lookup failed after retries, so the prompt says the context is missing
+# instead of silently leaving it empty, and callers can flag the result as built on degraded context
+UNAVAILABLE_CONTEXT = "[Unavailable: the knowledge base lookup failed, so this context is missing]"
+
+def degraded_sections(sections):
+    return [name for name, text in sections if text == UNAVAILABLE_CONTEXT]
+
+# Knowledge base responses are cached in-process (survives warm starts) and optionally in S3 (shared across containers)
+KB_CACHE_TTL = int(os.environ.get('KB_CACHE_TTL_SECONDS', '3600'))
+KB_CACHE_MAX_ENTRIES = int(os.environ.get('KB_CACHE_MAX_ENTRIES', '16'))
+KB_CACHE_S3_PREFIX = os.environ.get('KB_CACHE_S3_PREFIX', '')
+
+class MemoryCache:
+    # Least-recently-used cache whose entries expire after ttl seconds (0 disables expiry)
+    def __init__(self, max_entries, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl and time.time() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class S3Cache:
+    # Cache shared by all containers; expired objects are ignored here and can be removed with an S3 lifecycle rule
+    def __init__(self, bucket, prefix, ttl=0):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}.json")
+            entry = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                logger.warning("Error reading cache entry from S3: %s", e)
+            return None
+        if self.ttl and time.time() - entry['created'] > self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        try:
+            s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}.json", Body=json.dumps({'created': time.time(), 'value': value}))
+        except ClientError as e:
+            logger.warning("Error writing cache entry to S3: %s", e)
+
+class DiskCache:
+    # Cache on local disk, e.g. /tmp, which persists for the lifetime of a Lambda container
+    def __init__(self, directory, ttl=0):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.ttl and time.time() - entry['created'] > self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            # Write to a temporary file first so concurrent readers never see a partial entry
+            with open(f"{path}.{threading.get_ident()}.tmp", 'w') as f:
+                json.dump({'created': time.time(), 'value': value}, f)
+            os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+        except OSError as e:
+            logger.warning("Error writing cache entry to disk: %s", e)
+
+class TieredCache:
+    # Looks tiers up in order and copies a hit into the faster tiers in front of it
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster_tier in self.tiers[:i]:
+                    faster_tier.put(key, value)
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        for tier in self.tiers:
+            tier.put(key, value)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def build_kb_cache():
+    tiers = [MemoryCache(KB_CACHE_MAX_ENTRIES, KB_CACHE_TTL)]
+    if KB_CACHE_S3_PREFIX:
+        tiers.append(S3Cache(os.environ.get('KB_CACHE_S3_BUCKET', os.environ.get('S3_BUCKET')), KB_CACHE_S3_PREFIX, KB_CACHE_TTL))
+    return TieredCache(tiers)
+
+record_init_phase('configuration')
+kb_cache = build_kb_cache()
 
-def invoke_bedrock_model(prompt):
+# Optional content-addressed cache of model responses: memory, disk, s3 or none
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'none').lower()
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '0'))
+RESPONSE_CACHE_BYPASS = os.environ.get('RESPONSE_CACHE_BYPASS', 'false').lower() == 'true'
+
+def build_response_cache():
+    if RESPONSE_CACHE_BACKEND == 'memory':
+        backend = MemoryCache(int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '256')), RESPONSE_CACHE_TTL)
+    elif RESPONSE_CACHE_BACKEND == 'disk':
+        backend = DiskCache(os.environ.get('RESPONSE_CACHE_DIR', '/tmp/bedrock-response-cache'), RESPONSE_CACHE_TTL)
+    elif RESPONSE_CACHE_BACKEND == 's3':
+        backend = S3Cache(os.environ.get('RESPONSE_CACHE_S3_BUCKET', os.environ.get('S3_BUCKET')),
+                          os.environ.get('RESPONSE_CACHE_S3_PREFIX', 'bedrock-response-cache'), RESPONSE_CACHE_TTL)
+    else:
+        return None
+    return TieredCache([backend])
+
+response_cache = build_response_cache()
+record_init_phase('caches')
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+MAX_TOKENS = 100000
+
+# Model routing: every model call names a route and MODEL_ROUTES maps each route to a model ID. By default the
+# routes use the models this function always used. With MODEL_ROUTING, knowledge base summaries and the outline of
+# sectioned plans go to SMALL_MODEL_ID, and the plan itself stays on MODEL_ID. Single routes can be overridden with a
+# JSON object in MODEL_ROUTES.
+MODEL_ROUTING = os.environ.get('MODEL_ROUTING', 'false').lower() == 'true'
+SMALL_MODEL_ID = os.environ.get('SMALL_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+BASELINE_MODEL_ROUTES = {
+    'kb_application': MODEL_ID,
+    'kb_qanda': 'anthropic.claude-v2',
+    'kb_best_practices': MODEL_ID,
+    'plan': MODEL_ID,
+    'plan_outline': MODEL_ID,
+    'plan_section': MODEL_ID
+}
+SMALL_MODEL_ROUTES = ('kb_application', 'kb_qanda', 'kb_best_practices', 'plan_outline')
+
+def load_model_routes():
+    routes = dict(BASELINE_MODEL_ROUTES)
+    if MODEL_ROUTING:
+        routes.update({route: SMALL_MODEL_ID for route in SMALL_MODEL_ROUTES})
+    routes.update(json.loads(os.environ.get('MODEL_ROUTES', '{}')))
+    return routes
+
+MODEL_ROUTES = load_model_routes()
+
+def model_arn(model_id):
+    return f"arn:aws:bedrock:{os.environ.get('AWS_REGION', 'us-east-1')}::foundation-model/{model_id}"
+
+# USD per 1,000 input and output tokens and output tokens per second, used to estimate the cost and latency of
+# each route in the routing report. These are rough on-demand figures; set MODEL_PROFILES to a JSON object with
+# your own prices and measured speeds.
+DEFAULT_MODEL_PROFILES = {
+    'anthropic.claude-3-sonnet-20240229-v1:0': {'input': 0.003, 'output': 0.015, 'output_tokens_per_second': 60},
+    'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125, 'output_tokens_per_second': 150},
+    'anthropic.claude-v2': {'input': 0.008, 'output': 0.024, 'output_tokens_per_second': 40}
+}
+MODEL_PROFILES = dict(DEFAULT_MODEL_PROFILES, **json.loads(os.environ.get('MODEL_PROFILES', '{}')))
+
+# Mark the shared prompt prefix as a cache point; requires a model that supports Bedrock prompt caching
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'false').lower() == 'true'
+
+# Streaming mode writes the plan to S3 with a multipart upload while it is being generated
+STREAM_OUTPUT = os.environ.get('STREAM_OUTPUT', 'false').lower() == 'true'
+STREAM_PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get('STREAM_PART_SIZE', str(5 * 1024 * 1024))))
+STREAM_PROGRESS_SECONDS = float(os.environ.get('STREAM_PROGRESS_SECONDS', '15'))
+STREAM_TIMEOUT_MARGIN_MS = int(os.environ.get('STREAM_TIMEOUT_MARGIN_MS', '30000'))
+STREAM_RESUME_TAIL_CHARS = 4000
+
+# Token budget for each knowledge base section pasted into a prompt (0 disables the limit)
+CHARS_PER_TOKEN = 4
+PROMPT_SECTION_BUDGETS = {
+    'best_practices': int(os.environ.get('PROMPT_BUDGET_BEST_PRACTICES', '8000')),
+    'application': int(os.environ.get('PROMPT_BUDGET_APPLICATION', '8000')),
+    'qanda': int(os.environ.get('PROMPT_BUDGET_QANDA', '8000'))
+}
+# Lines shorter than this, such as list headings, are never treated as duplicates
+MIN_DEDUPLICATED_LINE_LENGTH = 40
+
+def estimate_tokens(text):
+    # Rough estimate for English text; good enough to enforce budgets without a tokenizer
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def compact_context(sections):
+    # sections is a list of (name, text) in priority order. Passages repeated from an earlier section are
+    # dropped, then each section is truncated at a line boundary to fit its budget.
+    # Returns the compacted texts by name and the estimated tokens before and after.
+    seen = set()
+    compacted = {}
+    tokens_before = 0
+    tokens_after = 0
+
+    for name, text in sections:
+        tokens_before += estimate_tokens(text)
+        budget = PROMPT_SECTION_BUDGETS.get(name, 0) * CHARS_PER_TOKEN
+        kept = []
+        size = 0
+        truncated = False
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            normalized = ' '.join(line.lower().split())
+            if len(normalized) >= MIN_DEDUPLICATED_LINE_LENGTH:
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+            if budget and size + len(line) > budget:
+                if not kept:
+                    kept.append(line[:budget])
+                truncated = True
+                break
+            kept.append(line)
+            size += len(line) + 1
+        if truncated:
+            kept.append("[Truncated to fit the prompt budget]")
+        compacted[name] = '\n'.join(kept)
+        tokens_after += estimate_tokens(compacted[name])
+
+    return compacted, {'tokens_before': tokens_before, 'tokens_after': tokens_after, 'tokens_saved': tokens_before - tokens_after}
+
+USAGE_METRICS = {
+    'input_tokens': 'InputTokens',
+    'output_tokens': 'OutputTokens',
+    'cache_read_input_tokens': 'CacheReadInputTokens',
+    'cache_creation_input_tokens': 'CacheWriteInputTokens'
+}
+
+def record_usage(usage):
+    # Cache read and write counts are only present when prompt caching is in use
+    for name, metric_name in USAGE_METRICS.items():
+        add_metric(metric_name, usage.get(name, 0) or 0)
+
+# Per-request totals for the routing report. Every request starts its own RunTotals on its thread, and the worker
+# threads it starts use the same one through bind_run_totals, so requests handled in one container at the same
+# time keep separate totals.
+class RunTotals:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Calls, tokens and seconds per (route, model)
+        self.routing = {}
+
+run_totals_context = threading.local()
+# Totals of calls made outside a request, e.g. from scripts
+default_run_totals = RunTotals()
+
+def current_run_totals():
+    return getattr(run_totals_context, 'totals', None) or default_run_totals
+
+def start_run_totals():
+    run_totals_context.totals = RunTotals()
+    return run_totals_context.totals
+
+def bind_run_totals(function):
+    # Runs function, on whichever thread, against the totals of the thread that wrapped it
+    totals = current_run_totals()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = getattr(run_totals_context, 'totals', None)
+        run_totals_context.totals = totals
+        try:
+            return function(*args, **kwargs)
+        finally:
+            run_totals_context.totals = previous
+    return wrapper
+
+def record_model_call(route, model_id, input_tokens, output_tokens, seconds):
+    run_totals = current_run_totals()
+    with run_totals.lock:
+        totals = run_totals.routing.setdefault((route, model_id), {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'seconds': 0.0})
+        totals['calls'] += 1
+        totals['input_tokens'] += input_tokens
+        totals['output_tokens'] += output_tokens
+        totals['seconds'] += seconds
+
+def estimate_model_call(model_id, input_tokens, output_tokens):
+    # (USD, seconds of generation) for a model in MODEL_PROFILES; unknown models count as free and instant
+    profile = MODEL_PROFILES.get(model_id)
+    if profile is None:
+        return 0.0, 0.0
+    return (input_tokens * profile['input'] + output_tokens * profile['output']) / 1000, output_tokens / profile['output_tokens_per_second']
+
+def routing_report():
+    # Per route: the model used, its calls, tokens, measured seconds and estimated cost, next to the estimated cost and
+    # seconds of the same tokens on the baseline model. The baseline latency swaps the estimated generation time of
+    # the routed model for that of the baseline model.
+    run_totals = current_run_totals()
+    with run_totals.lock:
+        items = [(route, model_id, dict(totals)) for (route, model_id), totals in run_totals.routing.items()]
+    routes = {}
+    for route, model_id, totals in items:
+        cost, generation_seconds = estimate_model_call(model_id, totals['input_tokens'], totals['output_tokens'])
+        baseline_model_id = BASELINE_MODEL_ROUTES.get(route)
+        if baseline_model_id is None:
+            baseline_cost, baseline_seconds = 0.0, 0.0
+        else:
+            baseline_cost, baseline_generation_seconds = estimate_model_call(baseline_model_id, totals['input_tokens'], totals['output_tokens'])
+            baseline_seconds = max(0.0, totals['seconds'] - generation_seconds) + baseline_generation_seconds
+        routes[f"{route}:{model_id}"] = dict(totals, route=route, model_id=model_id, baseline_model_id=baseline_model_id,
+                                            cost_usd=round(cost, 6), baseline_cost_usd=round(baseline_cost, 6),
+                                            seconds=round(totals['seconds'], 3), baseline_seconds=round(baseline_seconds, 3))
+    summary = {name: round(sum(route[name] for route in routes.values()), 6)
+               for name in ('calls', 'cost_usd', 'baseline_cost_usd', 'seconds', 'baseline_seconds')}
+    summary['savings_usd'] = round(summary['baseline_cost_usd'] - summary['cost_usd'], 6)
+    summary['seconds_saved'] = round(summary['baseline_seconds'] - summary['seconds'], 3)
+    return {'routes': routes, 'summary': summary}
+
+def log_routing_report():
+    report = routing_report()
+    logger.info("Model routing report: %s", json.dumps(report))
+    summary = report['summary']
+    emit_metrics('routing', {'EstimatedCostUSD': summary['cost_usd'], 'BaselineCostUSD': summary['baseline_cost_usd'],
+                             'RoutingSavingsUSD': summary['savings_usd']})
+    return report
+
+def build_user_content(prompt, prompt_prefix=''):
+    # With prompt caching the shared prefix is sent as its own block ending in a cache point,
+    # so Bedrock processes and bills it in full only once while it stays cached
+    if prompt_prefix and PROMPT_CACHING:
+        return [
+            {"type": "text", "text": prompt_prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": prompt}
+        ]
+    return [{"type": "text", "text": prompt_prefix + prompt}]
+
+@instrument
+def invoke_bedrock_model(prompt, bypass_cache=RESPONSE_CACHE_BYPASS, prompt_prefix='', max_tokens=MAX_TOKENS, route='plan'):
     try:
         body = {
-            "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
+            "modelId": MODEL_ROUTES[route],
             "contentType": "application/json",
             "accept": "application/json",
             "body": {
                 "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 100000,
+                "max_tokens": max_tokens,
                 "messages": [
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
+                        "content": build_user_content(prompt, prompt_prefix)
                     }
                 ]
             }
         }
         
+        # The key covers the model ID, the inference parameters and the full prompt, so a hit is
+        # only possible when nothing that feeds the generation has changed
+        key = cache_key(body['modelId'], body['body'])
+        if response_cache is not None and not bypass_cache:
+            cached_content = response_cache.get(key)
+            if cached_content is not None:
+                logger.info("Using cached response from Bedrock model")
+                add_metric('CacheHits', 1)
+                return cached_content
+
         # Invoke the Bedrock model
-        response = bedrock.invoke_model(
+        add_metric('RequestBytes', len(json.dumps(body['body'])))
+        start = time.perf_counter()
+        response = call_model(
+            bedrock.invoke_model,
+            body['modelId'],
             body=json.dumps(body['body']),
-            modelId=body['modelId'],
             contentType=body['contentType'],
             accept=body['accept']
         )
         
         # Parse the response from Bedrock
         response_body = json.loads(response['body'].read())
-        logger.info(f"Response from Bedrock model: {response_body}")
+        record_response_metadata(response)
+        if LOG_PAYLOADS:
+            logger.info(f"Response from Bedrock model: {response_body}")
+        usage = response_body.get('usage', {})
+        record_usage(usage)
+        record_model_call(route, body['modelId'], usage.get('input_tokens', 0) or 0, usage.get('output_tokens', 0) or 0, time.perf_counter() - start)
         
         # Extract the generated message from the response
-        generated_content = response_body.get('content', [{}])[0].get('text', '')
-        
-        return generated_content.strip()
+        generated_content = response_body.get('content', [{}])[0].get('text', '').strip()
+
+        # A bypassed lookup still refreshes the cached entry
+        if response_cache is not None and generated_content:
+            response_cache.put(key, generated_content)
+
+        return generated_content
     except ClientError as e:
         logger.error("An error occurred while invoking Bedrock model: %s", e, exc_info=True)
         raise
 
-def retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info):
-    query = (
-        f"Provide all the information for application ID {app_id}, including the Migration Assessment Questions "
-        f"and the corresponding App team Responses. Format the information as a structured list of questions and answers."
-    )
+# "generate" asks the knowledge base to summarize its results with a model (RetrieveAndGenerate); "retrieve" passes
+# the ranked chunks with their scores and sources straight into the final prompt, saving one generation per lookup
+KB_RETRIEVAL_MODE = os.environ.get('KB_RETRIEVAL_MODE', 'generate').lower()
+KB_NUMBER_OF_RESULTS = int(os.environ.get('KB_NUMBER_OF_RESULTS', '8'))
 
-    try:
-        response = bedrock_client.retrieve_and_generate(
-            input={
+def format_retrieval_results(results):
+    passages = []
+    for rank, result in enumerate(results, 1):
+        location = result.get('location', {})
+        source = location.get('s3Location', {}).get('uri') or location.get('type', 'unknown source')
+        passages.append(f"[{rank}] (relevance {result.get('score', 0):.3f}, source: {source})\n{result['content']['text'].strip()}")
+    return '\n\n'.join(passages)
+
+def query_knowledge_base(kb_id, query, route):
+    if KB_RETRIEVAL_MODE == 'retrieve':
+        response = call_knowledge_base(
+            bedrock_client.retrieve,
+            kb_id,
+            knowledgeBaseId=kb_id,
+            retrievalQuery={
                 'text': query
             },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_qanda_info,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-v2'
+            retrievalConfiguration={
+                'vectorSearchConfiguration': {
+                    'numberOfResults': KB_NUMBER_OF_RESULTS
                 }
             }
         )
+        record_response_metadata(response)
+        return format_retrieval_results(response['retrievalResults'])
+
+    model_id = MODEL_ROUTES[route]
+    start = time.perf_counter()
+    response = call_knowledge_base(
+        bedrock_client.retrieve_and_generate,
+        kb_id,
+        input={
+            'text': query
+        },
+        retrieveAndGenerateConfiguration={
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': {
+                'knowledgeBaseId': kb_id,
+                'modelArn': model_arn(model_id)
+            }
+        }
+    )
+    record_response_metadata(response)
+    # RetrieveAndGenerate does not report token usage, so the report estimates it from the query and the answer
+    record_model_call(route, model_id, estimate_tokens(query), estimate_tokens(response['output']['text']), time.perf_counter() - start)
+    return response['output']['text']
+
+# Exact inventory and Q&A rows are served from the SQLite index built by build-inventory-index.py when
+# INVENTORY_INDEX_KEY is set; applications missing from the index fall back to the knowledge bases
+INVENTORY_INDEX_KEY = os.environ.get('INVENTORY_INDEX_KEY', '')
+INVENTORY_INDEX_BUCKET = os.environ.get('INVENTORY_INDEX_BUCKET') or os.environ.get('S3_BUCKET', '')
+INVENTORY_INDEX_PATH = os.environ.get('INVENTORY_INDEX_PATH', '/tmp/inventory-index.db')
+INVENTORY_INDEX_TTL = int(os.environ.get('INVENTORY_INDEX_TTL_SECONDS', '300'))
+inventory_index_state = {'etag': None, 'checked_at': 0.0}
+inventory_index_lock = threading.Lock()
+
+def refresh_inventory_index():
+    # Returns the local path of the index, downloading it again only when the copy in S3 has changed
+    if not INVENTORY_INDEX_KEY:
+        return None
+    with inventory_index_lock:
+        if time.time() - inventory_index_state['checked_at'] >= INVENTORY_INDEX_TTL:
+            inventory_index_state['checked_at'] = time.time()
+            try:
+                etag = s3.head_object(Bucket=INVENTORY_INDEX_BUCKET, Key=INVENTORY_INDEX_KEY)['ETag']
+                if etag != inventory_index_state['etag']:
+                    # Replace the file atomically so lookups already reading the old copy are not disturbed
+                    s3.download_file(INVENTORY_INDEX_BUCKET, INVENTORY_INDEX_KEY, INVENTORY_INDEX_PATH + '.download')
+                    os.replace(INVENTORY_INDEX_PATH + '.download', INVENTORY_INDEX_PATH)
+                    inventory_index_state['etag'] = etag
+            except ClientError as e:
+                logger.warning("Inventory index s3://%s/%s is unavailable: %s", INVENTORY_INDEX_BUCKET, INVENTORY_INDEX_KEY, e)
+        return INVENTORY_INDEX_PATH if inventory_index_state['etag'] else None
+
+def format_inventory_records(app_id, rows):
+    sections = OrderedDict()
+    for sheet, record in rows:
+        fields = '; '.join(f"{column}: {value}" for column, value in json.loads(record).items() if value)
+        sections.setdefault(sheet, []).append(f"- {fields}")
+    return f"Inventory records for application {app_id}:\n" + '\n\n'.join(
+        f"{sheet}:\n" + '\n'.join(lines) for sheet, lines in sections.items()
+    )
 
-        retrieved_info = response['output']['text']
-        print(f"Received KB info:  {retrieved_info}")
+NEIGHBORHOOD_LIST_LIMIT = 25
+
+def format_id_list(ids):
+    ids = list(ids)
+    if len(ids) > NEIGHBORHOOD_LIST_LIMIT:
+        return ', '.join(ids[:NEIGHBORHOOD_LIST_LIMIT]) + f" and {len(ids) - NEIGHBORHOOD_LIST_LIMIT} more"
+    return ', '.join(ids) or 'none'
+
+def lookup_app_neighborhood(connection, app_id):
+    # The application's place in the portfolio dependency graph computed by build-inventory-index.py
+    try:
+        placement = connection.execute("SELECT wave, move_group FROM apps WHERE app_id = ?", (app_id,)).fetchone()
+    except sqlite3.OperationalError:
+        # Index built before the dependency graph was added
+        return None
+    if placement is None:
+        return None
+    wave, move_group = placement
+    total_waves = connection.execute("SELECT MAX(wave) FROM apps").fetchone()[0]
+    shared_server_app_limit = int(connection.execute(
+        "SELECT value FROM settings WHERE name = 'shared_server_app_limit'").fetchone()[0])
+
+    move_group_apps = [row[0] for row in connection.execute(
+        "SELECT app_id FROM apps WHERE move_group = ? AND app_id <> ? ORDER BY app_id", (move_group, app_id))]
+    depends_on = [f"{other} (wave {other_wave or '?'})" for other, other_wave in connection.execute(
+        "SELECT d.depends_on, a.wave FROM app_dependencies d LEFT JOIN apps a ON a.app_id = d.depends_on"
+        " WHERE d.app_id = ? ORDER BY d.depends_on", (app_id,))]
+    depended_on_by = [f"{other} (wave {other_wave or '?'})" for other, other_wave in connection.execute(
+        "SELECT d.app_id, a.wave FROM app_dependencies d LEFT JOIN apps a ON a.app_id = d.app_id"
+        " WHERE d.depends_on = ? ORDER BY d.app_id", (app_id,))]
+    servers = [f"{server_id} ({count} application{'s' if count > 1 else ''}"
+               f"{', shared infrastructure' if count > shared_server_app_limit else ''})"
+               for server_id, count in connection.execute(
+        "SELECT s.server_id, COUNT(*) FROM app_servers s JOIN app_servers o ON o.server_id = s.server_id"
+        " WHERE s.app_id = ? GROUP BY s.server_id ORDER BY s.server_id", (app_id,))]
+    server_links = [f"{source} -> {target}" for source, target in connection.execute(
+        "SELECT l.source, l.target FROM app_servers s JOIN server_links l ON l.source = s.server_id OR l.target = s.server_id"
+        " WHERE s.app_id = ? ORDER BY l.source, l.target", (app_id,))]
+
+    return "\n".join([
+        "Dependency graph:",
+        f"- Migration wave {wave} of {total_waves}, move group {move_group}",
+        f"- Moves together with: {format_id_list(move_group_apps)}",
+        f"- Depends on: {format_id_list(depends_on)}",
+        f"- Depended on by: {format_id_list(depended_on_by)}",
+        f"- Servers: {format_id_list(servers)}",
+        f"- Server communication: {format_id_list(server_links)}"
+    ])
+
+@instrument
+def lookup_inventory_index(app_id, kind):
+    # kind is "inventory" or "qanda"; returns None when there is no index or it has no rows for the application
+    path = refresh_inventory_index()
+    if path is None:
+        return None
+    app_id = app_id.strip()
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(
+            "SELECT sheet, record FROM records WHERE kind = ? AND id IN ("
+            " SELECT record_id FROM record_keys WHERE key_type = 'app' AND key = ?"
+            " UNION SELECT k.record_id FROM app_servers s JOIN record_keys k ON k.key_type = 'server' AND k.key = s.server_id"
+            " WHERE s.app_id = ?) ORDER BY id",
+            (kind, app_id, app_id)
+        ).fetchall()
+        neighborhood = lookup_app_neighborhood(connection, app_id) if rows and kind == 'inventory' else None
+    finally:
+        connection.close()
+    add_metric('RecordCount', len(rows))
+    if not rows:
+        return None
+    indexed_info = format_inventory_records(app_id, rows)
+    return f"{indexed_info}\n\n{neighborhood}" if neighborhood else indexed_info
+
+@instrument
+def retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info):
+    indexed_info = lookup_inventory_index(app_id, 'qanda')
+    if indexed_info:
+        return indexed_info
+
+    query = (
+        f"Provide all the information for application ID {app_id}, including the Migration Assessment Questions "
+        f"and the corresponding App team Responses. Format the information as a structured list of questions and answers."
+    )
+
+    try:
+        retrieved_info = query_knowledge_base(kb_id_qanda_info, query, 'kb_qanda')
+        if LOG_PAYLOADS:
+            print(f"Received KB info:  {retrieved_info}")
         return retrieved_info
 
     except ClientError as e:
         print(f"Error retrieving information from the Q&A knowledge base: {e}")
-        return ""
+        return UNAVAILABLE_CONTEXT
 
+@instrument
 def write_text_to_s3(bucket, key, content):
     try:
+        add_metric('RequestBytes', len(content.encode('utf-8')))
         s3.put_object(Bucket=bucket, Key=key, Body=content)
     except ClientError as e:
         logger.error("Error writing text to S3: %s", e, exc_info=True)
         raise
 
+def load_stream_state(bucket, key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{key}.stream-state.json")
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+
+def save_stream_state(bucket, key, state, pending):
+    # The state object doubles as the progress report for a plan that is still being generated
+    state = dict(state, pending=pending.decode('utf-8', errors='ignore'), updated=time.time())
+    s3.put_object(Bucket=bucket, Key=f"{key}.stream-state.json", Body=json.dumps(state))
+
+@instrument
+def stream_bedrock_model_to_s3(prompt, bucket, key, context=None, resume=False, prompt_prefix=''):
+    # Stream the generation straight into an S3 multipart upload so memory use is bounded by one part.
+    # Returns True once the object is complete, or False if the run stopped early and can be resumed.
+    state = load_stream_state(bucket, key) if resume else None
+    if state is None:
+        upload = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType='text/plain')
+        state = {'upload_id': upload['UploadId'], 'parts': [], 'bytes_written': 0, 'tail': ''}
+        pending = bytearray()
+    else:
+        logger.info("Resuming streamed generation of %s after %d bytes", key, state['bytes_written'])
+        pending = bytearray(state['pending'].encode('utf-8'))
+
+    messages = [{"role": "user", "content": build_user_content(prompt, prompt_prefix)}]
+    if state['tail'].rstrip():
+        # Prefill the end of the text generated so far so the model continues where it stopped
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": state['tail'].rstrip()}]})
+
+    def upload_part(data):
+        part_number = len(state['parts']) + 1
+        part = s3.upload_part(Bucket=bucket, Key=key, UploadId=state['upload_id'], PartNumber=part_number, Body=bytes(data))
+        state['parts'].append({'PartNumber': part_number, 'ETag': part['ETag']})
+
+    model_id = MODEL_ROUTES['plan']
+    usage = {'input_tokens': 0, 'output_tokens': 0}
+    start = time.perf_counter()
+    try:
+        response = call_model(
+            bedrock.invoke_model_with_response_stream,
+            model_id,
+            body=json.dumps({"anthropic_version": "bedrock-2023-05-31", "max_tokens": MAX_TOKENS, "messages": messages}),
+            contentType="application/json",
+            accept="application/json"
+        )
+
+        last_progress = time.monotonic()
+        for event in response['body']:
+            chunk = json.loads(event['chunk']['bytes'])
+            if chunk.get('type') in ('message_start', 'message_delta'):
+                # Input and cache read/write token counts arrive with the first event, output tokens with the last
+                chunk_usage = chunk.get('message', {}).get('usage', {}) if chunk['type'] == 'message_start' else chunk.get('usage', {})
+                record_usage(chunk_usage)
+                for name in usage:
+                    usage[name] += chunk_usage.get(name, 0) or 0
+            if chunk.get('type') != 'content_block_delta':
+                continue
+            text = chunk['delta'].get('text', '')
+            pending.extend(text.encode('utf-8'))
+            state['bytes_written'] += len(text.encode('utf-8'))
+            add_metric('ResponseBytes', len(text.encode('utf-8')))
+            state['tail'] = (state['tail'] + text)[-STREAM_RESUME_TAIL_CHARS:]
+
+            if len(pending) >= STREAM_PART_SIZE:
+                upload_part(pending)
+                pending = bytearray()
+                save_stream_state(bucket, key, state, pending)
+                last_progress = time.monotonic()
+            elif time.monotonic() - last_progress >= STREAM_PROGRESS_SECONDS:
+                save_stream_state(bucket, key, state, pending)
+                last_progress = time.monotonic()
+
+            if context is not None and context.get_remaining_time_in_millis() < STREAM_TIMEOUT_MARGIN_MS:
+                logger.warning("Stopping streamed generation of %s before the Lambda timeout", key)
+                save_stream_state(bucket, key, state, pending)
+                return False
+    except Exception:
+        # Keep what has been generated so far so the plan can be resumed
+        save_stream_state(bucket, key, state, pending)
+        raise
+    finally:
+        record_model_call('plan', model_id, usage['input_tokens'], usage['output_tokens'], time.perf_counter() - start)
+
+    # S3 accepts a last part smaller than the minimum part size
+    if pending or not state['parts']:
+        upload_part(pending)
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=state['upload_id'], MultipartUpload={'Parts': state['parts']})
+    s3.delete_object(Bucket=bucket, Key=f"{key}.stream-state.json")
+    return True
+
+@instrument
 def retrieve_from_app_knowledge_base(app_id, r_strategy, kb_id_migration_agent_info):
+    indexed_info = lookup_inventory_index(app_id, 'inventory')
+    if indexed_info:
+        return indexed_info
+
     # Prepare the query
     query = (
         f"Provide detailed information about application ID {app_id} related to its migration to AWS using the {r_strategy} strategy. "
@@ -108,29 +974,17 @@ def retrieve_from_app_knowledge_base(app_id, r_strategy, kb_id_migration_agent_i
     )
 
     try:
-        # Call the Bedrock KnowledgeBase retrieve_and_generate API
-        response = bedrock_client.retrieve_and_generate(
-            input={
-                'text': query
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_migration_agent_info,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0'
-                }
-            }
-        )
-
-        # Extract the relevant information from the response
-        retrieved_info = response['output']['text']
-        print(f"Received KB info:  {retrieved_info}")
+        # Query the Bedrock knowledge base
+        retrieved_info = query_knowledge_base(kb_id_migration_agent_info, query, 'kb_application')
+        if LOG_PAYLOADS:
+            print(f"Received KB info:  {retrieved_info}")
         return retrieved_info
 
     except ClientError as e:
         print(f"Error retrieving information from the knowledge base: {e}")
-        return ""    
+        return UNAVAILABLE_CONTEXT
     
+@instrument
 def retrieve_from_knowledge_base(r_strategy, kb_id_bp_docs):
     # Prepare the query
     query = (
@@ -139,61 +993,74 @@ def retrieve_from_knowledge_base(r_strategy, kb_id_bp_docs):
         f"Outline the steps involved in the migration process and best practices to ensure a smooth transition with {r_strategy}."
     )
 
-    try:
-        # Call the Bedrock KnowledgeBase retrieve_and_generate API
-        response = bedrock_client.retrieve_and_generate(
-            input={
-                'text': query
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_bp_docs,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0'
-                }
-            }
-        )
+    # The query does not depend on the application, so the same answer can be reused across requests
+    key = cache_key(kb_id_bp_docs, query, model_arn(MODEL_ROUTES['kb_best_practices']), KB_RETRIEVAL_MODE)
+    cached_info = kb_cache.get(key)
+    if cached_info is not None:
+        add_metric('CacheHits', 1)
+        if LOG_PAYLOADS:
+            print(f"Using cached KB info:  {cached_info}")
+        return cached_info
 
-        # Extract the relevant information from the response
-        retrieved_info = response['output']['text']
-        print(f"Received KB info:  {retrieved_info}")
+    try:
+        # Query the Bedrock knowledge base
+        retrieved_info = query_knowledge_base(kb_id_bp_docs, query, 'kb_best_practices')
+        if LOG_PAYLOADS:
+            print(f"Received KB info:  {retrieved_info}")
+        if retrieved_info:
+            kb_cache.put(key, retrieved_info)
         return retrieved_info
 
     except ClientError as e:
         print(f"Error retrieving information from the knowledge base: {e}")
-        return ""
+        return UNAVAILABLE_CONTEXT
 
-def lambda_handler(event, context):
+def retrieve_migration_contexts(app_ids, r_strategies, kb_id_bp_docs, kb_id_migration_agent_info, kb_id_qanda_info, timeout=KB_RETRIEVAL_TIMEOUT):
+    # None of the retrievals depends on another, so run them at the same time and pay for the slowest round trip
+    # instead of the sum. Best practices depend only on the strategy and the application and Q&A information only
+    # on the application, so each is retrieved once however many plans share it.
+    # Returns {('best practices', r_strategy) | ('application', app_id) | ('Q&A', app_id): info}
+    app_strategy = ' or '.join(r_strategies)
+    calls = [(('best practices', r_strategy), retrieve_from_knowledge_base, (r_strategy, kb_id_bp_docs)) for r_strategy in r_strategies]
+    for app_id in app_ids:
+        calls.append((('application', app_id), retrieve_from_app_knowledge_base, (app_id, app_strategy, kb_id_migration_agent_info)))
+        calls.append((('Q&A', app_id), retrieve_from_qanda_knowledgebase, (app_id, kb_id_qanda_info)))
+    if not calls:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=min(len(calls), CLIENT_MAX_POOL_CONNECTIONS))
+    futures = {name: executor.submit(bind_run_totals(function), *args) for name, function, args in calls}
+
+    # All calls start together, so a shared deadline gives each of them the same timeout
+    deadline = time.monotonic() + timeout
+    results = {}
     try:
-        print("Received event: " + json.dumps(event))
-        properties = event['requestBody']['content']['application/json']['properties']
-        params = {prop['name']: prop['value'] for prop in properties}
-        
-        s3_bucket = os.environ['S3_BUCKET']
-        app_id = params['app_id']
-        r_strategy = params['r_strategy']
-        output_key = f"R-Disposition-outputs/{app_id}_migration_plan.txt"
-        kb_id_migration_agent_info = os.environ['KB_ID_MIGRATION_AGENT_INFO'] 
-        kb_id_bp_docs = os.environ['KB_ID_BP_DOCS'] 
-        kb_id_qanda_info = os.environ['KB_ID_QANDA_INFO'] 
-        
-        retrieved_info = retrieve_from_knowledge_base(r_strategy,kb_id_bp_docs)
-        retrieved_app_info = retrieve_from_app_knowledge_base(app_id, r_strategy, kb_id_migration_agent_info)
-        
-        qanda_info = retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FuturesTimeoutError:
+                print(f"Timed out after {timeout}s retrieving information from the {name[0]} knowledge base")
+                results[name] = UNAVAILABLE_CONTEXT
+    finally:
+        # Do not block on retrievals that timed out
+        executor.shutdown(wait=False)
 
-        
-        prompt = (
-        f"Create a detailed migration plan for application ID {app_id} based on the following information:\n\n"
-        f"Application details:\n{retrieved_app_info}\n\n"
-        f"Migration Strategy: {r_strategy}\n\n"
-        f"Migration recommendation from AWS whitepapers: {retrieved_info}\n\n"
-        f"Application Assessment Data:\n{qanda_info}\n\n"
-        "1. Introduction\n"
+    return results
+
+# Sectioned mode generates a short outline first and then every section of the plan as its own concurrent call
+# that sees the outline, and stitches the sections together. Outline and sections are stored next to the plan, so
+# regenerating one section reuses the others as they were, even though the knowledge base answers change per call.
+PLAN_MODE = os.environ.get('PLAN_MODE', 'single').lower()
+PLAN_OUTLINE_MAX_TOKENS = int(os.environ.get('PLAN_OUTLINE_MAX_TOKENS', '2000'))
+PLAN_SECTION_MAX_TOKENS = int(os.environ.get('PLAN_SECTION_MAX_TOKENS', '8000'))
+
+# (title, guidance) for every section of a migration plan; {r_strategy} in the guidance is replaced with the strategy
+PLAN_SECTIONS = [
+    ("Introduction", (
         "   - Provide a brief overview of the application, its purpose, and its current architecture\n"
         "   - Provide a detailed description of AWS architecture\n"
-        f"   - Explain the rationale for choosing the {r_strategy} migration strategy\n\n"
-        "2. Pre-Migration Activities\n"
+        "   - Explain the rationale for choosing the {r_strategy} migration strategy\n"
+    )),
+    ("Pre-Migration Activities", (
         "   - AWS Account Enrollment and Setup with AWS landing zone or AWS control tower\n"
         "     - Provide step-by-step instructions for enrolling AWS accounts with control tower or AWS landing Zone\n"
         "     - Include guidelines for setting up development and production accounts\n"
@@ -216,8 +1083,9 @@ def lambda_handler(event, context):
         "     - Establish connectivity between on-premises and AWS environments (e.g., VPN, AWS Direct Connect)\n"
         "   - Migration Tooling and Environment Setup\n"
         "     - List the AWS tools and services that will be used for the migration (e.g., AWS MGN, AWS DMS)\n"
-        "     - Provide step-by-step instructions for setting up the necessary AWS environments\n\n"
-        "3. Compute, Database, and Storage Migration\n"
+        "     - Provide step-by-step instructions for setting up the necessary AWS environments\n"
+    )),
+    ("Compute, Database, and Storage Migration", (
         "   - Compute Migration\n"
         "     - Provide a detailed, step-by-step plan for migrating compute resources\n"
         "     - Include specific instructions for using AWS services like AWS MGN or AWS App2Container\n"
@@ -238,13 +1106,15 @@ def lambda_handler(event, context):
         "     - Include instructions for configuring and optimizing storage on AWS (e.g., Amazon EFS, Amazon S3)\n"
         "     - Address any data synchronization or replication requirements\n"
         "     - Provide recommendations for storage options based on the current storage requirements\n"
-        "     - Include details on storage size, performance, and data transfer considerations\n\n"
-        "4. Testing and Validation\n"
+        "     - Include details on storage size, performance, and data transfer considerations\n"
+    )),
+    ("Testing and Validation", (
         "   - Define a comprehensive testing strategy, including functional, performance, and user acceptance testing\n"
         "   - Provide detailed test cases and scenarios for each testing phase\n"
         "   - Include instructions for setting up test environments on AWS\n"
-        "   - Clearly define success criteria and acceptance criteria for each testing phase\n\n"
-        "5. Monitoring, Logging, and Cost Optimization\n"
+        "   - Clearly define success criteria and acceptance criteria for each testing phase\n"
+    )),
+    ("Monitoring, Logging, and Cost Optimization", (
         "   - Monitoring and Logging\n"
         "     - Configure Amazon CloudWatch for resource monitoring and alerting\n"
         "     - Enable AWS CloudTrail for API activity tracking and auditing\n"
@@ -252,44 +1122,214 @@ def lambda_handler(event, context):
         "   - Cost Optimization\n"
         "     - Right-size resources based on performance requirements\n"
         "     - Leverage AWS cost optimization tools (e.g., AWS Cost Explorer, AWS Budgets)\n"
-        "     - Implement cost-saving measures (e.g., reserved instances, spot instances, auto-scaling)\n\n"
-        "6. Disaster Recovery and Business Continuity\n"
+        "     - Implement cost-saving measures (e.g., reserved instances, spot instances, auto-scaling)\n"
+    )),
+    ("Disaster Recovery and Business Continuity", (
         "   - Design a highly available and fault-tolerant architecture\n"
         "   - Implement data backup and restore procedures\n"
-        "   - Develop and test disaster recovery plans\n\n"
-        "7. Cutover and Post-Migration\n"
+        "   - Develop and test disaster recovery plans\n"
+    )),
+    ("Cutover and Post-Migration", (
         "   - Develop a detailed cutover plan, including timelines, communication plans, and rollback procedures\n"
         "   - Provide step-by-step instructions for the cutover process\n"
         "   - Outline post-migration activities, such as monitoring, optimization, and knowledge transfer\n"
-        "   - Include a plan for decommissioning the old environment\n\n"
-        "8. Stakeholder Communication and Collaboration\n"
+        "   - Include a plan for decommissioning the old environment\n"
+    )),
+    ("Stakeholder Communication and Collaboration", (
         "   - Identify key stakeholders and their roles in the migration process\n"
         "   - Establish communication channels and feedback loops\n"
-        "   - Conduct regular status updates and progress reviews\n\n"
-        "9. Risk Assessment and Mitigation\n"
+        "   - Conduct regular status updates and progress reviews\n"
+    )),
+    ("Risk Assessment and Mitigation", (
         "    - Identify potential risks associated with the migration, including technical, operational, and business risks\n"
         "    - Provide specific mitigation strategies for each identified risk\n"
-        "    - Include a contingency plan and detailed rollback procedures\n\n"
-        "10. Training and Continuous Optimization\n"
+        "    - Include a contingency plan and detailed rollback procedures\n"
+    )),
+    ("Training and Continuous Optimization", (
         "    - Outline a comprehensive training plan for the team, including AWS services, architecture, and application-specific knowledge\n"
         "    - Provide a schedule for training sessions and knowledge transfer activities\n"
         "    - Establish a process for continuous optimization and modernization post-migration\n"
-        "    - Include recommendations for leveraging additional AWS services and best practices\n\n"
-        "Ensure the plan is well-structured, provides actionable guidance, and includes specific instructions for each phase of the migration process. Use consistent formatting and language throughout the plan."
+        "    - Include recommendations for leveraging additional AWS services and best practices\n"
+    ))
+]
+
+def build_plan_prompt_prefix(r_strategy, best_practices):
+    structure = ''.join(
+        f"{number}. {title}\n{guidance.replace('{r_strategy}', r_strategy)}\n" for number, (title, guidance) in enumerate(PLAN_SECTIONS, 1)
     )
-        
-        #print(f"Received final prompt:  {prompt}")
+    return (
+        f"You will create a detailed migration plan for an application moving to AWS. The application details and assessment data follow these instructions.\n\n"
+        f"Migration Strategy: {r_strategy}\n\n"
+        f"Migration recommendation from AWS whitepapers: {best_practices}\n\n"
+        "Structure the migration plan as follows:\n\n"
+        f"{structure}"
+        "Ensure the plan is well-structured, provides actionable guidance, and includes specific instructions for each phase of the migration process. Use consistent formatting and language throughout the plan.\n\n"
+    )
+
+def plan_section_store(s3_bucket, output_key):
+    # <output_key>.sections/outline.json and <section number>.json
+    return S3Cache(s3_bucket, f"{output_key}.sections")
+
+@instrument
+def generate_plan_part(prompt, prompt_prefix, max_tokens, bypass_cache=False, route='plan_section'):
+    return invoke_bedrock_model(prompt, bypass_cache, prompt_prefix, max_tokens, route)
+
+@instrument
+def generate_sectioned_plan(app_id, prompt_prefix, app_details, s3_bucket, output_key, regenerate_sections=(), bypass_cache=RESPONSE_CACHE_BYPASS):
+    # regenerate_sections holds the numbers of the sections to generate again. The outline and the other sections
+    # are then loaded from the plan's stored parts, and only generated if they are missing.
+    store = plan_section_store(s3_bucket, output_key)
+    reused = []
+
+    def stored_part(name):
+        part = store.get(name) if regenerate_sections else None
+        if part is not None:
+            reused.append(name)
+        return part
+
+    outline = stored_part('outline')
+    if outline is None:
+        outline = generate_plan_part(
+            f"{app_details}Write a concise outline of the migration plan for application ID {app_id}: the target AWS architecture, "
+            "the key decisions and assumptions, and the main points each section must cover. Do not write the sections themselves.",
+            prompt_prefix, PLAN_OUTLINE_MAX_TOKENS, bypass_cache, 'plan_outline'
+        )
+        if outline:
+            store.put('outline', outline)
+
+    def generate_section(number, title):
+        set_metrics_app_id(app_id)
+        if number not in regenerate_sections:
+            section = stored_part(str(number))
+            if section is not None:
+                return section
+        prompt = (
+            f"{app_details}Outline of the whole plan:\n{outline}\n\n"
+            f"Write only section {number}. {title} of the migration plan for application ID {app_id}, following the structure and "
+            f"guidance above and consistent with the outline. Start with the heading \"{number}. {title}\"."
+        )
+        section = generate_plan_part(prompt, prompt_prefix, PLAN_SECTION_MAX_TOKENS, bypass_cache or number in regenerate_sections)
+        if section:
+            store.put(str(number), section)
+        return section
+
+    with ThreadPoolExecutor(max_workers=max(1, min(PLAN_SECTION_WORKERS, len(PLAN_SECTIONS)))) as executor:
+        sections = list(executor.map(bind_run_totals(lambda item: generate_section(item[0], item[1][0])), enumerate(PLAN_SECTIONS, 1)))
+    add_metric('CacheHits', len(reused))
+    return '\n\n'.join(sections)
+
+def generate_migration_plan(app_id, r_strategy, contexts, s3_bucket, output_key, context=None, bypass_cache=RESPONSE_CACHE_BYPASS, stream_output=STREAM_OUTPUT, resume=False, sectioned=False, regenerate_sections=()):
+    # Returns the text for the agent: the output key, with a note if the plan is incomplete or degraded
+    set_metrics_app_id(app_id)
+    retrieved_info = contexts[('best practices', r_strategy)]
+    retrieved_app_info = contexts[('application', app_id)]
+    qanda_info = contexts[('Q&A', app_id)]
+    prompt_context, stats = compact_context([
+        ('best_practices', retrieved_info),
+        ('application', retrieved_app_info),
+        ('qanda', qanda_info)
+    ])
+    logger.info("Prompt compaction saved %d of %d estimated tokens", stats['tokens_saved'], stats['tokens_before'])
+    degraded = degraded_sections([
+        ('best practices', retrieved_info),
+        ('application', retrieved_app_info),
+        ('Q&A', qanda_info)
+    ])
+    if degraded:
+        logger.warning("Generating the migration plan for %s without the %s context", app_id, ', '.join(degraded))
+        add_metric('DegradedContext', len(degraded))
+
+    
+    # The template and the best-practice guidance only depend on r_strategy, so they form a prefix that
+    # can be served from the Bedrock prompt cache; the application-specific data follows it
+    prompt_prefix = build_plan_prompt_prefix(r_strategy, prompt_context['best_practices'])
+    prompt = (
+    f"Create a detailed migration plan for application ID {app_id} based on the following information:\n\n"
+    f"Application details:\n{prompt_context['application']}\n\n"
+    f"Application Assessment Data:\n{prompt_context['qanda']}\n\n"
+    "Follow the structure and guidance above."
+)
+    
+    #print(f"Received final prompt:  {prompt}")
 
+    response_key = output_key
+    if stream_output or resume:
+        # Stream the migration plan into S3 as it is generated
+        if not stream_bedrock_model_to_s3(prompt, s3_bucket, output_key, context, resume, prompt_prefix):
+            response_key = f"{output_key} (incomplete, progress in {output_key}.stream-state.json; run again with resume=true to continue)"
+    elif sectioned:
+        app_details = (
+            f"Application details:\n{prompt_context['application']}\n\n"
+            f"Application Assessment Data:\n{prompt_context['qanda']}\n\n"
+        )
+        write_text_to_s3(s3_bucket, output_key, generate_sectioned_plan(app_id, prompt_prefix, app_details, s3_bucket, output_key, regenerate_sections, bypass_cache))
+    else:
         # Invoke Bedrock model to get the migration plan
-        migration_plan = invoke_bedrock_model(prompt)
+        migration_plan = invoke_bedrock_model(prompt, bypass_cache, prompt_prefix)
         
         # Write the migration plan to a text file in S3
         write_text_to_s3(s3_bucket, output_key, migration_plan)
+    
+    if degraded:
+        response_key = f"{response_key} (warning: generated without the {', '.join(degraded)} context because the knowledge base lookup failed)"
+
+    return response_key
+
+record_init_phase('module')
+
+@instrument
+def lambda_handler(event, context):
+    try:
+        log_init_report()
+        if LOG_PAYLOADS:
+            print("Received event: " + json.dumps(event))
+        properties = event['requestBody']['content']['application/json']['properties']
+        params = {prop['name']: prop['value'] for prop in properties}
+        
+        s3_bucket = os.environ['S3_BUCKET']
+        # app_id and r_strategy may be comma-separated lists; one plan is generated for every combination
+        app_ids = [app_id.strip() for app_id in params['app_id'].split(',') if app_id.strip()]
+        r_strategies = [r_strategy.strip() for r_strategy in params['r_strategy'].split(',') if r_strategy.strip()]
+        plans = [(app_id, r_strategy) for app_id in app_ids for r_strategy in r_strategies]
+        if not plans:
+            raise ValueError("app_id and r_strategy must each name at least one application and strategy")
+        bypass_cache = str(params.get('bypass_cache', RESPONSE_CACHE_BYPASS)).lower() == 'true'
+        stream_output = str(params.get('stream', STREAM_OUTPUT)).lower() == 'true'
+        resume = str(params.get('resume', 'false')).lower() == 'true'
+        regenerate_sections = {int(number) for number in str(params.get('regenerate_sections', '')).split(',') if number.strip()}
+        sectioned = bool(regenerate_sections) or str(params.get('sectioned', PLAN_MODE == 'sectioned')).lower() == 'true'
+        kb_id_migration_agent_info = os.environ['KB_ID_MIGRATION_AGENT_INFO'] 
+        kb_id_bp_docs = os.environ['KB_ID_BP_DOCS'] 
+        kb_id_qanda_info = os.environ['KB_ID_QANDA_INFO'] 
         
+        totals = start_run_totals()
+        contexts = retrieve_migration_contexts(app_ids, r_strategies, kb_id_bp_docs, kb_id_migration_agent_info, kb_id_qanda_info)
+
+        def generate(plan):
+            app_id, r_strategy = plan
+            # A single plan keeps the original key so existing consumers still find it
+            if len(plans) == 1:
+                output_key = f"R-Disposition-outputs/{app_id}_migration_plan.txt"
+                return generate_migration_plan(app_id, r_strategy, contexts, s3_bucket, output_key, context, bypass_cache, stream_output, resume, sectioned, regenerate_sections)
+            output_key = f"R-Disposition-outputs/{app_id}_{r_strategy}_migration_plan.txt"
+            try:
+                return generate_migration_plan(app_id, r_strategy, contexts, s3_bucket, output_key, context, bypass_cache, stream_output, resume, sectioned, regenerate_sections)
+            except Exception as e:
+                # One failed plan must not lose the others
+                logger.error("Error generating the %s migration plan for %s: %s", r_strategy, app_id, e, exc_info=True)
+                return f"{output_key} (failed: {e})"
+
+        with ThreadPoolExecutor(max_workers=max(1, min(PLAN_MAX_WORKERS, len(plans)))) as executor:
+            response_key = '\n'.join(executor.map(bind_run_totals(generate), plans))
+        if response_cache is not None:
+            logger.info("Bedrock response cache: %s", response_cache.stats())
+        if totals.routing:
+            log_routing_report()
+
         # Construct the API response
         response_body = {
             'application/json': {
-                'body': output_key
+                'body': response_key
             }
         }
 
@@ -311,7 +1351,8 @@ def lambda_handler(event, context):
             'promptSessionAttributes': prompt_session_attributes
         }
     
-        print(api_response)
+        if LOG_PAYLOADS:
+            print(api_response)
         return api_response
             
     except Exception as e:
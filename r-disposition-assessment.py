@@ -1,97 +1,825 @@
+import time
+
+# Start of the Lambda init phase; the init timing report measures every component from here
+INIT_STARTED = time.perf_counter()
+
 import os
+import re
 import json
+import inspect
+import functools
+import hashlib
+import sqlite3
+import threading
+import random
+import uuid
 import logging
-import boto3
-import csv
-from io import StringIO
-from botocore.exceptions import ClientError
+from urllib.parse import quote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize a Boto3 client for Bedrock
-bedrock = boto3.client(service_name='bedrock-runtime')
-bedrock_client = boto3.client(service_name='bedrock-agent-runtime')
-s3 = boto3.client('s3')
+# Milliseconds spent on each component of the init phase, logged once by the first invocation of this container.
+# Clients are created on first use and added as client:<service> when that happens.
+init_timings = OrderedDict()
+init_phase_started = INIT_STARTED
+init_reported = False
+
+def record_init_phase(component):
+    global init_phase_started
+    now = time.perf_counter()
+    init_timings[component] = round((now - init_phase_started) * 1000, 3)
+    init_phase_started = now
+
+record_init_phase('imports')
+
+# Number of applications assessed in parallel; can be overridden per request with the max_workers parameter, up to
+# MAX_WORKERS_LIMIT, so that one request cannot start an unbounded number of parallel Bedrock calls
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+MAX_WORKERS_LIMIT = max(MAX_WORKERS, int(os.environ.get('MAX_WORKERS_LIMIT', '16')))
+
+def clamp_max_workers(max_workers):
+    return max(1, min(int(max_workers), MAX_WORKERS_LIMIT))
+
+# Boto3 clients, sized so that every worker thread gets its own connection. Importing boto3 and botocore.config and
+# creating a client are the slowest parts of a cold start, so each client is only created when a request first uses
+# it. Throttling of Bedrock calls is retried by call_with_backoff rather than botocore, so the rate limiters can
+# react to it. Set AWS_ENDPOINT_URL_BEDROCK_RUNTIME, AWS_ENDPOINT_URL_BEDROCK_AGENT_RUNTIME or AWS_ENDPOINT_URL_S3
+# to run against local fake endpoints.
+BEDROCK_READ_TIMEOUT = int(os.environ.get('BEDROCK_READ_TIMEOUT', '300'))
+client_init_lock = threading.Lock()
+
+class LazyClient:
+    # Stands in for a boto3 client and creates it on first attribute access. One lock for all clients, since
+    # creating clients on boto3's default session is not thread-safe.
+    def __init__(self, service_name, **config):
+        self.service_name = service_name
+        self.config = config
+        self.client = None
+
+    def get(self):
+        if self.client is None:
+            with client_init_lock:
+                if self.client is None:
+                    start = time.perf_counter()
+                    import boto3
+                    from botocore.config import Config
+                    client = boto3.client(service_name=self.service_name, config=Config(**self.config))
+                    init_timings[f"client:{self.service_name}"] = round((time.perf_counter() - start) * 1000, 3)
+                    self.client = client
+            logger.info("Created %s client in %.1f ms", self.service_name, init_timings[f"client:{self.service_name}"])
+            emit_metrics(f"init_client:{self.service_name}", {'Duration': init_timings[f"client:{self.service_name}"]})
+        return self.client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+bedrock_config = {'max_pool_connections': max(10, MAX_WORKERS_LIMIT), 'read_timeout': BEDROCK_READ_TIMEOUT,
+                  'retries': {'mode': 'standard', 'total_max_attempts': 1}}
+bedrock = LazyClient('bedrock-runtime', **bedrock_config)
+bedrock_client = LazyClient('bedrock-agent-runtime', **bedrock_config)
+bedrock_batch = LazyClient('bedrock')
+s3 = LazyClient('s3', max_pool_connections=max(10, MAX_WORKERS_LIMIT), retries={'mode': 'standard'})
+
+# Per-stage metrics are printed as CloudWatch Embedded Metric Format (EMF) lines. Full prompts, KB answers, model
+# responses and the events and responses of the handler are only logged when LOG_PAYLOADS is true, since they
+# dominate CloudWatch ingestion.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MigrationPortfolioAssessment')
+LOG_PAYLOADS = os.environ.get('LOG_PAYLOADS', 'false').lower() == 'true'
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'r-disposition-assessment')
+METRIC_UNITS = {
+    'Duration': 'Milliseconds',
+    'RequestBytes': 'Bytes',
+    'ResponseBytes': 'Bytes'
+}
+metrics_context = threading.local()
+
+def emit_metrics(stage, values, app_id=None):
+    # app_id is a property rather than a dimension to keep metric cardinality low; it can still be queried in Logs Insights
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Stage']],
+                'Metrics': [{'Name': name, 'Unit': METRIC_UNITS.get(name, 'Count')} for name in values]
+            }]
+        },
+        'Function': FUNCTION_NAME,
+        'Stage': stage,
+        **values
+    }
+    if app_id:
+        record['AppId'] = app_id
+    print(json.dumps(record))
+
+def add_metric(name, value):
+    # Adds to the metrics of the innermost instrumented stage running on this thread
+    stack = getattr(metrics_context, 'stack', None)
+    if stack:
+        stack[-1][name] = stack[-1].get(name, 0) + value
+
+def set_metrics_app_id(app_id):
+    metrics_context.app_id = app_id
+
+def log_init_report():
+    # Only the first invocation of a container paid for the init phase, so only it reports it
+    global init_reported
+    if init_reported:
+        return
+    init_reported = True
+    components = {component: ms for component, ms in init_timings.items() if not component.startswith('client:')}
+    logger.info("Init timing report: %s, total %.1f ms", ", ".join(f"{component} {ms:.1f} ms" for component, ms in components.items()),
+                sum(components.values()))
+    for component, ms in components.items():
+        emit_metrics(f"init_{component}", {'Duration': ms})
+
+def instrument(function):
+    # Records wall time, errors and the size of a string result for every call, plus anything the function
+    # adds with add_metric, and emits them tagged with the stage name and the application ID
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        app_id = arguments.get('app_id', getattr(metrics_context, 'app_id', None))
+        if not hasattr(metrics_context, 'stack'):
+            metrics_context.stack = []
+        values = {}
+        metrics_context.stack.append(values)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            if isinstance(result, str):
+                values['ResponseBytes'] = len(result.encode('utf-8'))
+            return result
+        except Exception:
+            values['Errors'] = 1
+            raise
+        finally:
+            metrics_context.stack.pop()
+            values['Duration'] = round((time.perf_counter() - start) * 1000, 3)
+            emit_metrics(function.__name__, values, app_id)
+    return wrapper
+
+def record_response_metadata(response):
+    add_metric('Retries', response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+# Every Bedrock and knowledge base request goes through a token bucket per model and per knowledge base. A
+# throttled request halves that bucket's rate and is retried with exponential backoff and full jitter; successful
+# requests restore the rate gradually. A rate of 0 disables limiting.
+MODEL_REQUESTS_PER_SECOND = float(os.environ.get('MODEL_REQUESTS_PER_SECOND', '2'))
+KB_REQUESTS_PER_SECOND = float(os.environ.get('KB_REQUESTS_PER_SECOND', '5'))
+THROTTLE_MAX_RETRIES = int(os.environ.get('THROTTLE_MAX_RETRIES', '6'))
+THROTTLE_BASE_DELAY = float(os.environ.get('THROTTLE_BASE_DELAY_SECONDS', '1'))
+THROTTLE_MAX_DELAY = float(os.environ.get('THROTTLE_MAX_DELAY_SECONDS', '30'))
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException'}
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.max_rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 32, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name, rate):
+    with rate_limiters_lock:
+        if name not in rate_limiters:
+            rate_limiters[name] = RateLimiter(rate)
+        return rate_limiters[name]
+
+def call_with_backoff(limiter, operation, **kwargs):
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = operation(**kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in RETRYABLE_ERROR_CODES or attempt == THROTTLE_MAX_RETRIES:
+                raise
+            if code in THROTTLING_ERROR_CODES:
+                limiter.throttled()
+                add_metric('Throttles', 1)
+            error = code
+        except (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError) as e:
+            if attempt == THROTTLE_MAX_RETRIES:
+                raise
+            error = type(e).__name__
+        else:
+            limiter.succeeded()
+            return response
+        delay = random.uniform(0, min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2 ** attempt))
+        add_metric('Retries', 1)
+        logger.warning("%s from %s, retrying in %.1fs (attempt %d of %d)", error, operation.__name__, delay, attempt + 1, THROTTLE_MAX_RETRIES)
+        time.sleep(delay)
+
+def call_model(operation, model_id, **kwargs):
+    return call_with_backoff(get_rate_limiter(f"model:{model_id}", MODEL_REQUESTS_PER_SECOND), operation, modelId=model_id, **kwargs)
+
+def call_knowledge_base(operation, kb_id, **kwargs):
+    return call_with_backoff(get_rate_limiter(f"kb:{kb_id}", KB_REQUESTS_PER_SECOND), operation, **kwargs)
+
+# Returned by the retrieval helpers when a lookup failed after retries, so the prompt says the context is missing
+# instead of silently leaving it empty, and callers can flag the result as built on degraded context
+UNAVAILABLE_CONTEXT = "[Unavailable: the knowledge base lookup failed, so this context is missing]"
+
+def degraded_sections(sections):
+    return [name for name, text in sections if text == UNAVAILABLE_CONTEXT]
+
+# Knowledge base responses are cached in-process (survives warm starts) and optionally in S3 (shared across containers)
+KB_CACHE_TTL = int(os.environ.get('KB_CACHE_TTL_SECONDS', '3600'))
+KB_CACHE_MAX_ENTRIES = int(os.environ.get('KB_CACHE_MAX_ENTRIES', '16'))
+KB_CACHE_S3_PREFIX = os.environ.get('KB_CACHE_S3_PREFIX', '')
+
+class MemoryCache:
+    # Least-recently-used cache whose entries expire after ttl seconds (0 disables expiry)
+    def __init__(self, max_entries, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl and time.time() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-def invoke_bedrock_model(prompt):
+class S3Cache:
+    # Cache shared by all containers; expired objects are ignored here and can be removed with an S3 lifecycle rule
+    def __init__(self, bucket, prefix, ttl=0):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}.json")
+            entry = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                logger.warning("Error reading cache entry from S3: %s", e)
+            return None
+        if self.ttl and time.time() - entry['created'] > self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        try:
+            s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}.json", Body=json.dumps({'created': time.time(), 'value': value}))
+        except ClientError as e:
+            logger.warning("Error writing cache entry to S3: %s", e)
+
+class DiskCache:
+    # Cache on local disk, e.g. /tmp, which persists for the lifetime of a Lambda container
+    def __init__(self, directory, ttl=0):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.ttl and time.time() - entry['created'] > self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            # Write to a temporary file first so concurrent readers never see a partial entry
+            with open(f"{path}.{threading.get_ident()}.tmp", 'w') as f:
+                json.dump({'created': time.time(), 'value': value}, f)
+            os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+        except OSError as e:
+            logger.warning("Error writing cache entry to disk: %s", e)
+
+class TieredCache:
+    # Looks tiers up in order and copies a hit into the faster tiers in front of it
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster_tier in self.tiers[:i]:
+                    faster_tier.put(key, value)
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        for tier in self.tiers:
+            tier.put(key, value)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def build_kb_cache():
+    tiers = [MemoryCache(KB_CACHE_MAX_ENTRIES, KB_CACHE_TTL)]
+    if KB_CACHE_S3_PREFIX:
+        tiers.append(S3Cache(os.environ.get('KB_CACHE_S3_BUCKET', os.environ.get('S3_BUCKET')), KB_CACHE_S3_PREFIX, KB_CACHE_TTL))
+    return TieredCache(tiers)
+
+record_init_phase('configuration')
+kb_cache = build_kb_cache()
+
+# Optional content-addressed cache of model responses: memory, disk, s3 or none
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'none').lower()
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '0'))
+RESPONSE_CACHE_BYPASS = os.environ.get('RESPONSE_CACHE_BYPASS', 'false').lower() == 'true'
+
+def build_response_cache():
+    if RESPONSE_CACHE_BACKEND == 'memory':
+        backend = MemoryCache(int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '256')), RESPONSE_CACHE_TTL)
+    elif RESPONSE_CACHE_BACKEND == 'disk':
+        backend = DiskCache(os.environ.get('RESPONSE_CACHE_DIR', '/tmp/bedrock-response-cache'), RESPONSE_CACHE_TTL)
+    elif RESPONSE_CACHE_BACKEND == 's3':
+        backend = S3Cache(os.environ.get('RESPONSE_CACHE_S3_BUCKET', os.environ.get('S3_BUCKET')),
+                          os.environ.get('RESPONSE_CACHE_S3_PREFIX', 'bedrock-response-cache'), RESPONSE_CACHE_TTL)
+    else:
+        return None
+    return TieredCache([backend])
+
+response_cache = build_response_cache()
+record_init_phase('caches')
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+MAX_TOKENS = 10000
+
+# Model routing: every model call names a route and MODEL_ROUTES maps each route to a model ID. By default the
+# routes use the models this function always used. With MODEL_ROUTING, knowledge base summaries and simple
+# applications go to SMALL_MODEL_ID, and complex applications and low-confidence recommendations use MODEL_ID.
+# Single routes can be overridden with a JSON object in MODEL_ROUTES.
+MODEL_ROUTING = os.environ.get('MODEL_ROUTING', 'false').lower() == 'true'
+SMALL_MODEL_ID = os.environ.get('SMALL_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+BASELINE_MODEL_ROUTES = {
+    'kb_application': 'anthropic.claude-v2',
+    'kb_qanda': 'anthropic.claude-v2',
+    'kb_best_practices': 'anthropic.claude-v2',
+    'assessment_simple': MODEL_ID,
+    'assessment_complex': MODEL_ID
+}
+SMALL_MODEL_ROUTES = ('kb_application', 'kb_qanda', 'kb_best_practices', 'assessment_simple')
+# Applications whose application and Q&A data exceed this many estimated tokens, or that are missing part of their
+# context, are complex; a simple application whose top pattern is below ESCALATION_CONFIDENCE percent is assessed
+# again on the escalation route
+COMPLEX_APP_PROMPT_TOKENS = int(os.environ.get('COMPLEX_APP_PROMPT_TOKENS', '2000'))
+ESCALATION_CONFIDENCE = float(os.environ.get('ESCALATION_CONFIDENCE', '50'))
+
+def load_model_routes():
+    # Escalations are extra calls, so they have no baseline model
+    routes = dict(BASELINE_MODEL_ROUTES, assessment_escalation=MODEL_ID)
+    if MODEL_ROUTING:
+        routes.update({route: SMALL_MODEL_ID for route in SMALL_MODEL_ROUTES})
+    routes.update(json.loads(os.environ.get('MODEL_ROUTES', '{}')))
+    return routes
+
+MODEL_ROUTES = load_model_routes()
+
+def model_arn(model_id):
+    return f"arn:aws:bedrock:{os.environ.get('AWS_REGION', 'us-east-1')}::foundation-model/{model_id}"
+
+# USD per 1,000 input and output tokens and output tokens per second, used to estimate the cost and latency of
+# each route in the routing report. These are rough on-demand figures; set MODEL_PROFILES to a JSON object with
+# your own prices and measured speeds.
+DEFAULT_MODEL_PROFILES = {
+    'anthropic.claude-3-sonnet-20240229-v1:0': {'input': 0.003, 'output': 0.015, 'output_tokens_per_second': 60},
+    'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125, 'output_tokens_per_second': 150},
+    'anthropic.claude-v2': {'input': 0.008, 'output': 0.024, 'output_tokens_per_second': 40}
+}
+MODEL_PROFILES = dict(DEFAULT_MODEL_PROFILES, **json.loads(os.environ.get('MODEL_PROFILES', '{}')))
+
+# Mark the shared prompt prefix as a cache point; requires a model that supports Bedrock prompt caching
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'false').lower() == 'true'
+
+# Batch mode submits all prompts as one Bedrock batch inference job instead of invoking the model per application
+ASSESSMENT_MODE = os.environ.get('ASSESSMENT_MODE', 'sync').lower()
+BATCH_PREFIX = os.environ.get('BATCH_PREFIX', 'R-Disposition-batch')
+# Bedrock rejects batch inference jobs with fewer records than its per-job minimum (a service quota, 100 by default)
+BATCH_MIN_RECORDS = int(os.environ.get('BATCH_MIN_RECORDS', '100'))
+
+# Token budget for each knowledge base section pasted into a prompt (0 disables the limit)
+CHARS_PER_TOKEN = 4
+PROMPT_SECTION_BUDGETS = {
+    'best_practices': int(os.environ.get('PROMPT_BUDGET_BEST_PRACTICES', '8000')),
+    'application': int(os.environ.get('PROMPT_BUDGET_APPLICATION', '8000')),
+    'qanda': int(os.environ.get('PROMPT_BUDGET_QANDA', '8000'))
+}
+# Lines shorter than this, such as list headings, are never treated as duplicates
+MIN_DEDUPLICATED_LINE_LENGTH = 40
+
+def estimate_tokens(text):
+    # Rough estimate for English text; good enough to enforce budgets without a tokenizer
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def compact_context(sections):
+    # sections is a list of (name, text) in priority order. Passages repeated from an earlier section are
+    # dropped, then each section is truncated at a line boundary to fit its budget.
+    # Returns the compacted texts by name and the estimated tokens before and after.
+    seen = set()
+    compacted = {}
+    tokens_before = 0
+    tokens_after = 0
+
+    for name, text in sections:
+        tokens_before += estimate_tokens(text)
+        budget = PROMPT_SECTION_BUDGETS.get(name, 0) * CHARS_PER_TOKEN
+        kept = []
+        size = 0
+        truncated = False
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            normalized = ' '.join(line.lower().split())
+            if len(normalized) >= MIN_DEDUPLICATED_LINE_LENGTH:
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+            if budget and size + len(line) > budget:
+                if not kept:
+                    kept.append(line[:budget])
+                truncated = True
+                break
+            kept.append(line)
+            size += len(line) + 1
+        if truncated:
+            kept.append("[Truncated to fit the prompt budget]")
+        compacted[name] = '\n'.join(kept)
+        tokens_after += estimate_tokens(compacted[name])
+
+    return compacted, {'tokens_before': tokens_before, 'tokens_after': tokens_after, 'tokens_saved': tokens_before - tokens_after}
+
+def build_user_content(prompt, prompt_prefix=''):
+    # With prompt caching the shared prefix is sent as its own block ending in a cache point,
+    # so Bedrock processes and bills it in full only once while it stays cached
+    if prompt_prefix and PROMPT_CACHING:
+        return [
+            {"type": "text", "text": prompt_prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": prompt}
+        ]
+    return prompt_prefix + prompt
+
+@instrument
+def invoke_bedrock_model(prompt, bypass_cache=RESPONSE_CACHE_BYPASS, prompt_prefix='', route='assessment_complex'):
     try:
         body = {
-            "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
+            "modelId": MODEL_ROUTES[route],
             "contentType": "application/json",
             "accept": "application/json",
             "body": {
                 "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 10000,
+                "max_tokens": MAX_TOKENS,
                 "messages": [
                     {
                         "role": "user",
-                        "content": prompt
+                        "content": build_user_content(prompt, prompt_prefix)
                     }
                 ]
             }
         }
         
+        # The key covers the model ID, the inference parameters and the full prompt, so a hit is
+        # only possible when nothing that feeds the generation has changed
+        key = cache_key(body['modelId'], body['body'])
+        if response_cache is not None and not bypass_cache:
+            cached_content = response_cache.get(key)
+            if cached_content is not None:
+                logger.info("Using cached response from Bedrock model")
+                add_metric('CacheHits', 1)
+                return cached_content
+
         # Invoke the Bedrock model
-        response = bedrock.invoke_model(
+        add_metric('RequestBytes', len(json.dumps(body['body'])))
+        start = time.perf_counter()
+        response = call_model(
+            bedrock.invoke_model,
+            body['modelId'],
             body=json.dumps(body['body']),
-            modelId=body['modelId'],
             contentType=body['contentType'],
             accept=body['accept']
         )
         
         # Parse the response from Bedrock
         response_body = json.loads(response['body'].read())
-        logger.info(f"Response from Bedrock model: {response_body}")
+        record_response_metadata(response)
+        if LOG_PAYLOADS:
+            logger.info(f"Response from Bedrock model: {response_body}")
+        usage = response_body.get('usage', {})
+        record_usage(usage)
+        record_model_call(route, body['modelId'], usage.get('input_tokens', 0) or 0, usage.get('output_tokens', 0) or 0, time.perf_counter() - start)
         
         # Extract the generated message from the response
-        generated_content = response_body.get('content', [{}])[0].get('text', '')
-        
-        return generated_content.strip()
+        generated_content = response_body.get('content', [{}])[0].get('text', '').strip()
+
+        # A bypassed lookup still refreshes the cached entry
+        if response_cache is not None and generated_content:
+            response_cache.put(key, generated_content)
+
+        return generated_content
     except ClientError as e:
         logger.error("An error occurred while invoking Bedrock model: %s", e, exc_info=True)
         raise
 
-def retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info):
-    query = (
-        f"Provide all the information for application ID {app_id}, including the Migration Assessment Questions "
-        f"and the corresponding App team Responses. Format the information as a structured list of questions and answers."
-    )
+# "generate" asks the knowledge base to summarize its results with a model (RetrieveAndGenerate); "retrieve" passes
+# the ranked chunks with their scores and sources straight into the final prompt, saving one generation per lookup
+KB_RETRIEVAL_MODE = os.environ.get('KB_RETRIEVAL_MODE', 'generate').lower()
+KB_NUMBER_OF_RESULTS = int(os.environ.get('KB_NUMBER_OF_RESULTS', '8'))
 
-    try:
-        response = bedrock_client.retrieve_and_generate(
-            input={
+def format_retrieval_results(results):
+    passages = []
+    for rank, result in enumerate(results, 1):
+        location = result.get('location', {})
+        source = location.get('s3Location', {}).get('uri') or location.get('type', 'unknown source')
+        passages.append(f"[{rank}] (relevance {result.get('score', 0):.3f}, source: {source})\n{result['content']['text'].strip()}")
+    return '\n\n'.join(passages)
+
+def query_knowledge_base(kb_id, query, route):
+    if KB_RETRIEVAL_MODE == 'retrieve':
+        response = call_knowledge_base(
+            bedrock_client.retrieve,
+            kb_id,
+            knowledgeBaseId=kb_id,
+            retrievalQuery={
                 'text': query
             },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_qanda_info,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-v2'
+            retrievalConfiguration={
+                'vectorSearchConfiguration': {
+                    'numberOfResults': KB_NUMBER_OF_RESULTS
                 }
             }
         )
+        record_response_metadata(response)
+        return format_retrieval_results(response['retrievalResults'])
+
+    model_id = MODEL_ROUTES[route]
+    start = time.perf_counter()
+    response = call_knowledge_base(
+        bedrock_client.retrieve_and_generate,
+        kb_id,
+        input={
+            'text': query
+        },
+        retrieveAndGenerateConfiguration={
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': {
+                'knowledgeBaseId': kb_id,
+                'modelArn': model_arn(model_id)
+            }
+        }
+    )
+    record_response_metadata(response)
+    # RetrieveAndGenerate does not report token usage, so the report estimates it from the query and the answer
+    record_model_call(route, model_id, estimate_tokens(query), estimate_tokens(response['output']['text']), time.perf_counter() - start)
+    return response['output']['text']
+
+# Exact inventory and Q&A rows are served from the SQLite index built by build-inventory-index.py when
+# INVENTORY_INDEX_KEY is set; applications missing from the index fall back to the knowledge bases
+INVENTORY_INDEX_KEY = os.environ.get('INVENTORY_INDEX_KEY', '')
+INVENTORY_INDEX_BUCKET = os.environ.get('INVENTORY_INDEX_BUCKET') or os.environ.get('S3_BUCKET', '')
+INVENTORY_INDEX_PATH = os.environ.get('INVENTORY_INDEX_PATH', '/tmp/inventory-index.db')
+INVENTORY_INDEX_TTL = int(os.environ.get('INVENTORY_INDEX_TTL_SECONDS', '300'))
+inventory_index_state = {'etag': None, 'checked_at': 0.0}
+inventory_index_lock = threading.Lock()
+
+def refresh_inventory_index():
+    # Returns the local path of the index, downloading it again only when the copy in S3 has changed
+    if not INVENTORY_INDEX_KEY:
+        return None
+    with inventory_index_lock:
+        if time.time() - inventory_index_state['checked_at'] >= INVENTORY_INDEX_TTL:
+            inventory_index_state['checked_at'] = time.time()
+            try:
+                etag = s3.head_object(Bucket=INVENTORY_INDEX_BUCKET, Key=INVENTORY_INDEX_KEY)['ETag']
+                if etag != inventory_index_state['etag']:
+                    # Replace the file atomically so lookups already reading the old copy are not disturbed
+                    s3.download_file(INVENTORY_INDEX_BUCKET, INVENTORY_INDEX_KEY, INVENTORY_INDEX_PATH + '.download')
+                    os.replace(INVENTORY_INDEX_PATH + '.download', INVENTORY_INDEX_PATH)
+                    inventory_index_state['etag'] = etag
+            except ClientError as e:
+                logger.warning("Inventory index s3://%s/%s is unavailable: %s", INVENTORY_INDEX_BUCKET, INVENTORY_INDEX_KEY, e)
+        return INVENTORY_INDEX_PATH if inventory_index_state['etag'] else None
+
+def format_inventory_records(app_id, rows):
+    sections = OrderedDict()
+    for sheet, record in rows:
+        fields = '; '.join(f"{column}: {value}" for column, value in json.loads(record).items() if value)
+        sections.setdefault(sheet, []).append(f"- {fields}")
+    return f"Inventory records for application {app_id}:\n" + '\n\n'.join(
+        f"{sheet}:\n" + '\n'.join(lines) for sheet, lines in sections.items()
+    )
+
+NEIGHBORHOOD_LIST_LIMIT = 25
+
+def format_id_list(ids):
+    ids = list(ids)
+    if len(ids) > NEIGHBORHOOD_LIST_LIMIT:
+        return ', '.join(ids[:NEIGHBORHOOD_LIST_LIMIT]) + f" and {len(ids) - NEIGHBORHOOD_LIST_LIMIT} more"
+    return ', '.join(ids) or 'none'
+
+def lookup_app_neighborhood(connection, app_id):
+    # The application's place in the portfolio dependency graph computed by build-inventory-index.py
+    try:
+        placement = connection.execute("SELECT wave, move_group FROM apps WHERE app_id = ?", (app_id,)).fetchone()
+    except sqlite3.OperationalError:
+        # Index built before the dependency graph was added
+        return None
+    if placement is None:
+        return None
+    wave, move_group = placement
+    total_waves = connection.execute("SELECT MAX(wave) FROM apps").fetchone()[0]
+    shared_server_app_limit = int(connection.execute(
+        "SELECT value FROM settings WHERE name = 'shared_server_app_limit'").fetchone()[0])
 
-        retrieved_info = response['output']['text']
-        print(f"Received KB info: {retrieved_info}")
+    move_group_apps = [row[0] for row in connection.execute(
+        "SELECT app_id FROM apps WHERE move_group = ? AND app_id <> ? ORDER BY app_id", (move_group, app_id))]
+    depends_on = [f"{other} (wave {other_wave or '?'})" for other, other_wave in connection.execute(
+        "SELECT d.depends_on, a.wave FROM app_dependencies d LEFT JOIN apps a ON a.app_id = d.depends_on"
+        " WHERE d.app_id = ? ORDER BY d.depends_on", (app_id,))]
+    depended_on_by = [f"{other} (wave {other_wave or '?'})" for other, other_wave in connection.execute(
+        "SELECT d.app_id, a.wave FROM app_dependencies d LEFT JOIN apps a ON a.app_id = d.app_id"
+        " WHERE d.depends_on = ? ORDER BY d.app_id", (app_id,))]
+    servers = [f"{server_id} ({count} application{'s' if count > 1 else ''}"
+               f"{', shared infrastructure' if count > shared_server_app_limit else ''})"
+               for server_id, count in connection.execute(
+        "SELECT s.server_id, COUNT(*) FROM app_servers s JOIN app_servers o ON o.server_id = s.server_id"
+        " WHERE s.app_id = ? GROUP BY s.server_id ORDER BY s.server_id", (app_id,))]
+    server_links = [f"{source} -> {target}" for source, target in connection.execute(
+        "SELECT l.source, l.target FROM app_servers s JOIN server_links l ON l.source = s.server_id OR l.target = s.server_id"
+        " WHERE s.app_id = ? ORDER BY l.source, l.target", (app_id,))]
+
+    return "\n".join([
+        "Dependency graph:",
+        f"- Migration wave {wave} of {total_waves}, move group {move_group}",
+        f"- Moves together with: {format_id_list(move_group_apps)}",
+        f"- Depends on: {format_id_list(depends_on)}",
+        f"- Depended on by: {format_id_list(depended_on_by)}",
+        f"- Servers: {format_id_list(servers)}",
+        f"- Server communication: {format_id_list(server_links)}"
+    ])
+
+@instrument
+def lookup_inventory_index(app_id, kind):
+    # kind is "inventory" or "qanda"; returns None when there is no index or it has no rows for the application
+    path = refresh_inventory_index()
+    if path is None:
+        return None
+    app_id = app_id.strip()
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(
+            "SELECT sheet, record FROM records WHERE kind = ? AND id IN ("
+            " SELECT record_id FROM record_keys WHERE key_type = 'app' AND key = ?"
+            " UNION SELECT k.record_id FROM app_servers s JOIN record_keys k ON k.key_type = 'server' AND k.key = s.server_id"
+            " WHERE s.app_id = ?) ORDER BY id",
+            (kind, app_id, app_id)
+        ).fetchall()
+        neighborhood = lookup_app_neighborhood(connection, app_id) if rows and kind == 'inventory' else None
+    finally:
+        connection.close()
+    add_metric('RecordCount', len(rows))
+    if not rows:
+        return None
+    indexed_info = format_inventory_records(app_id, rows)
+    return f"{indexed_info}\n\n{neighborhood}" if neighborhood else indexed_info
+
+@instrument
+def retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info):
+    indexed_info = lookup_inventory_index(app_id, 'qanda')
+    if indexed_info:
+        return indexed_info
+
+    query = (
+        f"Provide all the information for application ID {app_id}, including the Migration Assessment Questions "
+        f"and the corresponding App team Responses. Format the information as a structured list of questions and answers."
+    )
+
+    try:
+        retrieved_info = query_knowledge_base(kb_id_qanda_info, query, 'kb_qanda')
+        if LOG_PAYLOADS:
+            print(f"Received KB info: {retrieved_info}")
         return retrieved_info
 
     except ClientError as e:
         print(f"Error retrieving information from the Q&A knowledge base: {e}")
-        return ""
+        return UNAVAILABLE_CONTEXT
     
+# S3 requires every part of a multipart upload except the last to be at least 5 MiB
+CSV_PART_BYTES = 5 * 1024 * 1024
+
+@instrument
 def write_csv_to_s3(bucket, key, rows):
+    # rows can be any iterable, e.g. a generator. A CSV of up to CSV_PART_BYTES is written with one put_object;
+    # larger ones become a multipart upload, so memory holds one part rather than the whole CSV.
+    # Imported here rather than during init, since only the final CSV write needs it
+    import csv
+    from io import StringIO
+    csv_buffer = StringIO()
+    writer = csv.writer(csv_buffer)
+    upload_id = None
+    parts = []
+    size = 0
+
+    def upload_part(data):
+        part_number = len(parts) + 1
+        part = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data)
+        parts.append({'PartNumber': part_number, 'ETag': part['ETag']})
+
     try:
-        csv_buffer = StringIO()
-        writer = csv.writer(csv_buffer)
-        writer.writerows(rows)
-        s3.put_object(Bucket=bucket, Key=key, Body=csv_buffer.getvalue())
-    except ClientError as e:
+        for row in rows:
+            writer.writerow(row)
+            if csv_buffer.tell() >= CSV_PART_BYTES:
+                data = csv_buffer.getvalue().encode('utf-8')
+                csv_buffer.seek(0)
+                csv_buffer.truncate()
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType='text/csv')['UploadId']
+                upload_part(data)
+                size += len(data)
+        data = csv_buffer.getvalue().encode('utf-8')
+        size += len(data)
+        if upload_id is None:
+            s3.put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            if data:
+                upload_part(data)
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        add_metric('RequestBytes', size)
+    except Exception as e:
+        # Also when producing the rows fails, so that no incomplete multipart upload is left behind
         logger.error("Error writing CSV to S3: %s", e, exc_info=True)
+        if upload_id is not None:
+            try:
+                s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            except ClientError:
+                logger.warning("Could not abort the multipart upload of %s", key)
         raise
 
+@instrument
 def retrieve_from_app_knowledge_base(app_id, kb_id_migration_agent_info):
+    indexed_info = lookup_inventory_index(app_id, 'inventory')
+    if indexed_info:
+        return indexed_info
+
     # Prepare the query
     query = (
         f"Provide a comprehensive overview of application ID {app_id}, including its description, "
@@ -101,29 +829,17 @@ def retrieve_from_app_knowledge_base(app_id, kb_id_migration_agent_info):
     )
 
     try:
-        # Call the Bedrock KnowledgeBase retrieve_and_generate API
-        response = bedrock_client.retrieve_and_generate(
-            input={
-                'text': query
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_migration_agent_info,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-v2'
-                }
-            }
-        )
-
-        # Extract the relevant information from the response
-        retrieved_info = response['output']['text']
-        print(f"Received KB info: {retrieved_info}")
+        # Query the Bedrock knowledge base
+        retrieved_info = query_knowledge_base(kb_id_migration_agent_info, query, 'kb_application')
+        if LOG_PAYLOADS:
+            print(f"Received KB info: {retrieved_info}")
         return retrieved_info
 
     except ClientError as e:
         print(f"Error retrieving information from the knowledge base: {e}")
-        return ""    
+        return UNAVAILABLE_CONTEXT
     
+@instrument
 def retrieve_from_knowledge_base(kb_id_bp_docs):
     # Prepare the query
     query = (
@@ -135,143 +851,1257 @@ def retrieve_from_knowledge_base(kb_id_bp_docs):
         "Include insights from AWS Migration Lens and other relevant best practices to support your recommendation."
     )
 
+    # The query does not depend on the application, so the same answer can be reused across requests
+    key = cache_key(kb_id_bp_docs, query, model_arn(MODEL_ROUTES['kb_best_practices']), KB_RETRIEVAL_MODE)
+    cached_info = kb_cache.get(key)
+    if cached_info is not None:
+        add_metric('CacheHits', 1)
+        if LOG_PAYLOADS:
+            print(f"Using cached KB info: {cached_info}")
+        return cached_info
+
     try:
-        # Call the Bedrock KnowledgeBase retrieve_and_generate API
-        response = bedrock_client.retrieve_and_generate(
-            input={
-                'text': query
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': kb_id_bp_docs,
-                    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-v2'
+        # Query the Bedrock knowledge base
+        retrieved_info = query_knowledge_base(kb_id_bp_docs, query, 'kb_best_practices')
+        if LOG_PAYLOADS:
+            print(f"Received KB info: {retrieved_info}")
+        if retrieved_info:
+            kb_cache.put(key, retrieved_info)
+        return retrieved_info
+
+    except ClientError as e:
+        print(f"Error retrieving information from the knowledge base: {e}")
+        return UNAVAILABLE_CONTEXT
+
+# Batched retrieval looks up many applications with one metadata-filtered Retrieve call per knowledge base and
+# splits the chunks back out by the application ID stored in each source document's metadata attributes
+KB_BATCH_RETRIEVAL = os.environ.get('KB_BATCH_RETRIEVAL', 'false').lower() == 'true'
+KB_APP_ID_METADATA_KEY = os.environ.get('KB_APP_ID_METADATA_KEY', 'app_id')
+KB_RESULTS_PER_APP = int(os.environ.get('KB_RESULTS_PER_APP', '5'))
+KB_MAX_RESULTS = 100  # Retrieve API limit for numberOfResults
+
+def retrieval_batches(app_ids):
+    batch_size = max(1, KB_MAX_RESULTS // max(1, KB_RESULTS_PER_APP))
+    unique_app_ids = list(dict.fromkeys(app_id.strip() for app_id in app_ids if app_id.strip()))
+    return [unique_app_ids[i:i + batch_size] for i in range(0, len(unique_app_ids), batch_size)]
+
+@instrument
+def retrieve_batch_from_knowledge_base(app_ids, kb_id, query):
+    response = call_knowledge_base(
+        bedrock_client.retrieve,
+        kb_id,
+        knowledgeBaseId=kb_id,
+        retrievalQuery={
+            'text': query
+        },
+        retrievalConfiguration={
+            'vectorSearchConfiguration': {
+                'numberOfResults': min(KB_MAX_RESULTS, KB_RESULTS_PER_APP * len(app_ids)),
+                'filter': {
+                    'in': {
+                        'key': KB_APP_ID_METADATA_KEY,
+                        'value': app_ids
+                    }
                 }
             }
+        }
+    )
+    record_response_metadata(response)
+
+    # Results arrive ranked across the whole batch; cap each application so one cannot crowd out the others
+    results = {app_id: [] for app_id in app_ids}
+    for result in response['retrievalResults']:
+        app_id = str(result.get('metadata', {}).get(KB_APP_ID_METADATA_KEY, '')).strip()
+        if app_id in results and len(results[app_id]) < KB_RESULTS_PER_APP:
+            results[app_id].append(result)
+    return results
+
+def retrieve_batched_app_context(app_ids, kb_id_migration_agent_info, kb_id_qanda_info, max_workers=MAX_WORKERS):
+    # Returns {app_id: (application info, Q&A info)}; a value is None when neither the inventory index nor the
+    # batch had anything for that application, so the caller falls back to the per-application query for it
+    queries = (
+        ('inventory', kb_id_migration_agent_info, (
+            "Provide a comprehensive overview of each application, including its description, business unit, criticality, "
+            "and type, its dependencies on other applications, the server(s) it is associated with, and the databases it utilizes."
+        )),
+        ('qanda', kb_id_qanda_info, "Migration Assessment Questions and the corresponding App team Responses for each application.")
+    )
+
+    def retrieve_batch_safely(batch, kb_id, query):
+        try:
+            return retrieve_batch_from_knowledge_base(batch, kb_id, query)
+        except ClientError as e:
+            print(f"Error retrieving batched information from knowledge base {kb_id}: {e}")
+            return {}
+
+    # Applications found in the inventory index need no knowledge base lookup at all
+    app_ids = [app_id for batch in retrieval_batches(app_ids) for app_id in batch]
+    found = {kind: {} for kind, kb_id, query in queries}
+    jobs = []
+    for kind, kb_id, query in queries:
+        for app_id in app_ids:
+            indexed_info = lookup_inventory_index(app_id, kind)
+            if indexed_info:
+                found[kind][app_id] = indexed_info
+        jobs.extend((kind, batch, kb_id, query) for batch in retrieval_batches([a for a in app_ids if a not in found[kind]]))
+
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+            results = list(executor.map(bind_run_totals(lambda job: retrieve_batch_safely(*job[1:])), jobs))
+        for (kind, batch, kb_id, query), batch_results in zip(jobs, results):
+            for app_id, app_results in batch_results.items():
+                if app_results:
+                    found[kind][app_id] = format_retrieval_results(app_results)
+
+    app_contexts = {app_id: tuple(found[kind].get(app_id) for kind, kb_id, query in queries) for app_id in app_ids}
+    missing = sum(1 for app_context in app_contexts.values() for info in app_context if info is None)
+    logger.info("Batched retrieval: %d applications in %d calls, %d lookups falling back to per-application queries",
+                len(app_contexts), len(jobs), missing)
+    return app_contexts
+
+# Ask the model for JSON matching RECOMMENDATION_SCHEMA; the text parser remains as a fallback
+STRUCTURED_OUTPUT = os.environ.get('STRUCTURED_OUTPUT', 'true').lower() == 'true'
+
+RECOMMENDATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "top_3_recommended_migration_patterns": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "pattern": {"type": "string", "enum": ["Retain", "Retire", "Rehost", "Replatform", "Repurchase", "Refactor"]},
+                    "percentage": {"type": "number"}
+                },
+                "required": ["pattern", "percentage"]
+            }
+        },
+        "justification": {"type": "string"},
+        "potential_aws_architecture": {"type": "string"},
+        "approximate_cost": {"type": "string"}
+    },
+    "required": ["top_3_recommended_migration_patterns", "justification", "potential_aws_architecture", "approximate_cost"]
+}
+
+# Matches section headers such as "2. Justification:", "**2. Justification**", "## Justification" or "2) Justification"
+# but not sentences that merely start with a section name, like "Justification for Rehost is ..."
+SECTION_HEADER = re.compile(
+    r"[ \t]*(?:#{1,6}[ \t]*)?[*_]{0,3}[ \t]*(?:\d{1,2}[ \t]*[.)][ \t]*)?[*_]{0,3}[ \t]*"
+    r"(?:(?P<patterns>top[ \t]*(?:3|three)[ \t]+recommended[ \t]+migration[ \t]+patterns)|(?P<justification>justification)|"
+    r"(?P<architecture>potential[ \t]+aws[ \t]+architecture)|(?P<cost>cost[ \t]+breakdown[^:*_\n]*|approximate[ \t]+cost))"
+    r"[ \t]*[*_]{0,3}[ \t]*(?::|$)",
+    re.IGNORECASE
+)
+SECTION_HEADER_PREFIXES = {'top', 'jus', 'pot', 'cos', 'app'}
+SECTION_NAMES = ('patterns', 'justification', 'architecture', 'cost')
+
+def parse_structured_recommendation(recommendation):
+    # Returns the parsed sections, or None if the response is not JSON matching RECOMMENDATION_SCHEMA
+    start = recommendation.find('{')
+    end = recommendation.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(recommendation[start:end + 1])
+    except ValueError:
+        return None
+
+    if not isinstance(data, dict) or any(key not in data for key in RECOMMENDATION_SCHEMA['required']):
+        return None
+    patterns = data['top_3_recommended_migration_patterns']
+    if not isinstance(patterns, list) or not all(
+        isinstance(p, dict) and isinstance(p.get('pattern'), str) and isinstance(p.get('percentage'), (int, float))
+        for p in patterns
+    ):
+        return None
+    if not all(isinstance(data[key], str) for key in ('justification', 'potential_aws_architecture', 'approximate_cost')):
+        return None
+
+    return (
+        ', '.join(f"{p['pattern']}-{p['percentage']:g}%" for p in patterns),
+        data['justification'].strip(),
+        data['potential_aws_architecture'].strip(),
+        data['approximate_cost'].strip()
+    )
+
+def parse_text_recommendation(recommendation):
+    # Single pass over the lines. The regex only runs on lines whose first word could start a header,
+    # and each section collects its lines in a list that is joined once instead of being built up with +=.
+    sections = {name: [] for name in SECTION_NAMES}
+    current = None
+
+    for line in recommendation.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.lstrip('#*_0123456789.) \t')[:3].lower() in SECTION_HEADER_PREFIXES:
+            header = SECTION_HEADER.match(line)
+            if header:
+                current = sections[header.lastgroup]
+        if current is not None:
+            current.append(line)
+
+    return tuple('\n'.join(sections[name]) for name in SECTION_NAMES)
+
+USAGE_METRICS = {
+    'input_tokens': 'InputTokens',
+    'output_tokens': 'OutputTokens',
+    'cache_read_input_tokens': 'CacheReadInputTokens',
+    'cache_creation_input_tokens': 'CacheWriteInputTokens'
+}
+
+# Per-run totals such as prompt compaction savings and token usage. Every request and every shard starts its own
+# RunTotals on its thread, and the worker threads it starts use the same one through bind_run_totals, so shards
+# processed in one container at the same time keep separate totals.
+class RunTotals:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        # Applications whose prompt was built without part of its context
+        self.degraded_apps = {}
+        # Calls, tokens and seconds per (route, model), for the routing report
+        self.routing = {}
+
+run_totals_context = threading.local()
+# Totals of calls made outside a request or shard, e.g. from scripts
+default_run_totals = RunTotals()
+
+def current_run_totals():
+    return getattr(run_totals_context, 'totals', None) or default_run_totals
+
+def start_run_totals():
+    run_totals_context.totals = RunTotals()
+    return run_totals_context.totals
+
+def bind_run_totals(function):
+    # Runs function, on whichever thread, against the totals of the thread that wrapped it
+    totals = current_run_totals()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = getattr(run_totals_context, 'totals', None)
+        run_totals_context.totals = totals
+        try:
+            return function(*args, **kwargs)
+        finally:
+            run_totals_context.totals = previous
+    return wrapper
+
+def add_to_run_totals(**values):
+    totals = current_run_totals()
+    with totals.lock:
+        for name, value in values.items():
+            totals.values[name] = totals.values.get(name, 0) + value
+
+def record_compaction(app_id, stats):
+    logger.info("Prompt compaction for %s saved %d of %d estimated tokens", app_id, stats['tokens_saved'], stats['tokens_before'])
+    add_to_run_totals(prompts=1, prompt_tokens_before=stats['tokens_before'], prompt_tokens_after=stats['tokens_after'])
+
+def record_degraded_context(app_id, sections):
+    degraded = degraded_sections(sections)
+    if degraded:
+        logger.warning("Assessing application %s without the %s context", app_id, ', '.join(degraded))
+        add_metric('DegradedContext', len(degraded))
+        add_to_run_totals(degraded_context=1)
+        totals = current_run_totals()
+        with totals.lock:
+            totals.degraded_apps[app_id] = degraded
+
+def record_usage(usage):
+    # Cache read and write counts are only present when prompt caching is in use
+    tokens = {name: usage.get(name, 0) or 0 for name in USAGE_METRICS}
+    add_to_run_totals(**tokens)
+    for name, metric_name in USAGE_METRICS.items():
+        add_metric(metric_name, tokens[name])
+
+def record_model_call(route, model_id, input_tokens, output_tokens, seconds):
+    run_totals = current_run_totals()
+    with run_totals.lock:
+        totals = run_totals.routing.setdefault((route, model_id), {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'seconds': 0.0})
+        totals['calls'] += 1
+        totals['input_tokens'] += input_tokens
+        totals['output_tokens'] += output_tokens
+        totals['seconds'] += seconds
+
+def estimate_model_call(model_id, input_tokens, output_tokens):
+    # (USD, seconds of generation) for a model in MODEL_PROFILES; unknown models count as free and instant
+    profile = MODEL_PROFILES.get(model_id)
+    if profile is None:
+        return 0.0, 0.0
+    return (input_tokens * profile['input'] + output_tokens * profile['output']) / 1000, output_tokens / profile['output_tokens_per_second']
+
+def routing_report():
+    # Per route: the model used, its calls, tokens, measured seconds and estimated cost, next to the estimated cost and
+    # seconds of the same tokens on the baseline model. The baseline latency swaps the estimated generation time of
+    # the routed model for that of the baseline model.
+    run_totals = current_run_totals()
+    with run_totals.lock:
+        items = [(route, model_id, dict(totals)) for (route, model_id), totals in run_totals.routing.items()]
+    routes = {}
+    for route, model_id, totals in items:
+        cost, generation_seconds = estimate_model_call(model_id, totals['input_tokens'], totals['output_tokens'])
+        baseline_model_id = BASELINE_MODEL_ROUTES.get(route)
+        if baseline_model_id is None:
+            baseline_cost, baseline_seconds = 0.0, 0.0
+        else:
+            baseline_cost, baseline_generation_seconds = estimate_model_call(baseline_model_id, totals['input_tokens'], totals['output_tokens'])
+            baseline_seconds = max(0.0, totals['seconds'] - generation_seconds) + baseline_generation_seconds
+        routes[f"{route}:{model_id}"] = dict(totals, route=route, model_id=model_id, baseline_model_id=baseline_model_id,
+                                            cost_usd=round(cost, 6), baseline_cost_usd=round(baseline_cost, 6),
+                                            seconds=round(totals['seconds'], 3), baseline_seconds=round(baseline_seconds, 3))
+    summary = {name: round(sum(route[name] for route in routes.values()), 6)
+               for name in ('calls', 'cost_usd', 'baseline_cost_usd', 'seconds', 'baseline_seconds')}
+    summary['savings_usd'] = round(summary['baseline_cost_usd'] - summary['cost_usd'], 6)
+    summary['seconds_saved'] = round(summary['baseline_seconds'] - summary['seconds'], 3)
+    return {'routes': routes, 'summary': summary}
+
+def log_routing_report():
+    report = routing_report()
+    logger.info("Model routing report: %s", json.dumps(report))
+    summary = report['summary']
+    emit_metrics('routing', {'EstimatedCostUSD': summary['cost_usd'], 'BaselineCostUSD': summary['baseline_cost_usd'],
+                             'RoutingSavingsUSD': summary['savings_usd']})
+    return report
+
+@instrument
+def parse_recommendation(recommendation):
+    add_metric('RequestBytes', len(recommendation.encode('utf-8')))
+    parsed = parse_structured_recommendation(recommendation)
+    if parsed is None:
+        if STRUCTURED_OUTPUT:
+            logger.warning("Recommendation is not valid structured output, falling back to the text parser")
+        parsed = parse_text_recommendation(recommendation)
+    return parsed
+
+# Obvious Retire and Retain cases are decided by rules over the inventory index attributes, without retrieval or a
+# model call. Each rule matches a field (column name, or question for Q&A rows) and a value (cell or response)
+# with case-insensitive regular expressions, optionally only for one kind of row ("inventory" or "qanda"). A rule
+# without a disposition takes it from the value's "disposition" group. Rules with the disposition Active mark
+# evidence that the application is still in use; they disagree with every other rule, so the application goes to the
+# model. Replace the defaults with a JSON list in PRECLASSIFIER_RULES.
+PRECLASSIFY = os.environ.get('PRECLASSIFY', 'true').lower() == 'true'
+DEFAULT_PRECLASSIFIER_RULES = [
+    {'name': 'explicit-disposition', 'field': r'\b(disposition|migration (decision|strategy|pattern))\b',
+     'value': r'^(?P<disposition>retire|retain)\b'},
+    {'name': 'decommissioned', 'disposition': 'Retire', 'field': r'\b(status|lifecycle|life cycle|state)\b',
+     'value': r'^(decommissioned|decommissioning|retired|retiring|end[- ]of[- ]life|eol|sunset)\b'},
+    {'name': 'no-users', 'disposition': 'Retire', 'field': r'\busers?\b|users$',
+     'value': r'^(0+|none|no users)$'},
+    {'name': 'qanda-decommissioned', 'disposition': 'Retire', 'kind': 'qanda', 'field': r'end of (its )?(support|life)|lifecycle|still (used|in use)',
+     'value': r'^(yes\b.*\b(decommission|retire|end of life)|(it is |it will be )?(being |scheduled to be )?decommissioned\b|no longer (used|in use))'},
+    {'name': 'must-stay-on-premises', 'disposition': 'Retain', 'field': r'\b(status|disposition|constraint|hosting)\b',
+     'value': r'\b(must (remain|stay)|retain(ed)?) on[- ]prem'},
+    {'name': 'active-status', 'disposition': 'Active', 'field': r'\b(status|lifecycle|life cycle|state)\b',
+     'value': r'^(active|in use|in production|production|live|operational)\b'},
+    {'name': 'has-users', 'disposition': 'Active', 'field': r'\busers?\b|users$',
+     'value': r'^0*[1-9][\d,]*\+?$'},
+    {'name': 'qanda-in-use', 'disposition': 'Active', 'kind': 'qanda', 'field': r'still (used|in use)',
+     'value': r'^yes\b(?!.*\b(decommission|retire|end of life))'}
+]
+
+def load_preclassifier_rules():
+    rules = json.loads(os.environ['PRECLASSIFIER_RULES']) if os.environ.get('PRECLASSIFIER_RULES') else DEFAULT_PRECLASSIFIER_RULES
+    return [dict(rule, field=re.compile(rule['field'], re.IGNORECASE), value=re.compile(rule['value'], re.IGNORECASE))
+            for rule in rules]
+
+PRECLASSIFIER_RULES = load_preclassifier_rules()
+
+def id_columns(record):
+    # Application and server ID columns, named the way build-inventory-index.py recognizes them
+    normalized = {column: re.sub(r'[^a-z0-9]', '', column.lower()) for column in record}
+    app_columns = [column for column, name in normalized.items() if name.endswith(('appid', 'applicationid'))]
+    server_columns = [column for column, name in normalized.items() if name.endswith('serverid')]
+    return app_columns, server_columns
+
+def is_own_record(app_id, record):
+    # Rows that only describe this application. Server mapping rows carry the status of a server, and dependency
+    # rows name other applications whose status says nothing about this one.
+    app_columns, server_columns = id_columns(record)
+    app_ids = {record[column].strip().lower() for column in app_columns if record.get(column)}
+    return app_ids == {app_id.strip().lower()} and not any(record.get(column) for column in server_columns)
+
+def load_app_attributes(app_id):
+    # (kind, sheet, field, value) for the application's own inventory rows and its Q&A answers
+    path = refresh_inventory_index()
+    if path is None:
+        return []
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(
+            "SELECT r.kind, r.sheet, r.record FROM records r JOIN record_keys k ON k.record_id = r.id"
+            " WHERE k.key_type = 'app' AND k.key = ? ORDER BY r.id", (app_id.strip(),)
+        ).fetchall()
+    finally:
+        connection.close()
+
+    attributes = []
+    for kind, sheet, record in rows:
+        record = json.loads(record)
+        if not is_own_record(app_id, record):
+            continue
+        question = next((v for c, v in record.items() if 'question' in c.lower()), None)
+        answer = next((v for c, v in record.items() if re.search(r'response|answer', c, re.IGNORECASE)), None)
+        if kind == 'qanda' and question is not None and answer is not None:
+            attributes.append((kind, sheet, question, answer))
+        else:
+            attributes.extend((kind, sheet, column, value) for column, value in record.items() if value)
+    return attributes
+
+def preclassify_application(app_id, rules=PRECLASSIFIER_RULES):
+    # Returns a CSV row when every matching rule agrees on one disposition, or None to send the app to the model
+    matches = []
+    for kind, sheet, field, value in load_app_attributes(app_id):
+        for rule in rules:
+            if rule.get('kind', kind) == kind and rule['field'].search(field) and rule['value'].search(value):
+                disposition = rule.get('disposition') or rule['value'].search(value).group('disposition')
+                matches.append((disposition.capitalize(), f"{rule['name']}: {sheet} / {field} = {value}"))
+    dispositions = {disposition for disposition, reason in matches}
+    if 'Active' in dispositions and len(dispositions) > 1:
+        logger.info("Application %s is still in use (%s); using the model", app_id,
+                    '; '.join(reason for disposition, reason in matches if disposition == 'Active'))
+        return None
+    if len(dispositions) != 1 or 'Active' in dispositions:
+        if len(dispositions) > 1:
+            logger.info("Rules disagree for application %s (%s); using the model", app_id, ', '.join(sorted(dispositions)))
+        return None
+
+    disposition = dispositions.pop()
+    reasons = '\n'.join(f"- {reason}" for disposition, reason in matches)
+    return [
+        app_id,
+        f"{disposition}-100%",
+        f"Pre-classified as {disposition} by deterministic rules on the inventory and Q&A data:\n{reasons}",
+        "Not applicable: the application is not migrated to AWS.",
+        "No AWS cost: the application is not migrated to AWS."
+    ]
+
+def preclassify_applications(app_ids):
+    # Returns {app_id: row} for the applications decided by rules
+    preclassified = {}
+    for app_id in dict.fromkeys(app_ids):
+        try:
+            row = preclassify_application(app_id)
+        except (sqlite3.Error, re.error, KeyError, IndexError) as e:
+            logger.warning("Pre-classification failed for application %s: %s", app_id, e)
+            row = None
+        if row is not None:
+            preclassified[app_id] = row
+    if preclassified:
+        # Each pre-classified application saves its model generation and both of its knowledge base queries
+        add_to_run_totals(preclassified=len(preclassified), llm_calls_avoided=len(preclassified))
+        emit_metrics('preclassify', {'LlmCallsAvoided': len(preclassified)})
+    logger.info("Pre-classified %d of %d applications", len(preclassified), len(set(app_ids)))
+    return preclassified
+
+def retrieve_app_context(app_id, kb_id_migration_agent_info, kb_id_qanda_info, app_context=None):
+    # app_context holds the (application info, Q&A info) found by batched retrieval, if any; the missing parts are
+    # retrieved per application
+    retrieved_app_info, qanda_info = app_context or (None, None)
+    if retrieved_app_info is None:
+        retrieved_app_info = retrieve_from_app_knowledge_base(app_id, kb_id_migration_agent_info)
+    if qanda_info is None:
+        qanda_info = retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info)
+    return retrieved_app_info, qanda_info
+
+# Identifies the assessment prompt and its parsing; change it whenever they change so that incremental runs assess
+# every application again
+PROMPT_VERSION = '1'
+
+def input_fingerprint(app_context):
+    # Hash of everything application-specific that feeds an assessment. It is only stable across runs when the
+    # inputs are: rows from the inventory index and chunks from KB_RETRIEVAL_MODE=retrieve are, while summaries
+    # generated by RetrieveAndGenerate usually differ from call to call.
+    retrieved_app_info, qanda_info = app_context
+    return cache_key(PROMPT_VERSION, STRUCTURED_OUTPUT, retrieved_app_info, qanda_info)
+
+def build_assessment_prompt(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, app_context=None):
+    retrieved_app_info, qanda_info = retrieve_app_context(app_id, kb_id_migration_agent_info, kb_id_qanda_info, app_context)
+
+    # The best-practices section comes first so it is never deduplicated away and stays identical across apps
+    prompt_context, stats = compact_context([
+        ('best_practices', retrieved_info),
+        ('application', retrieved_app_info),
+        ('qanda', qanda_info)
+    ])
+    record_compaction(app_id, stats)
+    record_degraded_context(app_id, [('application', retrieved_app_info), ('Q&A', qanda_info)])
+
+    # Everything that is the same for every application goes into the prefix so it can be served from the
+    # Bedrock prompt cache; only the application-specific data follows it
+    prompt_prefix = (
+        "As an AWS migration expert, your task is to analyze the application migration readiness data that follows these instructions and recommend the most suitable migration patterns for migrating the application to AWS. The migration patterns to consider are:\n"
+        "- Retain\n"
+        "- Retire\n"
+        "- Rehost\n"
+        "- Replatform\n"
+        "- Repurchase\n"
+        "- Refactor\n\n"
+        "In addition to the application migration readiness data, consider the following relevant information retrieved from the knowledge base:\n"
+        f"{prompt_context['best_practices']}\n\n"
+        "When providing your recommendation, please ensure that all suggestions are directly supported by the information provided in the application migration readiness data, the application-specific information, and the Q&A information. If a recommendation is based on an assumption or information not explicitly mentioned in the data, please clarify that in your response.\n\n"
+        "Please include the following details in your recommendation:\n"
+        "1. Top 3 Recommended Migration Patterns: [Provide the top 3 recommended migration patterns along with their respective percentages, e.g., Refactor-70%, Replatform-20%, Rehost-10%]\n"
+        "2. Justification: [For each recommended migration pattern, provide a detailed explanation of why it is suitable based on the application's characteristics, requirements, and migration goals. Analyze the key factors that influenced your decision, taking into account the complexity, time/velocity, cost, and optimization considerations. Cite specific information from the application readiness data, the application-specific information, and the Q&A information that supports your recommendation.]\n"
+        "3. Potential AWS Architecture: [For each recommended migration pattern, provide a high-level description of the potential AWS architecture that could be implemented. Include the key AWS services, components, and architectural patterns that align with the migration pattern and the application's requirements.]\n"
+        "4. Cost Breakdown and Total Cost for each Migration Pattern: [For each recommended migration pattern, provide a detailed cost breakdown at the AWS resource level, listing the individual AWS services, their pricing models (e.g., hourly, monthly, data transfer), and the estimated costs based on the application's requirements and usage patterns. Additionally, provide the total estimated cost for implementing each migration pattern's AWS architecture, considering all relevant factors.]"
+    )
+    if STRUCTURED_OUTPUT:
+        prompt_prefix += (
+            "\n\nProvide your response as a single JSON object, with no text before or after it, that matches this JSON schema:\n"
+            f"{json.dumps(RECOMMENDATION_SCHEMA)}\n"
+            "List the top 3 recommended migration patterns with percentages that add up to 100. Use newlines and bullet points inside "
+            "the justification, potential_aws_architecture and approximate_cost strings to keep them readable.\n\n"
         )
+    else:
+        prompt_prefix += "\n\nProvide your response in a clear, well-structured format, using bullet points, numbering, or headings as appropriate to enhance readability.\n\n"
 
-        # Extract the relevant information from the response
-        retrieved_info = response['output']['text']
-        print(f"Received KB info: {retrieved_info}")
-        return retrieved_info
+    prompt = (
+        "Application-specific information:\n"
+        f"{prompt_context['application']}\n\n"
+        "Application Q&A information:\n"
+        f"{prompt_context['qanda']}\n\n"
+        "Please provide your detailed recommendation based on the above information, guidelines, and the retrieved insights from the knowledge base, including the application-specific information and Q&A information. Ensure that all suggestions are supported by the provided data. If additional information is required to make a more accurate recommendation, please state the specific details needed."
+    )
+    if LOG_PAYLOADS:
+        print(f"Received final prompt: {prompt_prefix}{prompt}")
+    return prompt_prefix, prompt
+
+# Each application's result is saved under a run-scoped prefix as soon as it completes, so a run that stops early
+# (e.g. close to the Lambda timeout) can be resumed without repeating finished applications, and concurrent runs
+# never write to the same keys
+RUN_PREFIX = os.environ.get('RUN_PREFIX', 'R-Disposition-runs')
+RUN_TIMEOUT_MARGIN_MS = int(os.environ.get('RUN_TIMEOUT_MARGIN_MS', '60000'))
+CSV_HEADER = ['App-id', 'Top 3 Recommended Migration Patterns', 'Justification', 'Potential AWS Architecture', 'Approximate Cost']
+
+def new_run_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+def app_result_key(run_id, app_id):
+    return f"{RUN_PREFIX}/{run_id}/apps/{quote(app_id.strip(), safe='')}.json"
+
+def save_run_manifest(bucket, run_id, app_ids, output_csv_key, shards=None, previous_run_id=None):
+    s3.put_object(Bucket=bucket, Key=f"{RUN_PREFIX}/{run_id}/run.json", Body=json.dumps({
+        'run_id': run_id,
+        'app_ids': app_ids,
+        'output_csv_key': output_csv_key,
+        'shards': shards,
+        'previous_run_id': previous_run_id
+    }))
+
+def load_run_manifest(bucket, run_id):
+    return json.loads(s3.get_object(Bucket=bucket, Key=f"{RUN_PREFIX}/{run_id}/run.json")['Body'].read())
+
+@instrument
+def save_app_result(bucket, run_id, app_id, row, response, status, fingerprint=None):
+    # status is "complete", "preclassified", "reused" or "failed"; failed applications are assessed again on resume.
+    # fingerprint is the input_fingerprint the row was produced from, if any.
+    body = json.dumps({
+        'app_id': app_id,
+        'status': status,
+        'row': row,
+        'response': response,
+        'fingerprint': fingerprint,
+        'degraded_context': current_run_totals().degraded_apps.get(app_id, []),
+        'completed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    })
+    add_metric('RequestBytes', len(body))
+    s3.put_object(Bucket=bucket, Key=app_result_key(run_id, app_id), Body=body)
+
+def list_run_keys(bucket, prefix):
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return keys
 
+def load_app_results(bucket, run_id, max_workers=MAX_WORKERS, app_ids=None):
+    # {app_id: saved result} for every application saved under the run, or only for app_ids when given
+    def load(key):
+        try:
+            return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    if app_ids is None:
+        keys = list_run_keys(bucket, f"{RUN_PREFIX}/{run_id}/apps/")
+    else:
+        keys = [app_result_key(run_id, app_id) for app_id in app_ids]
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as executor:
+        return {result['app_id']: result for result in executor.map(load, keys) if result is not None}
+
+# Optional dataset written next to the CSV for Athena or DuckDB. It holds JSON Lines or Parquet files under
+# OUTPUT_DATASET_PREFIX/run_id=<run>/top_pattern=<pattern>/. The patterns, their percentages and the cost estimate
+# are typed columns. Rows are buffered per partition, and a part file is written every DATASET_PART_ROWS rows, so
+# memory does not grow with the portfolio.
+OUTPUT_DATASET = os.environ.get('OUTPUT_DATASET', '').lower()
+OUTPUT_DATASET_PREFIX = os.environ.get('OUTPUT_DATASET_PREFIX', 'R-Disposition-dataset')
+DATASET_PART_ROWS = int(os.environ.get('DATASET_PART_ROWS', '1000'))
+DATASET_COLUMNS = [
+    ('app_id', 'string'),
+    ('pattern_1', 'string'), ('pattern_1_percentage', 'double'),
+    ('pattern_2', 'string'), ('pattern_2_percentage', 'double'),
+    ('pattern_3', 'string'), ('pattern_3_percentage', 'double'),
+    ('cost_estimate_usd', 'double'), ('cost_period', 'string'),
+    ('status', 'string'), ('degraded_context', 'string'),
+    ('patterns', 'string'), ('justification', 'string'), ('architecture', 'string'), ('approximate_cost', 'string')
+]
+PATTERN_PERCENTAGE = re.compile(r"\b(Retain|Retire|Rehost|Replatform|Repurchase|Refactor|Relocate)\b\W{0,3}(\d+(?:\.\d+)?)\s*%", re.IGNORECASE)
+COST_AMOUNT = re.compile(r"\$\s?(\d[\d,]*(?:\.\d+)?)\s*([km]\b)?(?:\s*(?:/|per)\s*(hour|hr|month|mo|year|yr|annum)\b)?", re.IGNORECASE)
+COST_MULTIPLIERS = {'k': 1e3, 'm': 1e6}
+COST_PERIODS = {'hour': 'hour', 'hr': 'hour', 'month': 'month', 'mo': 'month', 'year': 'year', 'yr': 'year', 'annum': 'year'}
+
+def extract_cost_estimate(approximate_cost):
+    # (USD, period) of the largest amount on the lines that mention a total, or of the largest amount anywhere;
+    # (None, None) without a dollar amount
+    lines = approximate_cost.splitlines()
+    total_lines = [line for line in lines if 'total' in line.lower()]
+    amounts = []
+    for line in total_lines or lines:
+        for number, multiplier, period in COST_AMOUNT.findall(line):
+            amounts.append((float(number.replace(',', '')) * COST_MULTIPLIERS.get(multiplier.lower(), 1), COST_PERIODS.get(period.lower())))
+    if not amounts:
+        return None, None
+    return max(amounts, key=lambda amount: amount[0])
+
+def dataset_record(row, status=None, degraded_context=()):
+    app_id, patterns, justification, aws_architecture, approximate_cost = row
+    ranked = sorted(((name.capitalize(), float(percentage)) for name, percentage in PATTERN_PERCENTAGE.findall(patterns)),
+                    key=lambda pattern: -pattern[1])[:3]
+    record = {'app_id': app_id}
+    for index in range(3):
+        name, percentage = ranked[index] if index < len(ranked) else (None, None)
+        record[f'pattern_{index + 1}'] = name
+        record[f'pattern_{index + 1}_percentage'] = percentage
+    record['cost_estimate_usd'], record['cost_period'] = extract_cost_estimate(approximate_cost)
+    record.update({
+        'status': status or ('failed' if patterns.startswith('Error:') else 'complete'),
+        'degraded_context': ', '.join(degraded_context),
+        'patterns': patterns,
+        'justification': justification,
+        'architecture': aws_architecture,
+        'approximate_cost': approximate_cost
+    })
+    return record
+
+class DatasetWriter:
+    def __init__(self, bucket, run_id, dataset_format=OUTPUT_DATASET, prefix=OUTPUT_DATASET_PREFIX, part_rows=DATASET_PART_ROWS):
+        if dataset_format not in ('jsonl', 'parquet'):
+            raise ValueError(f"OUTPUT_DATASET must be jsonl or parquet, not {dataset_format}")
+        if dataset_format == 'parquet':
+            # pyarrow is only needed for Parquet output; add it to the deployment package or a Lambda layer
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("OUTPUT_DATASET=parquet requires pyarrow; install it or use OUTPUT_DATASET=jsonl")
+            self.pyarrow = pyarrow
+            self.parquet = pyarrow.parquet
+            types = {'string': pyarrow.string(), 'double': pyarrow.float64()}
+            self.schema = pyarrow.schema([(name, types[column_type]) for name, column_type in DATASET_COLUMNS])
+        self.bucket = bucket
+        self.run_id = run_id
+        self.dataset_format = dataset_format
+        self.prefix = prefix.rstrip('/')
+        self.part_rows = max(1, part_rows)
+        self.buffers = {}
+        self.keys = []
+
+    def write(self, record):
+        partition = record['pattern_1'] or 'Unknown'
+        buffer = self.buffers.setdefault(partition, [])
+        buffer.append(record)
+        if len(buffer) >= self.part_rows:
+            self.flush(partition)
+
+    def flush(self, partition):
+        records = self.buffers.pop(partition, [])
+        if not records:
+            return
+        extension = 'parquet' if self.dataset_format == 'parquet' else 'jsonl'
+        key = f"{self.prefix}/run_id={quote(self.run_id, safe='')}/top_pattern={partition}/part-{len(self.keys):05d}.{extension}"
+        if self.dataset_format == 'parquet':
+            stream = self.pyarrow.BufferOutputStream()
+            self.parquet.write_table(self.pyarrow.Table.from_pylist(records, schema=self.schema), stream, compression='snappy')
+            body = stream.getvalue().to_pybytes()
+        else:
+            body = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+        self.keys.append(key)
+
+    def close(self):
+        for partition in list(self.buffers):
+            self.flush(partition)
+        logger.info("Wrote %d %s dataset files for run %s under %s", len(self.keys), self.dataset_format, self.run_id, self.prefix)
+        return self.keys
+
+def write_recommendation_dataset(bucket, run_id, rows):
+    # For the paths that already hold every row: batch collection and the in-memory fallback of sync runs
+    if not OUTPUT_DATASET:
+        return None
+    dataset = DatasetWriter(bucket, run_id)
+    for row in rows:
+        dataset.write(dataset_record(row))
+    return dataset.close()
+
+def merge_app_results(bucket, run_id, max_workers=MAX_WORKERS):
+    # Builds the CSV, and the dataset if OUTPUT_DATASET is set, from the saved per-application results in the order of
+    # the run's app_ids. Returns the CSV key, or None if some applications have no saved result yet. Results are
+    # loaded DATASET_PART_ROWS at a time and streamed into the CSV and the dataset, so neither the results nor the
+    # rows of the whole run are ever in memory together.
+    manifest = load_run_manifest(bucket, run_id)
+    saved_keys = set(list_run_keys(bucket, f"{RUN_PREFIX}/{run_id}/apps/"))
+    missing = [app_id for app_id in manifest['app_ids'] if app_result_key(run_id, app_id) not in saved_keys]
+    if missing:
+        logger.info("Run %s is missing results for %d applications", run_id, len(missing))
+        return None
+    dataset = DatasetWriter(bucket, run_id) if OUTPUT_DATASET else None
+    app_ids = manifest['app_ids']
+
+    def merged_rows():
+        yield CSV_HEADER
+        for start in range(0, len(app_ids), DATASET_PART_ROWS):
+            chunk = app_ids[start:start + DATASET_PART_ROWS]
+            results = load_app_results(bucket, run_id, max_workers, chunk)
+            for app_id in chunk:
+                if dataset is not None:
+                    dataset.write(dataset_record(results[app_id]['row'], results[app_id]['status'], results[app_id].get('degraded_context', [])))
+                yield results[app_id]['row']
+
+    write_csv_to_s3(bucket, manifest['output_csv_key'], merged_rows())
+    if dataset is not None:
+        dataset.close()
+    # The latest complete run is the default baseline of incremental runs
+    s3.put_object(Bucket=bucket, Key=f"{RUN_PREFIX}/latest.json", Body=json.dumps({'run_id': run_id}))
+    # Written last, so that a run with this marker has all of its outputs
+    s3.put_object(Bucket=bucket, Key=merged_marker_key(run_id), Body=json.dumps({'output_csv_key': manifest['output_csv_key']}))
+    return manifest['output_csv_key']
+
+def merged_marker_key(run_id):
+    return f"{RUN_PREFIX}/{run_id}/merged.json"
+
+def load_merged_csv_key(bucket, run_id):
+    # The CSV key of a run whose results have been merged, or None
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=merged_marker_key(run_id))['Body'].read())['output_csv_key']
     except ClientError as e:
-        print(f"Error retrieving information from the knowledge base: {e}")
-        return ""
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
 
-def parse_recommendation(recommendation):
-    patterns = ''
-    justification = ''
-    aws_architecture = ''
-    approximate_cost = ''
+def load_latest_run_id(bucket):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=f"{RUN_PREFIX}/latest.json")['Body'].read())['run_id']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
 
-    sections = recommendation.split('\n')
-    
-    in_patterns = False
-    in_justification = False
-    in_architecture = False
-    in_cost = False
+def load_previous_results(bucket, previous_run_id, app_ids, max_workers=MAX_WORKERS):
+    # Results of the baseline run that can be reused when their fingerprint still matches
+    if previous_run_id is None:
+        logger.info("No previous run to compare with; every application is assessed")
+        return {}
+    return {app_id: result for app_id, result in load_app_results(bucket, previous_run_id, max_workers, app_ids).items()
+            if result['status'] in ('complete', 'reused') and result.get('fingerprint')}
 
-    for line in sections:
-        line = line.strip()
-        
-        if line.startswith('1. Top 3 Recommended Migration Patterns:'):
-            in_patterns = True
-            in_justification = False
-            in_architecture = False
-            in_cost = False
-            patterns += line + '\n'
-        elif line.startswith('2. Justification:'):
-            in_justification = True
-            in_patterns = False
-            in_architecture = False
-            in_cost = False
-            justification += line + '\n'
-        elif line.startswith('3. Potential AWS Architecture:'):
-            in_architecture = True
-            in_patterns = False
-            in_justification = False
-            in_cost = False
-            aws_architecture += line + '\n'
-        elif line.startswith('4. Cost Breakdown and Total Cost for each Migration Pattern:'):
-            in_cost = True
-            in_patterns = False
-            in_justification = False
-            in_architecture = False
-            approximate_cost += line + '\n'
+def assessment_route(app_id, prompt):
+    if app_id in current_run_totals().degraded_apps or estimate_tokens(prompt) > COMPLEX_APP_PROMPT_TOKENS:
+        return 'assessment_complex'
+    return 'assessment_simple'
+
+def recommendation_confidence(parsed):
+    # Percentage of the top recommended pattern; 0 when a section is missing or no percentage can be read
+    percentages = [float(value) for value in re.findall(r"(\d+(?:\.\d+)?)\s*%", parsed[0])]
+    if not all(parsed) or not percentages:
+        return 0.0
+    return max(percentages)
+
+def assess_application(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, bypass_cache=RESPONSE_CACHE_BYPASS, app_context=None):
+    set_metrics_app_id(app_id)
+    prompt_prefix, prompt = build_assessment_prompt(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, app_context)
+    route = assessment_route(app_id, prompt)
+    recommendation = invoke_bedrock_model(prompt, bypass_cache, prompt_prefix, route)
+    parsed = parse_recommendation(recommendation)
+    if (route == 'assessment_simple' and MODEL_ROUTES[route] != MODEL_ROUTES['assessment_escalation']
+            and recommendation_confidence(parsed) < ESCALATION_CONFIDENCE):
+        logger.info("Escalating application %s: top pattern confidence %.0f%% is below %.0f%%", app_id, recommendation_confidence(parsed), ESCALATION_CONFIDENCE)
+        add_to_run_totals(escalations=1)
+        recommendation = invoke_bedrock_model(prompt, bypass_cache, prompt_prefix, 'assessment_escalation')
+        parsed = parse_recommendation(recommendation)
+    patterns, justification, aws_architecture, approximate_cost = parsed
+    degraded = current_run_totals().degraded_apps.get(app_id)
+    if degraded:
+        justification = f"Warning: assessed without the {', '.join(degraded)} context because the knowledge base lookup failed.\n{justification}"
+    return [app_id, patterns, justification, aws_architecture, approximate_cost], recommendation
+
+def assess_application_safely(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, bypass_cache=RESPONSE_CACHE_BYPASS, app_context=None):
+    # A failure in one application must not lose the rows already produced for the others; the raw
+    # recommendation is None when the assessment failed
+    try:
+        return assess_application(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, bypass_cache, app_context)
+    except Exception as e:
+        logger.error("Error assessing application %s: %s", app_id, e, exc_info=True)
+        return [app_id, f"Error: assessment failed ({e})", '', '', ''], None
+
+def assess_applications(app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, max_workers=MAX_WORKERS, bypass_cache=RESPONSE_CACHE_BYPASS, batch_retrieval=KB_BATCH_RETRIEVAL, preclassify=PRECLASSIFY, run=None):
+    # Run the per-application retrieval and recommendation pipeline with bounded concurrency.
+    # executor.map yields results in input order, so the CSV rows follow the order of app_ids.
+    # With a run ({'bucket', 'run_id', 'context', 'completed'}), every result is saved as soon as it is ready,
+    # applications in run['completed'] are not assessed again, and no new application is started close to the
+    # Lambda timeout; the rows of applications that were not started are None. An incremental run also has
+    # run['previous'], the results of an earlier run: an application whose input fingerprint is unchanged reuses
+    # the earlier row instead of calling the model.
+    completed = run['completed'] if run is not None else {}
+    previous = run.get('previous', {}) if run is not None else {}
+    pending_app_ids = [app_id for app_id in app_ids if app_id not in completed]
+    preclassified = preclassify_applications(pending_app_ids) if preclassify else {}
+    pending_app_ids = [app_id for app_id in pending_app_ids if app_id not in preclassified]
+    app_contexts = retrieve_batched_app_context(pending_app_ids, kb_id_migration_agent_info, kb_id_qanda_info, max_workers) if batch_retrieval else {}
+
+    def assess(app_id):
+        if app_id in completed:
+            return completed[app_id]
+        if run is not None and run['context'] is not None and run['context'].get_remaining_time_in_millis() < RUN_TIMEOUT_MARGIN_MS:
+            return None
+        fingerprint = None
+        if app_id in preclassified:
+            row, recommendation, status = preclassified[app_id], None, 'preclassified'
         else:
-            if in_patterns and line:
-                patterns += line + '\n'
-            elif in_justification and line:
-                justification += line + '\n'
-            elif in_architecture and line:
-                aws_architecture += line + '\n'
-            elif in_cost and line:
-                approximate_cost += line + '\n'
-    
-    patterns = patterns.strip()
-    justification = justification.strip()
-    aws_architecture = aws_architecture.strip()
-    approximate_cost = approximate_cost.strip()
+            app_context = app_contexts.get(app_id.strip())
+            try:
+                app_context = retrieve_app_context(app_id, kb_id_migration_agent_info, kb_id_qanda_info, app_context)
+                if not degraded_sections([('application', app_context[0]), ('Q&A', app_context[1])]):
+                    fingerprint = input_fingerprint(app_context)
+            except Exception as e:
+                logger.error("Error retrieving the context of application %s: %s", app_id, e, exc_info=True)
+            prior = previous.get(app_id)
+            if fingerprint is not None and prior is not None and prior['fingerprint'] == fingerprint:
+                row, recommendation, status = prior['row'], prior['response'], 'reused'
+                add_to_run_totals(reused=1, llm_calls_avoided=1)
+            else:
+                row, recommendation = assess_application_safely(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, bypass_cache, app_context)
+                status = 'failed' if recommendation is None else 'complete'
+        if run is not None:
+            try:
+                save_app_result(run['bucket'], run['run_id'], app_id, row, recommendation, status, fingerprint)
+            except ClientError as e:
+                logger.error("Error saving the result for application %s: %s", app_id, e, exc_info=True)
+        return row
+
+    max_workers = max(1, min(max_workers, len(app_ids)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(bind_run_totals(assess), app_ids))
+
+def batch_record_id(index):
+    # Batch inference record IDs are 11 alphanumeric characters
+    return f"APP{index:08d}"
+
+def build_assessment_prompts(app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, max_workers=MAX_WORKERS, batch_retrieval=KB_BATCH_RETRIEVAL):
+    # Returns the prompt for every application in input order, or the error that prevented building it
+    app_contexts = retrieve_batched_app_context(app_ids, kb_id_migration_agent_info, kb_id_qanda_info, max_workers) if batch_retrieval else {}
+
+    def build_prompt_safely(app_id):
+        try:
+            return ''.join(build_assessment_prompt(app_id, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, app_contexts.get(app_id.strip()))), None
+        except Exception as e:
+            logger.error("Error building prompt for application %s: %s", app_id, e, exc_info=True)
+            return None, str(e)
+
+    max_workers = max(1, min(max_workers, len(app_ids)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(bind_run_totals(build_prompt_safely), app_ids))
+
+def submit_batch_assessment(bucket, app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, output_csv_key, max_workers=MAX_WORKERS, batch_retrieval=KB_BATCH_RETRIEVAL, preclassify=PRECLASSIFY):
+    run_prefix = f"{BATCH_PREFIX}/{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    preclassified = preclassify_applications(app_ids) if preclassify else {}
+    pending_app_ids = [app_id for app_id in app_ids if app_id not in preclassified]
+    prompts = dict(zip(pending_app_ids, build_assessment_prompts(pending_app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, max_workers, batch_retrieval)))
+
+    records = []
+    errors = {}
+    for index, app_id in enumerate(app_ids):
+        if app_id in preclassified:
+            continue
+        prompt, error = prompts[app_id]
+        if prompt is None:
+            errors[app_id] = error
+            continue
+        records.append(json.dumps({
+            "recordId": batch_record_id(index),
+            "modelInput": {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": MAX_TOKENS,
+                "messages": [{"role": "user", "content": prompt}]
+            }
+        }))
+
+    if not records:
+        # Every application was pre-classified or failed, so there is nothing for the model to do
+        rows = batch_recommendation_rows({'app_ids': app_ids, 'errors': errors, 'preclassified': preclassified}, {})
+        write_csv_to_s3(bucket, output_csv_key, rows)
+        write_recommendation_dataset(bucket, output_csv_key.split('/')[-2], rows[1:])
+        return None
+    if len(records) < BATCH_MIN_RECORDS:
+        raise ValueError(f"Only {len(records)} applications need the model, and a Bedrock batch inference job needs at least "
+                         f"{BATCH_MIN_RECORDS} records; assess them with mode=sync")
+
+    s3.put_object(Bucket=bucket, Key=f"{run_prefix}/input/records.jsonl", Body='\n'.join(records))
+
+    response = bedrock_batch.create_model_invocation_job(
+        jobName=f"r-disposition-{run_prefix.rsplit('/', 1)[-1]}",
+        roleArn=os.environ['BATCH_ROLE_ARN'],
+        modelId=MODEL_ID,
+        inputDataConfig={'s3InputDataConfig': {'s3Uri': f"s3://{bucket}/{run_prefix}/input/records.jsonl"}},
+        outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{bucket}/{run_prefix}/output/"}}
+    )
+    job_arn = response['jobArn']
+
+    # The manifest lets the completion step map record IDs back to applications in input order
+    manifest = {
+        'job_arn': job_arn,
+        'app_ids': app_ids,
+        'errors': errors,
+        'preclassified': preclassified,
+        'output_csv_key': output_csv_key,
+        'run_prefix': run_prefix
+    }
+    s3.put_object(Bucket=bucket, Key=f"{run_prefix}/manifest.json", Body=json.dumps(manifest))
+    s3.put_object(Bucket=bucket, Key=f"{BATCH_PREFIX}/jobs/{job_arn.rsplit('/', 1)[-1]}.json", Body=json.dumps({'manifest_key': f"{run_prefix}/manifest.json"}))
+    logger.info("Submitted batch inference job %s for %d applications", job_arn, len(records))
+    return job_arn
+
+def load_batch_manifest(bucket, job_arn):
+    pointer = json.loads(s3.get_object(Bucket=bucket, Key=f"{BATCH_PREFIX}/jobs/{job_arn.rsplit('/', 1)[-1]}.json")['Body'].read())
+    return json.loads(s3.get_object(Bucket=bucket, Key=pointer['manifest_key'])['Body'].read())
+
+def read_batch_output(bucket, run_prefix):
+    # Stream every output file line by line instead of loading whole files into memory
+    outputs = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{run_prefix}/output/"):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.jsonl.out'):
+                continue
+            for line in s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].iter_lines():
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'modelOutput' in record:
+                    outputs[record['recordId']] = record['modelOutput'].get('content', [{}])[0].get('text', '').strip()
+                else:
+                    outputs[record['recordId']] = None
+    return outputs
+
+def batch_recommendation_rows(manifest, outputs):
+    recommendations = [CSV_HEADER]
+    for index, app_id in enumerate(manifest['app_ids']):
+        recommendation = outputs.get(batch_record_id(index))
+        if app_id in manifest.get('preclassified', {}):
+            recommendations.append(manifest['preclassified'][app_id])
+        elif app_id in manifest['errors']:
+            recommendations.append([app_id, f"Error: assessment failed ({manifest['errors'][app_id]})", '', '', ''])
+        elif not recommendation:
+            recommendations.append([app_id, "Error: assessment failed (no output from batch inference job)", '', '', ''])
+        else:
+            patterns, justification, aws_architecture, approximate_cost = parse_recommendation(recommendation)
+            recommendations.append([app_id, patterns, justification, aws_architecture, approximate_cost])
+    return recommendations
+
+def collect_batch_assessment(bucket, job_arn):
+    # Returns the CSV key once the job has completed, or None while it is still running
+    job = bedrock_batch.get_model_invocation_job(jobIdentifier=job_arn)
+    status = job['status']
+    if status not in ('Completed', 'PartiallyCompleted'):
+        if status in ('Failed', 'Stopped', 'Expired'):
+            raise RuntimeError(f"Batch inference job {job_arn} ended with status {status}: {job.get('message', '')}")
+        logger.info("Batch inference job %s is %s", job_arn, status)
+        return None
+
+    manifest = load_batch_manifest(bucket, job_arn)
+    outputs = read_batch_output(bucket, manifest['run_prefix'])
+    rows = batch_recommendation_rows(manifest, outputs)
+    write_csv_to_s3(bucket, manifest['output_csv_key'], rows)
+    # The run ID is the directory of the CSV, R-Disposition-outputs/<run_id>/
+    write_recommendation_dataset(bucket, manifest['output_csv_key'].split('/')[-2], rows[1:])
+    return manifest['output_csv_key']
+
+def wait_for_batch_assessment(bucket, job_arn, poll_seconds=60, timeout=None):
+    # Poller for callers that can block, e.g. scripts and tests against a local stub of the batch API
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        output_csv_key = collect_batch_assessment(bucket, job_arn)
+        if output_csv_key is not None:
+            return output_csv_key
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(poll_seconds)
+
+def handle_batch_job_event(event):
+    # Completion handler for the EventBridge "Batch Inference Job State Change" event
+    detail = event.get('detail', {})
+    job_arn = detail.get('batchJobArn') or detail.get('jobArn')
+    output_csv_key = collect_batch_assessment(os.environ['S3_BUCKET'], job_arn)
+    return {'statusCode': 200, 'body': json.dumps({'jobArn': job_arn, 'output': output_csv_key})}
+
+# Coordinator mode: scatter the applications of a run over worker invocations of this function and gather their
+# per-application results (saved under the run prefix, as in sync mode) into the run's CSV
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '50'))
+SHARD_QUEUE_URL = os.environ.get('SHARD_QUEUE_URL', '')
+SHARD_DISPATCH = os.environ.get('SHARD_DISPATCH', 'sqs' if SHARD_QUEUE_URL else 'lambda').lower()
+SQS_BATCH_LIMIT = 10  # SendMessageBatch limit
+
+def shard_app_ids(app_ids, shard_size=SHARD_SIZE):
+    shard_size = max(1, shard_size)
+    return [app_ids[start:start + shard_size] for start in range(0, len(app_ids), shard_size)]
+
+def shard_marker_key(run_id, shard):
+    return f"{RUN_PREFIX}/{run_id}/shards/{shard}.json"
+
+class SqsShardQueue:
+    # Workers are triggered by an SQS event source mapping on SHARD_QUEUE_URL; its maximum concurrency bounds
+    # the number of workers calling Bedrock at the same time
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = LazyClient('sqs')
+
+    def send(self, messages):
+        for start in range(0, len(messages), SQS_BATCH_LIMIT):
+            entries = [{'Id': str(index), 'MessageBody': json.dumps(message)}
+                       for index, message in enumerate(messages[start:start + SQS_BATCH_LIMIT])]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get('Failed'):
+                raise RuntimeError(f"Could not queue {len(response['Failed'])} shards: {response['Failed'][0].get('Message')}")
+
+class LambdaShardQueue:
+    # Asynchronous invocations of this function; Lambda queues them and retries failed workers twice
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.client = LazyClient('lambda')
+
+    def send(self, messages):
+        for message in messages:
+            self.client.invoke(FunctionName=self.function_name, InvocationType='Event',
+                               Payload=json.dumps({'shard_message': message}))
+
+class LocalShardQueue:
+    # In-process stand-in for tests and local runs: shards are processed on a thread pool of this process, through
+    # lambda_handler as asynchronous invocations are, and a failed worker is retried twice as Lambda does
+    def __init__(self, max_workers=2, max_attempts=3):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_attempts = max_attempts
+        self.futures = []
+
+    def invoke(self, message):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return lambda_handler({'shard_message': message}, None)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                logger.warning("Shard %s of run %s failed (attempt %d of %d): %s", message['shard'], message['run_id'], attempt, self.max_attempts, e)
+
+    def send(self, messages):
+        self.futures.extend(self.executor.submit(self.invoke, message) for message in messages)
+
+    def join(self):
+        # Waits for every shard, including the continuations queued by the shards themselves
+        while self.futures:
+            self.futures.pop(0).result()
+
+shard_queue = None
+shard_queue_lock = threading.Lock()
+
+def get_shard_queue():
+    global shard_queue
+    with shard_queue_lock:
+        if shard_queue is None:
+            if SHARD_DISPATCH == 'sqs':
+                shard_queue = SqsShardQueue(SHARD_QUEUE_URL)
+            elif SHARD_DISPATCH == 'local':
+                shard_queue = LocalShardQueue()
+            else:
+                shard_queue = LambdaShardQueue(FUNCTION_NAME)
+        return shard_queue
 
-    return patterns, justification, aws_architecture, approximate_cost
+def start_coordinated_run(bucket, run_id, app_ids, output_csv_key, options):
+    shards = shard_app_ids(app_ids)
+    save_run_manifest(bucket, run_id, app_ids, output_csv_key, len(shards), options.get('previous_run_id'))
+    get_shard_queue().send([{'run_id': run_id, 'shard': index, 'app_ids': shard, 'options': options}
+                            for index, shard in enumerate(shards)])
+    emit_metrics('coordinator', {'Shards': len(shards)})
+    return len(shards)
 
+def process_shard(message, context):
+    # Worker side: assess the applications of one shard; applications saved by an earlier attempt are skipped, and
+    # the rest is queued again as a continuation of the same shard if the invocation runs short of time
+    bucket = os.environ['S3_BUCKET']
+    run_id, shard, app_ids, options = message['run_id'], message['shard'], message['app_ids'], message.get('options', {})
+    max_workers = clamp_max_workers(options.get('max_workers', MAX_WORKERS))
+    totals = start_run_totals()
+    retrieved_info = retrieve_from_knowledge_base(os.environ['KB_ID_BP_DOCS'])
+    run = {'bucket': bucket, 'run_id': run_id, 'context': context,
+           'completed': {app_id: result['row'] for app_id, result in load_app_results(bucket, run_id, max_workers, app_ids).items()
+                         if result['status'] != 'failed'}}
+    if options.get('previous_run_id'):
+        run['previous'] = load_previous_results(bucket, options['previous_run_id'], app_ids, max_workers)
+    rows = assess_applications(app_ids, retrieved_info, os.environ['KB_ID_MIGRATION_AGENT_INFO'], os.environ['KB_ID_QANDA_INFO'],
+                               max_workers, options.get('bypass_cache', RESPONSE_CACHE_BYPASS),
+                               options.get('batch_retrieval', KB_BATCH_RETRIEVAL), options.get('preclassify', PRECLASSIFY), run)
+    logger.info("Shard %s of run %s totals: %s", shard, run_id, totals.values)
+    log_routing_report()
+    remaining = [app_id for app_id, row in zip(app_ids, rows) if row is None]
+    if remaining:
+        get_shard_queue().send([dict(message, app_ids=remaining)])
+        return
+    s3.put_object(Bucket=bucket, Key=shard_marker_key(run_id, shard), Body=json.dumps({
+        'shard': shard,
+        'applications': len(app_ids),
+        'completed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }))
+    # The last shard to finish gathers the run; if two finish together both write the same CSV
+    manifest = load_run_manifest(bucket, run_id)
+    if len(list_run_keys(bucket, f"{RUN_PREFIX}/{run_id}/shards/")) >= manifest['shards']:
+        output_csv_key = merge_app_results(bucket, run_id, max_workers)
+        logger.info("Run %s gathered into %s", run_id, output_csv_key)
+
+def handle_shard_event(event, context):
+    # SQS batches and asynchronous invocations from the coordinator. A failed asynchronous invocation raises, so
+    # Lambda retries it; a failed SQS message is reported back, so only that message is delivered again.
+    if 'shard_message' in event:
+        process_shard(event['shard_message'], context)
+        return {'statusCode': 200}
+    failures = []
+    for record in event['Records']:
+        try:
+            process_shard(json.loads(record['body']), context)
+        except Exception as e:
+            logger.error("Shard message %s failed: %s", record.get('messageId'), e, exc_info=True)
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+def run_progress(bucket, run_id):
+    # A merged run is only reported; merging again would rewrite its CSV, dataset and latest.json on every poll
+    output_csv_key = load_merged_csv_key(bucket, run_id)
+    if output_csv_key is not None:
+        return f"Run {run_id} is complete; recommendations are in {output_csv_key}"
+    manifest = load_run_manifest(bucket, run_id)
+    assessed = len(list_run_keys(bucket, f"{RUN_PREFIX}/{run_id}/apps/"))
+    total = len(manifest['app_ids'])
+    if manifest.get('shards'):
+        shards_done = len(list_run_keys(bucket, f"{RUN_PREFIX}/{run_id}/shards/"))
+        if shards_done >= manifest['shards']:
+            output_csv_key = merge_app_results(bucket, run_id)
+            if output_csv_key is not None:
+                return f"Run {run_id} is complete: {total} applications assessed; recommendations are in {output_csv_key}"
+        return f"Run {run_id}: {assessed} of {total} applications assessed, {shards_done} of {manifest['shards']} shards complete"
+    return f"Run {run_id}: {assessed} of {total} applications assessed"
+
+record_init_phase('module')
+
+@instrument
 def lambda_handler(event, context):
-    try:
+    log_init_report()
+    if LOG_PAYLOADS:
         print("Received event: " + json.dumps(event))
+    # Events of other AWS services are routed before the agent's error response below, so that a failure
+    # reaches the service and it retries the event
+    if event.get('detail-type') == 'Batch Inference Job State Change':
+        return handle_batch_job_event(event)
+    if 'shard_message' in event or (event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs'):
+        return handle_shard_event(event, context)
+    try:
         properties = event['requestBody']['content']['application/json']['properties']
         params = {prop['name']: prop['value'] for prop in properties}
         
         s3_bucket = os.environ['S3_BUCKET']
-        app_ids = params['app_ids'].split(',')
-        output_csv_key = f"R-Disposition-outputs/r_disposition_recommendations.csv"
+        app_ids = params.get('app_ids', '').split(',')
+        resume = str(params.get('resume', 'false')).lower() == 'true'
+        if resume and not params.get('run_id'):
+            raise ValueError("resume=true requires the run_id of the run to continue")
+        run_id = params.get('run_id') or new_run_id()
+        output_csv_key = f"R-Disposition-outputs/{run_id}/r_disposition_recommendations.csv"
         kb_id_migration_agent_info = os.environ['KB_ID_MIGRATION_AGENT_INFO'] 
         kb_id_bp_docs = os.environ['KB_ID_BP_DOCS'] 
         kb_id_qanda_info = os.environ['KB_ID_QANDA_INFO'] 
+        max_workers = clamp_max_workers(params.get('max_workers', MAX_WORKERS))
+        bypass_cache = str(params.get('bypass_cache', RESPONSE_CACHE_BYPASS)).lower() == 'true'
+        mode = params.get('mode', ASSESSMENT_MODE).lower()
+        batch_retrieval = str(params.get('batch_retrieval', KB_BATCH_RETRIEVAL)).lower() == 'true'
+        preclassify = str(params.get('preclassify', PRECLASSIFY)).lower() == 'true'
+        # Incremental runs reuse the rows of previous_run_id, or of the latest complete run, whose inputs are unchanged
+        incremental = str(params.get('incremental', 'false')).lower() == 'true'
+        previous_run_id = (params.get('previous_run_id') or load_latest_run_id(s3_bucket)) if incremental and not resume else None
 
-        
-        retrieved_info = retrieve_from_knowledge_base(kb_id_bp_docs)
-        
-        recommendations = [['App-id', 'Top 3 Recommended Migration Patterns', 'Justification', 'Potential AWS Architecture', 'Approximate Cost']]
-        
-        for app_id in app_ids:
-            retrieved_app_info = retrieve_from_app_knowledge_base(app_id, kb_id_migration_agent_info)
-            qanda_info = retrieve_from_qanda_knowledgebase(app_id, kb_id_qanda_info)
-            
-            prompt = (
-                "As an AWS migration expert, your task is to analyze the following application migration readiness data and recommend the most suitable migration patterns for migrating the application to AWS. The migration patterns to consider are:\n"
-                "- Retain\n"
-                "- Retire\n"
-                "- Rehost\n"
-                "- Replatform\n"
-                "- Repurchase\n"
-                "- Refactor\n\n"
-                "In addition to the application migration readiness data, consider the following relevant information retrieved from the knowledge base:\n"
-                f"{retrieved_info}\n\n"
-                "Application-specific information:\n"
-                f"{retrieved_app_info}\n\n"
-                "Application Q&A information:\n"
-                f"{qanda_info}\n\n"
-                "When providing your recommendation, please ensure that all suggestions are directly supported by the information provided in the application migration readiness data, the application-specific information, and the Q&A information. If a recommendation is based on an assumption or information not explicitly mentioned in the data, please clarify that in your response.\n\n"
-                "Please include the following details in your recommendation:\n"
-                "1. Top 3 Recommended Migration Patterns: [Provide the top 3 recommended migration patterns along with their respective percentages, e.g., Refactor-70%, Replatform-20%, Rehost-10%]\n"
-                "2. Justification: [For each recommended migration pattern, provide a detailed explanation of why it is suitable based on the application's characteristics, requirements, and migration goals. Analyze the key factors that influenced your decision, taking into account the complexity, time/velocity, cost, and optimization considerations. Cite specific information from the application readiness data, the application-specific information, and the Q&A information that supports your recommendation.]\n"
-                "3. Potential AWS Architecture: [For each recommended migration pattern, provide a high-level description of the potential AWS architecture that could be implemented. Include the key AWS services, components, and architectural patterns that align with the migration pattern and the application's requirements.]\n\n"
-                "Please provide your detailed recommendation based on the above information, guidelines, and the retrieved insights from the knowledge base, including the application-specific information and Q&A information. Ensure that all suggestions are supported by the provided data. If additional information is required to make a more accurate recommendation, please state the specific details needed.\n\n"
-                "4. Cost Breakdown and Total Cost for each Migration Pattern: [For each recommended migration pattern, provide a detailed cost breakdown at the AWS resource level, listing the individual AWS services, their pricing models (e.g., hourly, monthly, data transfer), and the estimated costs based on the application's requirements and usage patterns. Additionally, provide the total estimated cost for implementing each migration pattern's AWS architecture, considering all relevant factors.]"
-                "Provide your response in a clear, well-structured format, using bullet points, numbering, or headings as appropriate to enhance readability."
-            )
-            print(f"Received final prompt: {prompt}")
-
-            recommendation = invoke_bedrock_model(prompt)
-            patterns, justification, aws_architecture, approximate_cost = parse_recommendation(recommendation)
-            recommendations.append([app_id, patterns, justification, aws_architecture, approximate_cost])
-        
-        write_csv_to_s3(s3_bucket, output_csv_key, recommendations)
+        response_text = output_csv_key
+        totals = start_run_totals()
+        if mode == 'status':
+            # Progress of a coordinated (or checkpointed sync) run for the agent session
+            if not params.get('run_id'):
+                raise ValueError("mode=status requires the run_id of the run to report on")
+            response_text = run_progress(s3_bucket, run_id)
+        elif mode == 'coordinator':
+            options = {'max_workers': max_workers, 'bypass_cache': bypass_cache, 'batch_retrieval': batch_retrieval, 'preclassify': preclassify,
+                       'previous_run_id': previous_run_id}
+            shards = start_coordinated_run(s3_bucket, run_id, app_ids, output_csv_key, options)
+            response_text = (f"Started run {run_id}: {len(app_ids)} applications in {shards} shards. Ask for progress with "
+                             f"mode=status and run_id={run_id}; the recommendations will be written to {output_csv_key}")
+        elif params.get('batch_job_arn'):
+            # Check on a batch job submitted earlier and build the CSV if it has completed. The CSV goes where the
+            # submitting request said it would, not under the run ID of this request.
+            batch_csv_key = collect_batch_assessment(s3_bucket, params['batch_job_arn'])
+            if batch_csv_key is None:
+                response_text = f"Batch inference job {params['batch_job_arn']} is still running"
+            else:
+                response_text = batch_csv_key
+        else:
+            if mode == 'batch' and len(app_ids) < BATCH_MIN_RECORDS:
+                # Too few applications for a batch inference job, so they are assessed the same way as in sync mode
+                logger.warning("%d applications are below the batch inference minimum of %d records; assessing them in sync mode", len(app_ids), BATCH_MIN_RECORDS)
+                mode = 'sync'
+            retrieved_info = retrieve_from_knowledge_base(kb_id_bp_docs)
+
+            if mode == 'batch':
+                job_arn = submit_batch_assessment(s3_bucket, app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, output_csv_key, max_workers, batch_retrieval, preclassify)
+                if job_arn is not None:
+                    response_text = f"Submitted batch inference job {job_arn}; {output_csv_key} will be written when it completes"
+            else:
+                run = {'bucket': s3_bucket, 'run_id': run_id, 'context': context, 'completed': {}}
+                if resume:
+                    # Continue with the applications of the original run; failed ones are assessed again
+                    manifest = load_run_manifest(s3_bucket, run_id)
+                    app_ids, previous_run_id = manifest['app_ids'], manifest.get('previous_run_id')
+                    run['completed'] = {app_id: result['row'] for app_id, result in load_app_results(s3_bucket, run_id, max_workers).items()
+                                        if result['status'] != 'failed'}
+                else:
+                    save_run_manifest(s3_bucket, run_id, app_ids, output_csv_key, previous_run_id=previous_run_id)
+                if previous_run_id:
+                    run['previous'] = load_previous_results(s3_bucket, previous_run_id, app_ids, max_workers)
+
+                rows = assess_applications(app_ids, retrieved_info, kb_id_migration_agent_info, kb_id_qanda_info, max_workers, bypass_cache, batch_retrieval, preclassify, run)
+                remaining = sum(1 for row in rows if row is None)
+                if remaining:
+                    response_text = (f"Run {run_id} stopped close to the Lambda timeout with {len(rows) - remaining} of {len(rows)} applications "
+                                     f"assessed; call again with resume=true and run_id={run_id} to continue")
+                else:
+                    if merge_app_results(s3_bucket, run_id, max_workers) is None:
+                        # Some results could not be saved; the rows in memory are still complete
+                        write_csv_to_s3(s3_bucket, output_csv_key, [CSV_HEADER] + rows)
+                        write_recommendation_dataset(s3_bucket, run_id, rows)
+                    if totals.values.get('reused'):
+                        response_text = f"{output_csv_key} ({totals.values['reused']} of {len(rows)} applications unchanged since run {previous_run_id} were reused)"
+                logger.info("Run totals: %s", totals.values)
+                if response_cache is not None:
+                    logger.info("Bedrock response cache: %s", response_cache.stats())
+            if totals.routing:
+                log_routing_report()
         
         response_body = {
             'application/json': {
-                'body': output_csv_key
+                'body': response_text
             }
         }
 
@@ -284,6 +2114,9 @@ def lambda_handler(event, context):
         }
          
         session_attributes = event['sessionAttributes']
+        if mode == 'coordinator':
+            # Lets the agent ask for the progress of the run later in the session
+            session_attributes = dict(session_attributes or {}, r_disposition_run_id=run_id)
         prompt_session_attributes = event['promptSessionAttributes']
         
         api_response = {
@@ -293,7 +2126,8 @@ def lambda_handler(event, context):
             'promptSessionAttributes': prompt_session_attributes
         }
     
-        print(api_response)
+        if LOG_PAYLOADS:
+            print(api_response)
         return api_response
             
     except Exception as e:
@@ -0,0 +1,35 @@
+import os
+import sys
+import logging
+
+# Shared setup of the tests: the handlers are loaded with load_handler_module from the benchmarks and run against
+# the local stubs in benchmarks/replay.py.
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, BENCHMARK_DIR)
+
+import replay
+import lambda_handler_benchmark
+from lambda_handler_benchmark import load_handler_module, build_event, run_handler
+
+def set_benchmark_environment(**overrides):
+    for name, value in lambda_handler_benchmark.BENCHMARK_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ.update(overrides)
+
+def sample_recommendation():
+    with open(os.path.join(BENCHMARK_DIR, 'responses', 'structured.json')) as f:
+        return f.read()
+
+def load_stubbed_handler(filename, recommendation=None, injector=None):
+    # Returns (module, S3 stub, injector) for a freshly loaded handler whose clients are replaced by the stubs
+    module = load_handler_module(filename)
+    module.logger.setLevel(logging.CRITICAL)
+    injector = injector or replay.Injector()
+    book = replay.ReplayBook([], replay.default_responses(recommendation or sample_recommendation()))
+    s3 = replay.install_stubs(module, book, injector)
+    return module, s3, injector
+
+def response_text(response):
+    return response['response']['responseBody']['application/json']['body']
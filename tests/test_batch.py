@@ -0,0 +1,68 @@
+import os
+import json
+import unittest
+
+from support import build_event, run_handler, response_text, load_stubbed_handler, set_benchmark_environment
+
+# Batch mode of r-disposition-assessment.py end to end against the Bedrock, batch inference and S3 stubs in
+# benchmarks/replay.py: submit, collect with batch_job_arn, and collect from the EventBridge completion event.
+# Run with: python -m unittest discover tests
+
+class BatchAssessmentTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment(BATCH_ROLE_ARN='arn:aws:iam::000000000000:role/batch-inference')
+        self.module, self.s3, injector = load_stubbed_handler('r-disposition-assessment.py')
+        self.module.bedrock_batch.polls_until_complete = 2
+        # The two applications of these tests make the minimum size of a batch job
+        self.module.BATCH_MIN_RECORDS = 2
+        self.bucket = os.environ['S3_BUCKET']
+
+    def invoke(self, event):
+        seconds, response = run_handler(self.module, event)
+        return response
+
+    def request(self, **params):
+        return response_text(self.invoke(build_event('r-disposition-assessment.py', ['A1-CRM', 'A2-CMDB'], params)))
+
+    def submit(self):
+        self.assertTrue(self.request(mode='batch').startswith('Submitted batch inference job '))
+        job_arn, = self.module.bedrock_batch.jobs
+        return job_arn
+
+    def read_csv(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf-8')
+
+    def test_collect_with_batch_job_arn_reports_the_submitted_csv_key(self):
+        job_arn = self.submit()
+        manifest = self.module.load_batch_manifest(self.bucket, job_arn)
+        self.assertIn('still running', self.request(batch_job_arn=job_arn))
+
+        self.assertEqual(self.request(batch_job_arn=job_arn), manifest['output_csv_key'])
+        rows = self.read_csv(manifest['output_csv_key'])
+        self.assertIn('A1-CRM', rows)
+        self.assertIn('A2-CMDB', rows)
+        self.assertNotIn('Error', rows)
+
+    def test_collect_from_eventbridge_event(self):
+        job_arn = self.submit()
+        manifest = self.module.load_batch_manifest(self.bucket, job_arn)
+        self.module.bedrock_batch.complete(job_arn)
+
+        response = self.invoke({'detail-type': 'Batch Inference Job State Change', 'detail': {'batchJobArn': job_arn, 'status': 'Completed'}})
+        self.assertEqual(json.loads(response['body'])['output'], manifest['output_csv_key'])
+        self.assertIn('A2-CMDB', self.read_csv(manifest['output_csv_key']))
+
+    def test_fewer_applications_than_the_batch_minimum_are_assessed_in_sync_mode(self):
+        self.module.BATCH_MIN_RECORDS = 3
+        output_csv_key = self.request(mode='batch')
+        self.assertEqual(self.module.bedrock_batch.jobs, {})
+        self.assertIn('A2-CMDB', self.read_csv(output_csv_key))
+
+    def test_fewer_records_than_the_batch_minimum_are_not_submitted(self):
+        self.module.BATCH_MIN_RECORDS = 3
+        with self.assertRaisesRegex(ValueError, 'needs at least 3 records'):
+            self.module.submit_batch_assessment(self.bucket, ['A1-CRM', 'A2-CMDB'], '', 'kb-app', 'kb-qanda', 'R-Disposition-outputs/run-1/r_disposition_recommendations.csv')
+        self.assertEqual(self.module.bedrock_batch.jobs, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import unittest
+
+from support import lambda_handler_benchmark
+import cold_start_benchmark
+
+# The cold-start benchmark of both handlers, with one fresh process per handler, so the check before deploying
+# keeps working. Only failures are checked here; the timings depend on the machine.
+# Run with: python -m unittest discover tests
+
+class ColdStartTest(unittest.TestCase):
+    def setUp(self):
+        self.environment = dict(lambda_handler_benchmark.BENCHMARK_ENVIRONMENT, **os.environ)
+        # Creating the real clients needs credentials, but never reaches AWS
+        self.environment.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        self.environment.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    def test_first_invocation_succeeds_and_reports_every_phase(self):
+        for filename in cold_start_benchmark.HANDLERS:
+            with self.subTest(handler=filename):
+                results = cold_start_benchmark.run(filename, 1, self.environment)
+                self.assertEqual(cold_start_benchmark.check_budget(filename, results, 0, 0), [])
+                self.assertTrue({'imports', 'configuration', 'module'} <= set(results[0]['components']))
+                self.assertTrue(any(component.startswith('client:') for component in results[0]['components']))
+
+    def test_budget_check_reports_an_exceeded_budget(self):
+        results = [{'init_ms': 200.0, 'first_invocation_ms': 50.0, 'error': False}]
+        self.assertEqual(cold_start_benchmark.check_budget('migration-plan.py', results, 150, 0),
+                         ["migration-plan.py: p50 init phase 200.0 ms exceeds the budget of 150 ms"])
+
+if __name__ == '__main__':
+    unittest.main()
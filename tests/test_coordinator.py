@@ -0,0 +1,77 @@
+import os
+import json
+import unittest
+import contextlib
+from unittest import mock
+
+from support import build_event, run_handler, response_text, load_stubbed_handler, set_benchmark_environment
+
+# Coordinator mode of r-disposition-assessment.py with SHARD_DISPATCH=local against the stubs in benchmarks/replay.py:
+# failed workers are retried, and failed SQS messages are reported back.
+# Run with: python -m unittest discover tests
+
+APP_IDS = ['A1-CRM', 'A2-CMDB', 'A3-OLD', 'A4-ARCHIVE', 'A5-HR']
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        with mock.patch.dict(os.environ, {'SHARD_DISPATCH': 'local', 'SHARD_SIZE': '2'}):
+            self.module, self.s3, injector = load_stubbed_handler('r-disposition-assessment.py')
+        self.bucket = os.environ['S3_BUCKET']
+        self.attempts = {}
+
+    def fail_shard(self, shard, failures):
+        process_shard = self.module.process_shard
+        def fail(message, context):
+            self.attempts[message['shard']] = self.attempts.get(message['shard'], 0) + 1
+            if message['shard'] == shard and self.attempts[shard] <= failures:
+                raise RuntimeError("Worker failed")
+            return process_shard(message, context)
+        self.module.process_shard = fail
+
+    def request(self, **params):
+        seconds, response = run_handler(self.module, build_event('r-disposition-assessment.py', APP_IDS, params))
+        return response_text(response)
+
+    def join(self):
+        # The workers run after run_handler returns, so their output is kept out of the test report here
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.module.get_shard_queue().join()
+
+    def start_run(self):
+        self.assertTrue(self.request(mode='coordinator', run_id='run-1').startswith('Started run run-1: 5 applications in 3 shards'))
+
+    def test_failed_worker_is_retried_and_the_run_is_gathered(self):
+        self.fail_shard(1, 1)
+        self.start_run()
+        self.join()
+
+        self.assertEqual(self.attempts, {0: 1, 1: 2, 2: 1})
+        self.assertIn('is complete', self.request(mode='status', run_id='run-1'))
+        body = self.s3.get_object(Bucket=self.bucket, Key='R-Disposition-outputs/run-1/r_disposition_recommendations.csv')['Body'].read().decode('utf-8')
+        for app_id in APP_IDS:
+            self.assertIn(app_id, body)
+
+    def test_worker_failing_every_attempt_leaves_the_run_open(self):
+        self.fail_shard(1, 3)
+        self.start_run()
+        with self.assertRaises(RuntimeError):
+            self.join()
+        self.module.get_shard_queue().executor.shutdown(wait=True)
+
+        self.assertEqual(self.attempts[1], 3)
+        self.assertIn('2 of 3 shards complete', self.request(mode='status', run_id='run-1'))
+
+    def test_failed_sqs_message_is_reported(self):
+        self.module.save_run_manifest(self.bucket, 'run-1', APP_IDS[:2], 'R-Disposition-outputs/run-1/r_disposition_recommendations.csv', 2)
+        event = {'Records': [
+            {'messageId': 'm1', 'eventSource': 'aws:sqs', 'body': json.dumps({'run_id': 'run-1', 'shard': 0, 'app_ids': APP_IDS[:1]})},
+            {'messageId': 'm2', 'eventSource': 'aws:sqs', 'body': json.dumps({'shard': 1, 'app_ids': APP_IDS[1:2]})}
+        ]}
+        seconds, response = run_handler(self.module, event)
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'm2'}]})
+        self.assertIn('A1-CRM', self.module.load_app_results(self.bucket, 'run-1', 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import unittest
+
+from support import replay, build_event, run_handler, response_text, load_stubbed_handler, set_benchmark_environment
+
+# Incremental runs of r-disposition-assessment.py against the stubs in benchmarks/replay.py, whose knowledge base
+# answers the same for the same question, as KB_RETRIEVAL_MODE=retrieve and the inventory index do.
+# Run with: python -m unittest discover tests
+
+APP_IDS = ['A1-CRM', 'A2-CMDB', 'A3-BILLING']
+
+class IncrementalRunTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        self.s3 = replay.StubS3(replay.Injector())
+
+    def request(self, app_ids, changed_app_id=None, **params):
+        # Every request runs in a fresh container, so nothing is shared but S3
+        module, s3, injector = load_stubbed_handler('r-disposition-assessment.py')
+        module.s3 = self.s3
+        if changed_app_id:
+            retrieve_and_generate = module.bedrock_client.retrieve_and_generate
+            def changed(**request):
+                response = retrieve_and_generate(**request)
+                if changed_app_id in request['input']['text']:
+                    response = dict(response, output={'text': response['output']['text'] + " The application moved to a new server."})
+                return response
+            module.bedrock_client.retrieve_and_generate = changed
+        seconds, response = run_handler(module, build_event('r-disposition-assessment.py', app_ids, params))
+        return response_text(response), injector.stats()['calls'].get('invoke_model', 0)
+
+    def test_unchanged_inventory_makes_no_model_calls(self):
+        output_csv_key, calls = self.request(APP_IDS, run_id='run-1')
+        self.assertEqual(calls, 3)
+
+        response, calls = self.request(APP_IDS, run_id='run-2', incremental='true')
+        self.assertEqual(calls, 0)
+        self.assertIn('3 of 3 applications unchanged since run run-1 were reused', response)
+        self.assertEqual(self.s3.get_object(Bucket=os.environ['S3_BUCKET'], Key='R-Disposition-outputs/run-2/r_disposition_recommendations.csv')['Body'].read(),
+                         self.s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=output_csv_key)['Body'].read())
+
+    def test_only_new_applications_are_assessed(self):
+        self.request(APP_IDS[:2], run_id='run-1')
+        response, calls = self.request(APP_IDS, run_id='run-2', incremental='true')
+        self.assertEqual(calls, 1)
+        self.assertIn('2 of 3 applications unchanged since run run-1 were reused', response)
+
+    def test_applications_whose_information_changed_are_assessed_again(self):
+        self.request(APP_IDS, run_id='run-1')
+        response, calls = self.request(APP_IDS, changed_app_id='A2-CMDB', run_id='run-2', incremental='true')
+        self.assertEqual(calls, 1)
+        self.assertIn('2 of 3 applications unchanged since run run-1 were reused', response)
+
+if __name__ == '__main__':
+    unittest.main()
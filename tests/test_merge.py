@@ -0,0 +1,40 @@
+import os
+import io
+import csv
+import unittest
+
+from support import load_stubbed_handler, set_benchmark_environment
+
+# Merging the saved per-application results of a run into the CSV, with r-disposition-assessment.py running against
+# the stubs in benchmarks/replay.py.
+# Run with: python -m unittest discover tests
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        self.module, self.s3, self.injector = load_stubbed_handler('r-disposition-assessment.py', "Rehost-100%")
+        self.bucket = os.environ['S3_BUCKET']
+        self.app_ids = [f"APP-{index:04d}" for index in range(50)]
+        self.module.save_run_manifest(self.bucket, 'run-1', self.app_ids, 'R-Disposition-outputs/run-1/r_disposition_recommendations.csv')
+        for app_id in self.app_ids:
+            self.module.save_app_result(self.bucket, 'run-1', app_id, [app_id, 'Rehost-100%', 'Justification ' * 20, '', ''], '', 'complete')
+
+    def merged_rows(self, key):
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf-8')
+        return list(csv.reader(io.StringIO(body)))
+
+    def test_small_csv_is_one_put(self):
+        key = self.module.merge_app_results(self.bucket, 'run-1')
+        self.assertEqual([row[0] for row in self.merged_rows(key)], ['App-id'] + self.app_ids)
+        self.assertNotIn('create_multipart_upload', self.injector.stats()['calls'])
+
+    def test_large_csv_is_streamed_in_parts(self):
+        self.module.CSV_PART_BYTES = 1024
+        self.module.DATASET_PART_ROWS = 7
+        key = self.module.merge_app_results(self.bucket, 'run-1')
+        self.assertEqual([row[0] for row in self.merged_rows(key)], ['App-id'] + self.app_ids)
+        self.assertGreater(self.injector.stats()['calls']['upload_part'], 1)
+        self.assertEqual(self.s3.uploads, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import glob
+import json
+import logging
+import unittest
+
+from support import BENCHMARK_DIR, load_handler_module
+
+# parse_recommendation of r-disposition-assessment.py over the model responses in benchmarks/responses: structured
+# output checked against RECOMMENDATION_SCHEMA, and the text parser as the fallback for every header style.
+# Run with: python -m unittest discover tests
+
+CORPUS = sorted(glob.glob(os.path.join(BENCHMARK_DIR, 'responses', '*')))
+STRUCTURED = {'structured.json', 'structured-fenced.txt'}
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+class ParseRecommendationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.module = load_handler_module('r-disposition-assessment.py')
+        cls.module.logger.setLevel(logging.CRITICAL)
+        # Without the metrics decorator, which prints a metric line per call
+        cls.parse = staticmethod(cls.module.parse_recommendation.__wrapped__)
+        cls.structured = json.loads(read(os.path.join(BENCHMARK_DIR, 'responses', 'structured.json')))
+
+    def test_every_corpus_response_has_all_four_sections(self):
+        self.assertTrue(CORPUS)
+        for path in CORPUS:
+            with self.subTest(response=os.path.basename(path)):
+                self.assertTrue(all(self.parse(read(path))))
+
+    def test_structured_responses_use_the_structured_parser(self):
+        for path in CORPUS:
+            with self.subTest(response=os.path.basename(path)):
+                parsed = self.module.parse_structured_recommendation(read(path))
+                self.assertEqual(parsed is not None, os.path.basename(path) in STRUCTURED)
+        patterns, justification, architecture, cost = self.parse(json.dumps(self.structured))
+        self.assertEqual(patterns, 'Replatform-60%, Rehost-30%, Refactor-10%')
+        self.assertEqual(justification, self.structured['justification'].strip())
+
+    def test_text_responses_are_split_at_their_headers(self):
+        patterns, justification, architecture, cost = self.parse(read(os.path.join(BENCHMARK_DIR, 'responses', 'numbered.txt')))
+        self.assertTrue(patterns.startswith('1. Top 3 Recommended Migration Patterns:'))
+        self.assertIn('Replatform-60%', patterns)
+        self.assertTrue(justification.startswith('2. Justification:'))
+        self.assertTrue(architecture.startswith('3. Potential AWS Architecture:'))
+        self.assertTrue(cost.startswith('4. Cost Breakdown'))
+
+    def test_sentence_starting_with_a_section_name_is_not_a_header(self):
+        patterns, justification, architecture, cost = self.parse(
+            "1. Top 3 Recommended Migration Patterns:\nRehost-100%\n2. Justification:\nJustification for Rehost is the deadline.\n"
+            "Potential AWS architecture changes are small.")
+        self.assertEqual(justification, "2. Justification:\nJustification for Rehost is the deadline.\nPotential AWS architecture changes are small.")
+        self.assertEqual(architecture, '')
+
+    def test_output_not_matching_the_schema_falls_back_to_the_text_parser(self):
+        invalid = {
+            'missing section': {key: value for key, value in self.structured.items() if key != 'approximate_cost'},
+            'percentage not a number': dict(self.structured, top_3_recommended_migration_patterns=[{'pattern': 'Rehost', 'percentage': '100%'}]),
+            'section not a string': dict(self.structured, justification=['Rehost'])
+        }
+        for name, data in invalid.items():
+            with self.subTest(name):
+                self.assertIsNone(self.module.parse_structured_recommendation(json.dumps(data)))
+        self.assertIsNone(self.module.parse_structured_recommendation('{"top_3_recommended_migration_patterns": '))
+        self.assertEqual(self.parse('{not json'), ('', '', '', ''))
+
+if __name__ == '__main__':
+    unittest.main()
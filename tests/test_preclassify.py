@@ -0,0 +1,75 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+from support import load_handler_module
+
+# Pre-classification rules of r-disposition-assessment.py against an inventory index built by build-inventory-index.py.
+# Run with: python -m unittest discover tests
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+class PreclassifyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        sheets = {
+            'Applications': [
+                ['Application ID', 'Application Name', 'Status', 'Business Criticality', 'Number of users'],
+                ['A1-CRM', 'CRM Application', 'Active', 'High', '1200'],
+                ['A3-OLD', 'Old reporting', 'Retired', 'Low', '0'],
+                ['A4-ARCHIVE', 'Archive viewer', 'Decommissioned', 'Low', '']
+            ],
+            'Server to application': [
+                ['appid', 'serverId', 'Status'],
+                ['A1-CRM', 'S1', 'Active'],
+                ['A1-CRM', 'S2', 'Decommissioned']
+            ],
+            'Application dependency': [
+                ['Application ID', 'Dependent Application ID', 'Status'],
+                ['A1-CRM', 'A3-OLD', 'Retired']
+            ]
+        }
+        sources = []
+        for sheet, rows in sheets.items():
+            path = os.path.join(cls.directory, f"{sheet}.csv")
+            write_csv(path, rows)
+            sources.append(('inventory', path))
+        qanda_path = os.path.join(cls.directory, 'qanda.csv')
+        write_csv(qanda_path, [
+            ['app-id', 'Migration Assessment Questions', 'App team Response'],
+            ['A1-CRM', 'Is the application still in use?', 'Yes, by the sales team'],
+            ['A3-OLD', 'Is the application still in use?', 'No longer used']
+        ])
+        sources.append(('qanda', qanda_path))
+
+        index_path = os.path.join(cls.directory, 'inventory.db')
+        load_handler_module('build-inventory-index.py').build_index(sources, index_path)
+        cls.module = load_handler_module('r-disposition-assessment.py')
+        cls.module.refresh_inventory_index = lambda: index_path
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_active_app_with_retired_dependency_and_decommissioned_server_goes_to_the_model(self):
+        self.assertIsNone(self.module.preclassify_application('A1-CRM'))
+
+    def test_only_the_apps_own_rows_are_evaluated(self):
+        fields = {(sheet, field) for kind, sheet, field, value in self.module.load_app_attributes('A1-CRM')}
+        self.assertIn(('Applications', 'Status'), fields)
+        self.assertFalse({sheet for sheet, field in fields} & {'Server to application', 'Application dependency'})
+
+    def test_retired_app_is_preclassified(self):
+        row = self.module.preclassify_application('A3-OLD')
+        self.assertEqual(row[1], 'Retire-100%')
+
+    def test_decommissioned_app_is_preclassified(self):
+        self.assertEqual(self.module.preclassify_application('A4-ARCHIVE')[1], 'Retire-100%')
+
+if __name__ == '__main__':
+    unittest.main()
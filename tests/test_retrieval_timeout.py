@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import threading
+import unittest
+import contextlib
+from unittest import mock
+
+from support import build_event, run_handler, response_text, load_stubbed_handler, set_benchmark_environment
+
+# Concurrent knowledge base retrieval of migration-plan.py against the stubs in benchmarks/replay.py, with a knowledge
+# base that does not answer within KB_RETRIEVAL_TIMEOUT.
+# Run with: python -m unittest discover tests
+
+class RetrievalTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        with mock.patch.dict(os.environ, {'KB_RETRIEVAL_TIMEOUT': '0.2'}):
+            self.module, self.s3, injector = load_stubbed_handler('migration-plan.py', "Plan text")
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def block_retrievals(self):
+        def blocked(**request):
+            self.release.wait(10)
+            return {'output': {'text': "Knowledge base answer"}, 'retrievalResults': []}
+        self.module.bedrock_client.retrieve_and_generate = blocked
+        self.module.bedrock_client.retrieve = blocked
+
+    def request(self, app_id):
+        return run_handler(self.module, build_event('migration-plan.py', [app_id], {}))
+
+    def test_blocked_retrievals_are_marked_unavailable(self):
+        self.block_retrievals()
+        start = time.monotonic()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            contexts = self.module.retrieve_migration_contexts(['A1-CRM'], ['Rehost'], 'kb-bp', 'kb-app', 'kb-qanda', timeout=0.2)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(set(contexts), {('best practices', 'Rehost'), ('application', 'A1-CRM'), ('Q&A', 'A1-CRM')})
+        self.assertEqual(set(contexts.values()), {self.module.UNAVAILABLE_CONTEXT})
+
+    def test_request_with_blocked_retrievals_still_generates_the_plan(self):
+        self.block_retrievals()
+        seconds, response = self.request('A1-CRM')
+        self.assertLess(seconds, 5)
+        self.assertTrue(response_text(response).startswith('R-Disposition-outputs/A1-CRM_migration_plan.txt (warning: generated without the'))
+        self.assertIn((os.environ['S3_BUCKET'], 'R-Disposition-outputs/A1-CRM_migration_plan.txt'), self.s3.objects)
+
+    def test_no_retrievals_without_applications(self):
+        self.assertEqual(self.module.retrieve_migration_contexts([], [], 'kb-bp', 'kb-app', 'kb-qanda'), {})
+
+    def test_empty_app_id_is_a_clear_error(self):
+        seconds, response = self.request(' ')
+        self.assertEqual(response['statusCode'], 500)
+        self.assertIn('at least one application', json.loads(response['body'])['details'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import threading
+import contextlib
+import unittest
+
+from support import replay, lambda_handler_benchmark, build_event, load_stubbed_handler, set_benchmark_environment
+
+# Per-request routing totals of migration-plan.py: requests handled by one container at the same time each report
+# only their own model calls.
+# Run with: python -m unittest discover tests
+
+REQUESTS = {'one plan': (['A1-CRM'], 'Retire'), 'four plans': (['A2-CMDB', 'A3-BILLING'], 'Rehost,Replatform')}
+
+class RoutingTotalsTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+
+    def run_requests(self, names):
+        # Runs the requests at the same time in one freshly loaded module; returns the routing report of each
+        module, s3, injector = load_stubbed_handler('migration-plan.py', "Plan text", replay.Injector({'*': (20, 5)}))
+        reports = {}
+        log_routing_report = module.log_routing_report
+        def log_and_keep():
+            # Called on the thread of the request
+            reports[threading.current_thread().name] = log_routing_report()
+        module.log_routing_report = log_and_keep
+        def request(name):
+            app_ids, r_strategy = REQUESTS[name]
+            event = build_event('migration-plan.py', app_ids, {'r_strategy': r_strategy, 'bypass_cache': 'true'})
+            module.lambda_handler(event, lambda_handler_benchmark.BenchmarkContext())
+
+        threads = [threading.Thread(target=request, args=(name,), name=name) for name in names]
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return reports
+
+    def calls(self, report):
+        return {route: totals['calls'] for route, totals in report['routes'].items()}
+
+    def test_concurrent_requests_keep_separate_routing_totals(self):
+        alone = {name: self.run_requests([name])[name] for name in REQUESTS}
+        together = self.run_requests(list(REQUESTS))
+        for name in REQUESTS:
+            with self.subTest(request=name):
+                self.assertEqual(self.calls(together[name]), self.calls(alone[name]))
+        self.assertLess(alone['one plan']['summary']['calls'], alone['four plans']['summary']['calls'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import itertools
+import unittest
+
+from support import replay, build_event, run_handler, load_stubbed_handler, set_benchmark_environment
+
+# Sectioned mode of migration-plan.py against the stubs in benchmarks/replay.py, with a knowledge base that
+# answers differently on every call, as RetrieveAndGenerate does.
+# Run with: python -m unittest discover tests
+
+class SectionedPlanTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        self.s3 = replay.StubS3(replay.Injector())
+        self.answers = itertools.count()
+
+    def request(self, **params):
+        # Every request runs in a fresh container, so nothing is shared but S3
+        module, s3, injector = load_stubbed_handler('migration-plan.py', "Section text")
+        module.s3 = self.s3
+        module.bedrock_client.retrieve_and_generate = lambda **request: {'output': {'text': f"Knowledge base answer {next(self.answers)}"}}
+        run_handler(module, build_event('migration-plan.py', ['A1-CRM'], dict(params, sectioned='true')))
+        return injector.stats()['calls'].get('invoke_model', 0)
+
+    def test_regenerate_sections_only_calls_the_model_for_those_sections(self):
+        self.assertEqual(self.request(), 1 + 10)
+        self.assertEqual(self.request(regenerate_sections='3,7'), 2)
+
+    def test_regenerate_sections_generates_missing_parts(self):
+        self.assertEqual(self.request(regenerate_sections='3'), 1 + 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import unittest
+import contextlib
+
+from botocore.exceptions import ClientError
+
+from support import replay, build_event, run_handler, response_text, load_stubbed_handler, set_benchmark_environment
+
+# Client-side rate limiting and retries of r-disposition-assessment.py against the stubs in benchmarks/replay.py, with
+# throttling injected by replay.Injector.
+# Run with: python -m unittest discover tests
+
+class ThrottlingTest(unittest.TestCase):
+    def setUp(self):
+        set_benchmark_environment()
+        self.module, self.s3, injector = load_stubbed_handler('r-disposition-assessment.py')
+        self.module.THROTTLE_BASE_DELAY = 0.001
+        self.module.THROTTLE_MAX_DELAY = 0.01
+        self.book = replay.ReplayBook([], replay.default_responses("Rehost-100%"))
+
+    def invoke_model(self, bedrock, limiter):
+        body = json.dumps({'anthropic_version': 'bedrock-2023-05-31', 'max_tokens': 10, 'messages': [{'role': 'user', 'content': 'Assess'}]})
+        return self.module.call_with_backoff(limiter, bedrock.invoke_model, modelId=self.module.MODEL_ID, body=body)
+
+    def test_rate_limiter_paces_calls_after_the_burst(self):
+        limiter = self.module.RateLimiter(100)
+        start = time.monotonic()
+        for _ in range(120):
+            limiter.acquire()
+        # The first 100 calls are the burst; the other 20 are paced at 100 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_rate_limiter_backs_off_on_throttling_and_recovers(self):
+        limiter = self.module.RateLimiter(10)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 2.5)
+        limiter.succeeded()
+        self.assertEqual(limiter.rate, 3.5)
+        for _ in range(10):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 10)
+
+    def test_throttled_calls_are_retried(self):
+        injector = replay.Injector(throttle_rate=0.3, seed=7)
+        bedrock = replay.StubBedrockRuntime(self.book, injector)
+        limiter = self.module.RateLimiter(0)
+        for _ in range(20):
+            self.assertIn('body', self.invoke_model(bedrock, limiter))
+
+        stats = injector.stats()
+        self.assertGreater(stats['throttles']['invoke_model'], 0)
+        self.assertEqual(stats['calls']['invoke_model'], 20 + stats['throttles']['invoke_model'])
+
+    def test_retries_are_bounded(self):
+        self.module.THROTTLE_MAX_RETRIES = 2
+        injector = replay.Injector(throttle_rate=1.0)
+        with self.assertRaises(ClientError):
+            self.invoke_model(replay.StubBedrockRuntime(self.book, injector), self.module.RateLimiter(0))
+        self.assertEqual(injector.stats()['calls']['invoke_model'], 3)
+
+    def test_exhausted_knowledge_base_retries_flag_the_assessment_as_degraded(self):
+        self.module.THROTTLE_MAX_RETRIES = 2
+        # Only the knowledge base is throttled; the model still answers
+        self.module.bedrock_client = replay.StubAgentRuntime(self.book, replay.Injector(throttle_rate=1.0))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.assertEqual(self.module.retrieve_from_app_knowledge_base('A1-CRM', 'kb-app'), self.module.UNAVAILABLE_CONTEXT)
+
+        seconds, response = run_handler(self.module, build_event('r-disposition-assessment.py', ['A1-CRM'], {}))
+        body = self.s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=response_text(response))['Body'].read().decode('utf-8')
+        self.assertIn('Warning: assessed without the application, Q&A context', body)
+
+if __name__ == '__main__':
+    unittest.main()
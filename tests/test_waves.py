@@ -0,0 +1,77 @@
+import os
+import csv
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from support import load_handler_module
+
+# Move groups and migration waves planned by build-inventory-index.py from application dependencies and servers.
+# Run with: python -m unittest discover tests
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+class WavePlanningTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.module = load_handler_module('build-inventory-index.py')
+        cls.directory = tempfile.mkdtemp()
+        # A1-CRM depends on A2-CMDB, which is in a cycle with A3-BILLING; A4-PORTAL depends on A1-CRM and shares a
+        # server with A5-SEARCH
+        sheets = {
+            'Applications': [['Application ID', 'Application Name']] + [[app_id, app_id] for app_id in
+                                                                         ['A1-CRM', 'A2-CMDB', 'A3-BILLING', 'A4-PORTAL', 'A5-SEARCH']],
+            'Application dependency': [
+                ['Application ID', 'Dependent Application ID'],
+                ['A1-CRM', 'A2-CMDB'],
+                ['A2-CMDB', 'A3-BILLING'],
+                ['A3-BILLING', 'A2-CMDB'],
+                ['A4-PORTAL', 'A1-CRM']
+            ],
+            'Server to application': [['appid', 'serverId'], ['A4-PORTAL', 'S1'], ['A5-SEARCH', 'S1']]
+        }
+        sources = []
+        for sheet, rows in sheets.items():
+            path = os.path.join(cls.directory, f"{sheet}.csv")
+            write_csv(path, rows)
+            sources.append(('inventory', path))
+        cls.index_path = os.path.join(cls.directory, 'inventory.db')
+        cls.module.build_index(sources, cls.index_path)
+        connection = sqlite3.connect(cls.index_path)
+        cls.apps = {app_id: (wave, move_group) for app_id, wave, move_group in connection.execute("SELECT app_id, wave, move_group FROM apps")}
+        connection.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_dependency_cycle_collapses_into_one_move_group(self):
+        self.assertEqual(self.apps['A2-CMDB'], self.apps['A3-BILLING'])
+        self.assertEqual(self.apps['A2-CMDB'][0], 1)
+
+    def test_waves_follow_the_dependencies(self):
+        self.assertEqual(self.apps['A1-CRM'][0], 2)
+        self.assertEqual(self.apps['A4-PORTAL'][0], 3)
+
+    def test_applications_on_the_same_server_move_together(self):
+        self.assertEqual(self.apps['A4-PORTAL'], self.apps['A5-SEARCH'])
+        self.assertEqual(len({move_group for wave, move_group in self.apps.values()}), 3)
+
+    def test_waves_csv_lists_every_application_in_wave_order(self):
+        with open(os.path.join(self.directory, 'inventory-waves.csv')) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['App-id', 'Wave', 'Move group', 'Depends on'])
+        self.assertEqual([row[0] for row in rows[1:]], ['A2-CMDB', 'A3-BILLING', 'A1-CRM', 'A4-PORTAL', 'A5-SEARCH'])
+
+    def test_deep_dependency_chain_does_not_hit_the_recursion_limit(self):
+        adjacency = {index: [index + 1] for index in range(5000)}
+        adjacency[5000] = [0]
+        components = self.module.strongly_connected_components(adjacency)
+        self.assertEqual(len(components), 1)
+        self.assertEqual(len(components[0]), 5001)
+
+if __name__ == '__main__':
+    unittest.main()